@@ -0,0 +1,77 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.authentication import TokenAuthentication
+
+
+class TokenCache(object):
+    """
+    Validated tokens of this process, least recently used evicted first.
+
+    Deleting a token evicts it here at once, see `accounts.models`. Entries
+    expire `settings.ACCOUNTS_TOKEN_CACHE_TTL` seconds after the lookup, which
+    bounds how long a token revoked by another process, or its deactivated
+    user, keeps working in this one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            expires, credentials = entry
+            if expires <= time.time():
+                return None
+
+            # Re-inserting moves the entry to the most recently used end.
+            self._entries[key] = entry
+
+            return credentials
+
+    def set(self, key, credentials):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + settings.ACCOUNTS_TOKEN_CACHE_TTL, credentials)
+
+            while len(self._entries) > settings.ACCOUNTS_TOKEN_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    `TokenAuthentication` answering repeated requests from `token_cache`,
+    without touching the database or the session.
+    """
+
+    def authenticate_credentials(self, key):
+        credentials = token_cache.get(key)
+        if credentials is None:
+            credentials = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+            token_cache.set(key, credentials)
+
+        return credentials
+
@@ -0,0 +1,200 @@
+# encoding: utf-8
+"""
+Password hashing off the request thread.
+
+PBKDF2 is CPU bound by design; running it in a small process pool with a
+bounded number of pending jobs keeps a login burst from pinning every web
+worker, and rejects the excess at once instead of queueing it.
+"""
+from __future__ import unicode_literals
+
+import logging
+import multiprocessing
+import os
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+from drf_samples.instrumentation import register_stats, span
+
+logger = logging.getLogger(__name__)
+
+
+class HashingPoolSaturated(Exception):
+    pass
+
+
+class HashingStats(object):
+    """
+    Queue depth and timings of a hashing pool, local to the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.pending = 0
+            self.completed = 0
+            self.rejected = 0
+            self.hash_seconds = 0.0
+            self.wait_seconds = 0.0
+
+    def enter(self):
+        with self._lock:
+            self.pending += 1
+
+    def leave(self):
+        with self._lock:
+            self.pending -= 1
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def complete(self, hash_seconds, total_seconds):
+        with self._lock:
+            self.completed += 1
+            self.hash_seconds += hash_seconds
+            self.wait_seconds += total_seconds - hash_seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'mean_hash_ms': self.hash_seconds / self.completed * 1000 if self.completed else 0.0,
+                'mean_wait_ms': self.wait_seconds / self.completed * 1000 if self.completed else 0.0,
+            }
+
+
+def _timed(func, *args):
+    """
+    Run `func(*args)` and return its result, the exception it raised if any,
+    and its duration.
+
+    Never raises, so the pool calls back once the call is over whatever happened;
+    Python 2 pools have no error callback.
+    """
+    start = default_timer()
+    try:
+        result, error = func(*args), None
+    except Exception as e:
+        result, error = None, e
+
+    return result, error, default_timer() - start
+
+
+class HashingPool(object):
+    """
+    Runs hasher calls in `processes` worker processes, or inline when 0.
+
+    At most `max_pending` calls wait or run at a time; further calls raise
+    `HashingPoolSaturated`, as do calls without a result after `timeout` seconds.
+    A call that timed out keeps its slot until it is over.
+    """
+
+    def __init__(self, processes=2, max_pending=8, timeout=5):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.stats = HashingStats()
+
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool_lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def make_password(self, password):
+        return self.run(hashers.make_password, password)
+
+    def check_password(self, password, encoded):
+        return self.run(hashers.check_password, password, encoded)
+
+    def run(self, func, *args):
+        if not self._slots.acquire(False):
+            self.stats.reject()
+            logger.warning('Hashing pool saturated: %s pending', self.max_pending)
+            raise HashingPoolSaturated()
+
+        self.stats.enter()
+        with span('hash'):
+            start = default_timer()
+            if self.processes:
+                # The slot is held until the call is over, also after a timeout:
+                # the call still occupies the pool.
+                try:
+                    task = self._get_pool().apply_async(_timed, (func,) + args, callback=self._release)
+                except Exception:
+                    self._release()
+                    raise
+
+                try:
+                    result, error, hash_seconds = task.get(self.timeout)
+                except multiprocessing.TimeoutError:
+                    raise HashingPoolSaturated()
+            else:
+                try:
+                    result, error, hash_seconds = _timed(func, *args)
+                finally:
+                    self._release()
+
+        if error is not None:
+            raise error
+
+        self.stats.complete(hash_seconds, default_timer() - start)
+
+        return result
+
+    def _release(self, *args):
+        self.stats.leave()
+        self._slots.release()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            # Forked web workers inherit the attribute but not the pool processes.
+            if self._pool_pid != os.getpid():
+                self._pool = multiprocessing.Pool(self.processes)
+                self._pool_pid = os.getpid()
+
+            return self._pool
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.terminate()
+                self._pool.join()
+
+                # Calls cut short by `terminate` never call back.
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+                self.stats.reset()
+
+            self._pool = None
+            self._pool_pid = None
+
+
+_hashing_pool = None
+_hashing_pool_lock = threading.Lock()
+
+
+def get_hashing_pool():
+    """
+    Return the process-wide pool configured by `settings.ACCOUNTS_HASHING_POOL`.
+    """
+    global _hashing_pool
+
+    with _hashing_pool_lock:
+        if _hashing_pool is None:
+            config = settings.ACCOUNTS_HASHING_POOL
+            _hashing_pool = HashingPool(
+                processes=config['PROCESSES'],
+                max_pending=config['MAX_PENDING'],
+                timeout=config['TIMEOUT'],
+            )
+            register_stats('hashing', _hashing_pool.stats.snapshot)
+
+    return _hashing_pool
@@ -0,0 +1,257 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+import multiprocessing
+import os
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from django.utils import six
+from rest_framework import serializers
+
+from accounts.models import UserProfile
+from accounts.serializers import UserProfileSerializer, UserSerializer
+
+
+# Inserts of a chunk tried while other processes keep registering its usernames.
+INSERT_ATTEMPTS = 3
+
+
+class UserImportSerializer(UserSerializer):
+    """
+    `UserSerializer` without the per-row unique query; the command checks
+    usernames a chunk at a time.
+    """
+    username = serializers.CharField()
+
+
+def read_csv(path):
+    if six.PY2:
+        with open(path, 'rb') as source:
+            for row in csv.DictReader(source):
+                yield dict((key.decode('utf-8'), (value or b'').decode('utf-8')) for key, value in row.items())
+    else:
+        with io.open(path, encoding='utf-8', newline='') as source:
+            for row in csv.DictReader(source):
+                yield row
+
+
+def read_jsonl(path):
+    with io.open(path, encoding='utf-8') as source:
+        for line in source:
+            if not line.strip():
+                continue
+
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Rejected by the serializers like any other non-object record.
+                yield line
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Import users with their profiles from a CSV or JSONL file with the columns username, password, '
+        'email (optional), birth_date, country, city, post_code and telephone_number.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file to import.')
+        parser.add_argument(
+            '--format',
+            choices=sorted(READERS),
+            help='Input format; guessed from the file extension by default.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Records validated, hashed and inserted together.',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help='Worker processes hashing passwords.',
+        )
+        parser.add_argument(
+            '--progress',
+            help='File recording the records done, to resume an interrupted import; defaults to PATH.progress.',
+        )
+        parser.add_argument(
+            '--report',
+            help='JSONL file listing rejected records: duplicate usernames and validation errors; '
+                 'defaults to PATH.rejected.jsonl.',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if input_format not in READERS:
+            raise CommandError('Unknown format {!r}, use --format.'.format(input_format))
+
+        if options['chunk_size'] < 1 or options['processes'] < 1:
+            raise CommandError('--chunk-size and --processes must be positive.')
+
+        progress_path = options['progress'] or path + '.progress'
+        report_path = options['report'] or path + '.rejected.jsonl'
+
+        done = self._read_progress(progress_path)
+        if done:
+            self.stdout.write('Resuming after record {}.'.format(done))
+
+        records = enumerate(READERS[input_format](path), start=1)
+        records = islice(records, done, None)
+
+        imported = rejected = 0
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            with io.open(report_path, 'a', encoding='utf-8') as report:
+                while True:
+                    chunk = list(islice(records, options['chunk_size']))
+                    if not chunk:
+                        break
+
+                    chunk_imported, rejections = self._import_chunk(chunk, pool)
+
+                    for rejection in rejections:
+                        report.write(json.dumps(rejection, ensure_ascii=False) + '\n')
+                    report.flush()
+
+                    imported += chunk_imported
+                    rejected += len(rejections)
+                    done = chunk[-1][0]
+                    self._write_progress(progress_path, done)
+
+                    self.stdout.write('{} records done: {} imported, {} rejected.'.format(done, imported, rejected))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.stdout.write(self.style.SUCCESS('Imported {} users, rejected {} records{}.'.format(
+            imported, rejected, ', see {}'.format(report_path) if rejected else ''
+        )))
+
+    def _import_chunk(self, chunk, pool):
+        """
+        Insert the valid, new users of `chunk`; return their number and the rejections.
+        """
+        rejections = []
+        accounts = []
+        usernames = set()
+
+        for number, record in chunk:
+            user_serializer = UserImportSerializer(data=record)
+            profile_serializer = UserProfileSerializer(data=record)
+
+            user_valid = user_serializer.is_valid()
+            profile_valid = profile_serializer.is_valid()
+            if not (user_valid and profile_valid):
+                errors = dict(user_serializer.errors)
+                errors.update(profile_serializer.errors)
+                rejections.append(self._rejection(number, record, 'invalid', errors))
+                continue
+
+            username = User.normalize_username(user_serializer.validated_data['username'])
+            if username in usernames:
+                rejections.append(self._rejection(number, record, 'duplicate'))
+                continue
+
+            usernames.add(username)
+            accounts.append((number, record, username, user_serializer.validated_data, profile_serializer.validated_data))
+
+        # Hashed on the first attempt only, a retry drops accounts.
+        passwords = None
+        error = None
+        for _ in range(INSERT_ATTEMPTS):
+            existing = self._get_existing([account[2] for account in accounts])
+
+            # The insert failed for another reason than a username taken meanwhile.
+            if error is not None and not existing:
+                raise error
+
+            for number, record, username, user_data, profile_data in accounts:
+                if username in existing:
+                    rejections.append(self._rejection(number, record, 'exists'))
+
+            accounts = [account for account in accounts if account[2] not in existing]
+
+            if passwords is None:
+                passwords = dict(zip(
+                    [account[2] for account in accounts],
+                    pool.map(make_password, [user_data['password'] for _, _, _, user_data, _ in accounts])
+                ))
+
+            try:
+                with transaction.atomic():
+                    self._insert(accounts, [passwords[account[2]] for account in accounts])
+            except IntegrityError as e:
+                # Registered concurrently, check the usernames again.
+                error = e
+                continue
+
+            break
+        else:
+            raise error
+
+        rejections.sort(key=lambda rejection: rejection['record'])
+
+        return len(accounts), rejections
+
+    def _get_existing(self, usernames):
+        return set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+
+    def _insert(self, accounts, passwords):
+        User.objects.bulk_create([
+            User(username=username, email=user_data.get('email', ''), password=password)
+            for (_, _, username, user_data, _), password in zip(accounts, passwords)
+        ])
+
+        # Not every database returns the primary keys of bulk inserts.
+        user_ids = dict(
+            User.objects.filter(username__in=[account[2] for account in accounts]).values_list('username', 'id')
+        )
+
+        UserProfile.objects.bulk_create([
+            UserProfile(user_id=user_ids[username], **profile_data)
+            for _, _, username, _, profile_data in accounts
+        ])
+
+    def _rejection(self, number, record, reason, errors=None):
+        rejection = {
+            'record': number,
+            'username': record.get('username') if isinstance(record, dict) else None,
+            'reason': reason,
+        }
+        if errors:
+            rejection['errors'] = errors
+
+        return rejection
+
+    def _read_progress(self, path):
+        try:
+            with io.open(path, encoding='ascii') as progress:
+                return int(progress.read().strip() or 0)
+        except IOError:
+            return 0
+        except ValueError:
+            raise CommandError('Unreadable progress file {}.'.format(path))
+
+    def _write_progress(self, path, done):
+        # Replace atomically, an interrupted write must not lose the progress.
+        temporary = path + '.tmp'
+        with io.open(temporary, 'w', encoding='ascii') as progress:
+            progress.write('{}\n'.format(done))
+        os.rename(temporary, path)
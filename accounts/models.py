@@ -2,6 +2,11 @@ from __future__ import unicode_literals
 
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from accounts.authentication import token_cache
 
 
 # Create your models here.
@@ -13,3 +18,8 @@ class UserProfile(models.Model):
     city = models.CharField(max_length=255)
     post_code = models.CharField(max_length=10)
     telephone_number = models.CharField(max_length=20)
+
+
+@receiver(post_delete, sender=Token)
+def evict_revoked_token(sender, instance, **kwargs):
+    token_cache.evict(instance.key)
@@ -0,0 +1,31 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core import signing
+
+from accounts.hashing import get_hashing_pool
+
+TICKET_SALT = 'accounts.registration'
+
+
+def make_ticket(username, password):
+    """
+    Signed ticket carrying the account of registration step 1 to step 2.
+
+    The password is hashed before it leaves the server, in the hashing pool:
+    raises `HashingPoolSaturated` when it is busy.
+    """
+    return signing.dumps(
+        {'username': username, 'password': get_hashing_pool().make_password(password)},
+        salt=TICKET_SALT,
+        compress=True,
+    )
+
+
+def read_ticket(ticket):
+    """
+    Account data of a ticket; raises `signing.BadSignature` when it is forged or
+    older than `settings.ACCOUNTS_REGISTRATION_TICKET_MAX_AGE` seconds.
+    """
+    return signing.loads(ticket, salt=TICKET_SALT, max_age=settings.ACCOUNTS_REGISTRATION_TICKET_MAX_AGE)
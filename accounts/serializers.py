@@ -6,15 +6,16 @@ from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 
 from accounts.models import UserProfile
+from drf_samples.instrumentation import TimedSerializerMixin
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = UserProfile
         fields = ('birth_date', 'country', 'city', 'post_code', 'telephone_number',)
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     id = serializers.IntegerField(read_only=True)
     username = serializers.CharField(
         validators=[UniqueValidator(queryset=User.objects.all()), ]
@@ -27,6 +28,6 @@ class UserSerializer(serializers.ModelSerializer):
         extra_kwargs = {'password': {'write_only': True}}
 
 
-class UserAuthenticateSerializer(serializers.Serializer):
+class UserAuthenticateSerializer(TimedSerializerMixin, serializers.Serializer):
     username = serializers.CharField()
     password = serializers.CharField()
@@ -1,8 +1,33 @@
 # Create your tests here.
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from logging.handlers import BufferingHandler
+
+from django.contrib.auth.hashers import check_password
 from django.contrib.auth.models import User
+from django.core import signing
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import override_settings
 from django.urls import reverse
+from django.utils.six import StringIO
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
+from accounts import hashing
+from accounts.authentication import token_cache
+from accounts.hashing import HashingPool, HashingPoolSaturated
+from accounts.management.commands import import_users
+from accounts.models import UserProfile
+from accounts.registration import make_ticket, read_ticket
+from drf_samples.instrumentation import log_stats, stats_logger
+from drf_samples.routers import is_pinned
+
 
 class AccountRegisterApiViewTestCase(APITestCase):
     url_register = reverse('accounts:register')
@@ -37,16 +62,42 @@ class AccountRegisterApiViewTestCase(APITestCase):
         self.assertIn('username', response_json)
         self.assertIn('This field must be unique.', response_json['username'])
 
-    def test_session_token(self):
+    def test_registration_ticket(self):
         account_data = {
             'username': 'FooBarUser',
             'password': 'ExampleFooBar'
         }
 
         response = self.client.post(self.url_register, account_data)
-        self.assertIn('sessionid', response.cookies)
+        self.assertNotIn('sessionid', response.cookies)
         self.assertEqual(202, response.status_code)
 
+        ticket = read_ticket(response.json()['ticket'])
+        self.assertEqual('FooBarUser', ticket['username'])
+        self.assertNotIn('ExampleFooBar', response.json()['ticket'])
+        self.assertTrue(check_password('ExampleFooBar', ticket['password']))
+
+    def test_invalid_ticket(self):
+        user_profile_data = {
+            'birth_date': '2000-01-01',
+            'country': 'Poland',
+            'city': 'Warszawa',
+            'post_code': '123-456',
+            'telephone_number': '+48123456789',
+        }
+
+        ticket = signing.dumps({'username': 'FooBarUser', 'password': 'hash'}, salt='other')
+        user_profile_data['ticket'] = ticket
+        response = self.client.post(self.url_register_step_2, user_profile_data)
+        self.assertEqual(403, response.status_code)
+
+        with override_settings(ACCOUNTS_REGISTRATION_TICKET_MAX_AGE=-1):
+            user_profile_data['ticket'] = make_ticket('FooBarUser', 'ExampleFooBar')
+            response = self.client.post(self.url_register_step_2, user_profile_data)
+            self.assertEqual(403, response.status_code)
+
+        self.assertFalse(User.objects.filter(username='FooBarUser').exists())
+
     def test_invalid_user_profile_data(self):
         account_data = {
             'username': 'FooBarUser',
@@ -64,8 +115,8 @@ class AccountRegisterApiViewTestCase(APITestCase):
             'telephone_number': '+48123456789',
         }
 
-        self.client.cookies = response.cookies
-        response = self.client.post(self.url_register_step_2, user_profile_data)
+        ticket = response.json()['ticket']
+        response = self.client.post(self.url_register_step_2, dict(user_profile_data, ticket=ticket))
 
         self.assertEqual(400, response.status_code)
 
@@ -119,14 +170,13 @@ class AccountRegisterApiViewTestCase(APITestCase):
             password='ExaplePassword'
         )
 
-        self.client.cookies = response.cookies
-        response_step = self.client.post(self.url_register_step_2, user_profile_data)
+        ticket = response.json()['ticket']
+        response_step = self.client.post(self.url_register_step_2, dict(user_profile_data, ticket=ticket))
 
         self.assertEqual(400, response_step.status_code)
 
         response_json = response_step.json()
         self.assertIn('This field must be unique.', response_json['username'])
-        self.assertEqual('', response_step.cookies['sessionid'].value)
 
     def test_register_full(self):
         account_data = {
@@ -145,8 +195,8 @@ class AccountRegisterApiViewTestCase(APITestCase):
             'telephone_number': '+48123456789',
         }
 
-        self.client.cookies = response.cookies
-        response_step = self.client.post(self.url_register_step_2, user_profile_data)
+        ticket = response.json()['ticket']
+        response_step = self.client.post(self.url_register_step_2, dict(user_profile_data, ticket=ticket))
 
         self.assertEqual(200, response_step.status_code)
 
@@ -155,6 +205,8 @@ class AccountRegisterApiViewTestCase(APITestCase):
         self.assertEqual(account_data['username'], response_json['username'])
         self.assertEqual('', response_json['email'])
         self.assertEqual(user_profile_data, response_json['user_profile'])
+        # Reads own writes right after registering.
+        self.assertTrue(is_pinned(response_json['id']))
 
 
 class AccountAuthenticationApiViewTestCase(APITestCase):
@@ -205,3 +257,321 @@ class AccountAuthenticationApiViewTestCase(APITestCase):
         response = self.client.post(self.url, user_data)
         self.assertEqual(200, response.status_code)
         self.assertIn('sessionid', response.cookies)
+
+
+class AccountTokenApiViewTestCase(APITestCase):
+    url = reverse('accounts:token')
+    url_unread = reverse('chat:messages')
+
+    def setUp(self):
+        token_cache.clear()
+
+        self.user = User.objects.create_user('example', password='example_pass')
+
+    def _get_token(self):
+        response = self.client.post(self.url, {'username': 'example', 'password': 'example_pass'})
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('sessionid', response.cookies)
+
+        return response.json()['token']
+
+    def test_invalid_password(self):
+        response = self.client.post(self.url, {'username': 'example', 'password': 'invalid_password'})
+
+        self.assertEqual(401, response.status_code)
+        self.assertFalse(Token.objects.exists())
+
+    def test_token_is_reused(self):
+        self.assertEqual(self._get_token(), self._get_token())
+
+    def test_cached_authentication(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self._get_token())
+        self.assertEqual(200, self.client.get(self.url_unread).status_code)
+
+        # The token and the unread count are cached: no query, no session.
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url_unread)
+
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('sessionid', response.cookies)
+
+    def test_invalid_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token invalid')
+
+        self.assertEqual(403, self.client.get(self.url_unread).status_code)
+        self.assertEqual(0, len(token_cache))
+
+    def test_revoke(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self._get_token())
+        self.assertEqual(200, self.client.get(self.url_unread).status_code)
+
+        self.assertEqual(204, self.client.delete(self.url).status_code)
+
+        self.assertEqual(403, self.client.get(self.url_unread).status_code)
+        self.assertFalse(Token.objects.exists())
+
+    def test_revoke_without_token(self):
+        self.assertEqual(401, self.client.delete(self.url).status_code)
+
+    @override_settings(ACCOUNTS_TOKEN_CACHE_SIZE=2)
+    def test_cache_evicts_least_recently_used(self):
+        for key in ('a', 'b'):
+            token_cache.set(key, key)
+        token_cache.get('a')
+        token_cache.set('c', 'c')
+
+        self.assertEqual('a', token_cache.get('a'))
+        self.assertIsNone(token_cache.get('b'))
+        self.assertEqual('c', token_cache.get('c'))
+
+    @override_settings(ACCOUNTS_TOKEN_CACHE_TTL=0)
+    def test_cache_expires(self):
+        token_cache.set('a', 'a')
+
+        self.assertIsNone(token_cache.get('a'))
+
+
+class HashingPoolTestCase(APITestCase):
+    def _saturate(self, pool):
+        """
+        Occupy every slot of an inline `pool` until the returned event is set.
+        """
+        release = threading.Event()
+        threads = [
+            threading.Thread(target=pool.run, args=(release.wait,))
+            for _ in range(pool.max_pending)
+        ]
+        for thread in threads:
+            thread.start()
+
+        while pool.stats.snapshot()['pending'] < pool.max_pending:
+            time.sleep(0.01)
+
+        def finish():
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.addCleanup(finish)
+
+    def test_worker_processes(self):
+        pool = HashingPool(processes=1, max_pending=2)
+        self.addCleanup(pool.close)
+
+        encoded = pool.make_password('example_pass')
+
+        self.assertTrue(pool.check_password('example_pass', encoded))
+        self.assertFalse(pool.check_password('invalid_password', encoded))
+
+        stats = pool.stats.snapshot()
+        self.assertEqual(3, stats['completed'])
+        self.assertEqual(0, stats['pending'])
+        self.assertGreater(stats['mean_hash_ms'], 0)
+
+    def test_timeout(self):
+        pool = HashingPool(processes=1, max_pending=2, timeout=0.05)
+        self.addCleanup(pool.close)
+
+        with self.assertRaises(HashingPoolSaturated):
+            pool.run(time.sleep, 1)
+
+        # The sleep still occupies the pool, and its slot.
+        self.assertEqual(1, pool.stats.snapshot()['pending'])
+        with self.assertRaises(HashingPoolSaturated):
+            pool.run(time.sleep, 1)
+
+        started = time.time()
+        with self.assertRaises(HashingPoolSaturated):
+            pool.run(time.sleep, 1)
+        self.assertLess(time.time() - started, 0.05)
+        self.assertEqual(1, pool.stats.snapshot()['rejected'])
+
+        while pool.stats.snapshot()['pending']:
+            time.sleep(0.05)
+        self.assertIsNone(pool.run(time.sleep, 0))
+
+    def test_error(self):
+        pool = HashingPool(processes=1, max_pending=1)
+        self.addCleanup(pool.close)
+
+        with self.assertRaises(ValueError):
+            pool.run(int, 'x')
+
+        self.assertEqual(0, pool.stats.snapshot()['pending'])
+        self.assertEqual(1, pool.run(int, '1'))
+
+    def test_saturated(self):
+        pool = HashingPool(processes=0, max_pending=2)
+        self._saturate(pool)
+
+        with self.assertRaises(HashingPoolSaturated):
+            pool.make_password('example_pass')
+
+        self.assertEqual(1, pool.stats.snapshot()['rejected'])
+
+    def test_stats_logged(self):
+        self.addCleanup(setattr, hashing, '_hashing_pool', hashing._hashing_pool)
+        hashing._hashing_pool = None
+        pool = hashing.get_hashing_pool()
+        self.addCleanup(pool.close)
+
+        handler = BufferingHandler(10)
+        self.addCleanup(setattr, stats_logger, 'handlers', stats_logger.handlers)
+        stats_logger.handlers = [handler]
+
+        pool.stats.complete(0.02, 0.03)
+        log_stats()
+
+        record, = handler.buffer
+        self.assertEqual(1, record.stats['hashing.completed'])
+        self.assertEqual(10.0, record.stats['hashing.mean_wait_ms'])
+
+    def test_saturated_login(self):
+        User.objects.create_user('example', password='example_pass')
+
+        pool = HashingPool(processes=0, max_pending=1)
+        self.addCleanup(setattr, hashing, '_hashing_pool', hashing._hashing_pool)
+        hashing._hashing_pool = pool
+        self._saturate(pool)
+
+        response = self.client.post(reverse('accounts:login'), {'username': 'example', 'password': 'example_pass'})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('1', response['Retry-After'])
+
+        response = self.client.post(reverse('accounts:register'), {'username': 'other', 'password': 'example_pass'})
+        self.assertEqual(503, response.status_code)
+
+
+class ImportUsersCommandTestCase(APITestCase):
+    profile = 'birth_date,country,city,post_code,telephone_number'
+    profile_values = '2000-01-01,Poland,Warszawa,00-001,+48123456789'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        with io.open(path, 'w', encoding='utf-8') as source:
+            source.write(u'\n'.join(lines) + u'\n')
+
+        return path
+
+    def _import(self, path, chunk_size=2):
+        call_command('import_users', path, processes=1, chunk_size=chunk_size, stdout=StringIO())
+
+    def _report(self, path):
+        with io.open(path + '.rejected.jsonl', encoding='utf-8') as report:
+            return [json.loads(line) for line in report]
+
+    def test_import_csv(self):
+        User.objects.create_user('existing')
+        path = self._write('users.csv', [
+            'username,password,email,' + self.profile,
+            'user_1,pass_1,user_1@example.com,' + self.profile_values,
+            'user_2,pass_2,,' + self.profile_values,
+            'user_1,pass_3,,' + self.profile_values,
+            'existing,pass_4,,' + self.profile_values,
+            'user_5,pass_5,,not-a-date,Poland,Warszawa,00-001,+48123456789',
+            u'u\u017cytkownik,pass_6,,' + self.profile_values,
+        ])
+
+        self._import(path, chunk_size=10)
+
+        self.assertEqual(
+            set(['existing', 'user_1', 'user_2', u'u\u017cytkownik']),
+            set(User.objects.values_list('username', flat=True))
+        )
+        self.assertEqual(3, UserProfile.objects.count())
+
+        user = User.objects.get(username='user_1')
+        self.assertTrue(user.check_password('pass_1'))
+        self.assertEqual('user_1@example.com', user.email)
+        self.assertEqual('Warszawa', user.userprofile.city)
+
+        report = self._report(path)
+        self.assertEqual(
+            [(3, 'user_1', 'duplicate'), (4, 'existing', 'exists'), (5, 'user_5', 'invalid')],
+            [(rejection['record'], rejection['username'], rejection['reason']) for rejection in report]
+        )
+        self.assertIn('birth_date', report[2]['errors'])
+
+    def test_import_jsonl(self):
+        profile = dict(zip(self.profile.split(','), self.profile_values.split(',')))
+        path = self._write('users.jsonl', [
+            json.dumps(dict(profile, username='user_1', password='pass_1')),
+            'not json',
+            json.dumps(dict(profile, username='user_2', password='pass_2')),
+        ])
+
+        self._import(path)
+
+        self.assertEqual(2, UserProfile.objects.count())
+        self.assertEqual(['invalid'], [rejection['reason'] for rejection in self._report(path)])
+
+    def _patch(self, name, before=lambda: None, after=lambda: None):
+        method = getattr(import_users.Command, name)
+
+        def patched(command, *args):
+            before()
+            result = method(command, *args)
+            after()
+            return result
+
+        setattr(import_users.Command, name, patched)
+        self.addCleanup(setattr, import_users.Command, name, method)
+
+    def test_registered_concurrently(self):
+        path = self._write('users.csv', [
+            'username,password,email,' + self.profile,
+            'user_1,pass_1,,' + self.profile_values,
+            'user_2,pass_2,,' + self.profile_values,
+        ])
+        # Between the check of the usernames and the insert.
+        self._patch('_get_existing', after=lambda: User.objects.get_or_create(username='user_2'))
+
+        self._import(path)
+
+        self.assertEqual(1, UserProfile.objects.count())
+        self.assertEqual([(2, 'exists')], [(r['record'], r['reason']) for r in self._report(path)])
+
+    def test_integrity_error_not_retried(self):
+        path = self._write('users.csv', [
+            'username,password,email,' + self.profile,
+            'user_1,pass_1,,' + self.profile_values,
+        ])
+        attempts = []
+
+        def fail():
+            attempts.append(1)
+            raise IntegrityError('profile constraint')
+
+        self._patch('_insert', before=fail)
+
+        with self.assertRaises(IntegrityError):
+            self._import(path)
+
+        self.assertEqual(1, len(attempts))
+
+    def test_resume(self):
+        path = self._write('users.csv', [
+            'username,password,email,' + self.profile,
+        ] + [
+            'user_{},pass,,{}'.format(i, self.profile_values) for i in range(5)
+        ])
+
+        with io.open(path + '.progress', 'w', encoding='ascii') as progress:
+            progress.write(u'2\n')
+
+        self._import(path)
+
+        self.assertEqual(
+            ['user_2', 'user_3', 'user_4'],
+            list(User.objects.order_by('username').values_list('username', flat=True))
+        )
+        with io.open(path + '.progress', encoding='ascii') as progress:
+            self.assertEqual('5', progress.read().strip())
+
+        # Nothing is left to do.
+        self._import(path)
+        self.assertEqual(3, User.objects.count())
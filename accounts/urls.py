@@ -3,10 +3,13 @@ from __future__ import unicode_literals
 
 from django.conf.urls import url
 
-from accounts.views import AccountRegisterBaseApiView, AccountRegisterCompleteApiView, AccountAuthenticationApiView
+from accounts.views import (
+    AccountRegisterBaseApiView, AccountRegisterCompleteApiView, AccountAuthenticationApiView, AccountTokenApiView
+)
 
 urlpatterns = [
     url(r'^accounts/login$', AccountAuthenticationApiView.as_view(), name='login'),
+    url(r'^accounts/token$', AccountTokenApiView.as_view(), name='token'),
     url(r'^accounts/register$', AccountRegisterBaseApiView.as_view(), name='register'),
     url(r'^accounts/register/step/2$', AccountRegisterCompleteApiView.as_view(), name='register_step_2'),
 ]
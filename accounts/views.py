@@ -2,15 +2,29 @@
 from __future__ import unicode_literals
 
 from django.contrib.auth import login
-from django.contrib.auth.hashers import check_password
 from django.contrib.auth.models import User
+from django.core import signing
 from django.db import IntegrityError
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
 
+from accounts.hashing import HashingPoolSaturated, get_hashing_pool
 from accounts.models import UserProfile
+from accounts.registration import make_ticket, read_ticket
 from accounts.serializers import UserSerializer, UserProfileSerializer, UserAuthenticateSerializer
+from drf_samples.routers import pin_user
+
+
+def hashing_unavailable():
+    response = Response(
+        data={'detail': 'Too many password checks in progress, try again later.'},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+    response['Retry-After'] = '1'
+
+    return response
 
 
 class AccountRegisterBaseApiView(GenericAPIView):
@@ -22,11 +36,13 @@ class AccountRegisterBaseApiView(GenericAPIView):
         if serializer.is_valid():
             account_data = serializer.validated_data
 
-            request.session['username'] = account_data['username']
-            request.session['password'] = account_data['password']
+            try:
+                ticket = make_ticket(account_data['username'], account_data['password'])
+            except HashingPoolSaturated:
+                return hashing_unavailable()
 
             return Response(
-                data=serializer.errors,
+                data={'ticket': ticket},
                 status=status.HTTP_202_ACCEPTED
             )
 
@@ -40,7 +56,9 @@ class AccountRegisterCompleteApiView(GenericAPIView):
     serializer_class = UserProfileSerializer
 
     def post(self, request, *args, **kwargs):
-        if 'username' not in request.session:
+        try:
+            account_data = read_ticket(request.data.get('ticket', ''))
+        except signing.BadSignature:
             return Response(
                 status=status.HTTP_403_FORBIDDEN
             )
@@ -48,13 +66,12 @@ class AccountRegisterCompleteApiView(GenericAPIView):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
             try:
-                user = User.objects.create_user(
-                    username=request.session['username'],
-                    password=request.session['password']
+                # The ticket holds the hashed password already.
+                user = User.objects.create(
+                    username=User.normalize_username(account_data['username']),
+                    password=account_data['password']
                 )
             except IntegrityError as e:
-                request.session.flush()
-
                 return Response(
                     data={'username': ['This field must be unique.']},
                     status=status.HTTP_400_BAD_REQUEST,
@@ -65,6 +82,9 @@ class AccountRegisterCompleteApiView(GenericAPIView):
                 **serializer.validated_data
             )
 
+            # Not logged in yet, the middleware cannot pin the new user.
+            pin_user(user.pk)
+
             user_serializer = UserSerializer(user)
 
             return Response(
@@ -92,13 +112,48 @@ class AccountAuthenticationApiView(GenericAPIView):
                     status=status.HTTP_401_UNAUTHORIZED
                 )
 
-            if check_password(serializer.validated_data['password'], user.password):
-                login(request, user)
+            try:
+                valid = get_hashing_pool().check_password(serializer.validated_data['password'], user.password)
+            except HashingPoolSaturated:
+                return hashing_unavailable()
 
-                return Response(
-                    status=status.HTTP_200_OK
-                )
+            if valid:
+                return self.authenticated(request, user)
 
         return Response(
             status=status.HTTP_401_UNAUTHORIZED
         )
+
+    def authenticated(self, request, user):
+        login(request, user)
+
+        return Response(
+            status=status.HTTP_200_OK
+        )
+
+
+class AccountTokenApiView(AccountAuthenticationApiView):
+    """
+    Token mode of the login: the client sends `Authorization: Token <token>`
+    instead of a session cookie. DELETE revokes the token it was sent with.
+    """
+
+    def authenticated(self, request, user):
+        token, created = Token.objects.get_or_create(user=user)
+
+        return Response(
+            data={'token': token.key},
+            status=status.HTTP_200_OK
+        )
+
+    def delete(self, request, *args, **kwargs):
+        if not isinstance(request.auth, Token):
+            return Response(
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+
+        request.auth.delete()
+
+        return Response(
+            status=status.HTTP_204_NO_CONTENT
+        )
@@ -0,0 +1,96 @@
+# encoding: utf-8
+"""
+Concurrent writers sending messages while readers poll unread counts, the
+contention `Message.objects.send` and `get_unread_count` meet in production.
+"""
+from __future__ import unicode_literals
+
+import random
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection
+
+from benchmarks.runner import summarize
+from chat.models import Message
+
+
+class Worker(threading.Thread):
+    """
+    Repeats `operation(rng)` until `deadline`, timing each call.
+
+    With `close_connection` the connection is closed after every call, as
+    Django does at the end of a request with `CONN_MAX_AGE = 0`.
+    """
+
+    def __init__(self, operation, deadline, seed, close_connection):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.operation = operation
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.close_connection = close_connection
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        try:
+            while default_timer() < self.deadline:
+                start = default_timer()
+                try:
+                    self.operation(self.rng)
+                except OperationalError:
+                    # "database is locked": the busy timeout ran out.
+                    self.errors += 1
+                else:
+                    self.latencies.append(default_timer() - start)
+
+                if self.close_connection:
+                    connection.close()
+        finally:
+            connection.close()
+
+
+def run_mixed_workload(user_ids, readers=4, writers=2, duration=5.0, close_connections=False, seed=0):
+    """
+    Run `writers` threads sending messages and `readers` threads reading unread
+    counts between random pairs of `user_ids` for `duration` seconds.
+    """
+    users = [User(pk=user_id) for user_id in user_ids]
+
+    def pick_pair(rng):
+        sender, receiver = rng.sample(users, 2)
+        return sender, receiver
+
+    def write(rng):
+        sender, receiver = pick_pair(rng)
+        Message.objects.send(sender, receiver, 'Benchmark message.')
+
+    def read(rng):
+        user, peer = pick_pair(rng)
+        Message.objects.get_unread_count(user, peer)
+
+    start = default_timer()
+    deadline = start + duration
+    workers = (
+        [('writes', Worker(write, deadline, seed + i, close_connections)) for i in range(writers)] +
+        [('reads', Worker(read, deadline, seed + writers + i, close_connections)) for i in range(readers)]
+    )
+
+    for _, worker in workers:
+        worker.start()
+    for _, worker in workers:
+        worker.join()
+
+    elapsed = default_timer() - start
+
+    results = OrderedDict()
+    for kind in ('writes', 'reads'):
+        latencies = [latency for name, worker in workers if name == kind for latency in worker.latencies]
+        summary = summarize(latencies, elapsed) if latencies else OrderedDict((('requests', 0),))
+        summary['errors'] = sum(worker.errors for name, worker in workers if name == kind)
+        results[kind] = summary
+
+    return results
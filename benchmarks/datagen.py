@@ -0,0 +1,139 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import bisect
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.utils.six import StringIO
+
+from accounts.models import UserProfile
+from chat.models import Message, Sequence, get_conversation_key
+
+USERNAME = 'bench_user_{}'
+PASSWORD = 'bench_password'
+
+
+class ZipfSampler(object):
+    """
+    Draws ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** skew.
+    """
+
+    def __init__(self, n, skew, rng):
+        self.rng = rng
+        self.cumulative = []
+
+        total = 0.0
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** skew
+            self.cumulative.append(total)
+
+    def __call__(self):
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+class Dataset(object):
+    """
+    Generated users and the conversations between them, most active first.
+    """
+
+    def __init__(self, usernames, conversations):
+        self.usernames = usernames
+        self.conversations = conversations
+
+    @property
+    def user_ids(self):
+        return sorted(self.usernames)
+
+
+def generate(users, messages, skew=1.1, seed=0, batch_size=1000):
+    """
+    Create `users` users with profiles and `messages` messages between them.
+
+    Conversation activity follows a Zipf distribution with exponent `skew`: a
+    few conversations hold most of the messages, most hold only a handful. The
+    same arguments always produce the same data.
+    """
+    rng = random.Random(seed)
+
+    # Hashing is deliberately slow, every generated user shares one password.
+    password = make_password(PASSWORD)
+
+    with transaction.atomic():
+        User.objects.bulk_create([
+            User(username=USERNAME.format(i), password=password)
+            for i in range(users)
+        ], batch_size=batch_size)
+
+        usernames = dict(
+            User.objects.filter(username__startswith='bench_user_').values_list('id', 'username')
+        )
+        user_ids = sorted(usernames)
+
+        UserProfile.objects.bulk_create([
+            UserProfile(
+                user_id=user_id,
+                birth_date=datetime.date(1970, 1, 1) + datetime.timedelta(days=rng.randrange(15000)),
+                country='Poland',
+                city='Warszawa',
+                post_code='00-{:03d}'.format(rng.randrange(1000)),
+                telephone_number='+48{:09d}'.format(rng.randrange(10 ** 9)),
+            )
+            for user_id in user_ids
+        ], batch_size=batch_size)
+
+        conversations = _pick_conversations(user_ids, rng)
+        sample = ZipfSampler(len(conversations), skew, rng)
+
+        last_token = Sequence.objects.next_value(Message.SYNC_SEQUENCE, messages)
+        sync_token = last_token - messages
+
+        for start in range(0, messages, batch_size):
+            batch = []
+            for i in range(start, min(start + batch_size, messages)):
+                sync_token += 1
+                sender_id, receiver_id = conversations[sample()]
+                if rng.random() < 0.5:
+                    sender_id, receiver_id = receiver_id, sender_id
+
+                batch.append(Message(
+                    sender_id=sender_id,
+                    receiver_id=receiver_id,
+                    content='Benchmark message {}.'.format(i),
+                    conversation_key=get_conversation_key(sender_id, receiver_id),
+                    sync_token=sync_token,
+                ))
+
+            Message.objects.bulk_create(batch)
+
+        # Nothing has been read yet, derive the counters from the messages.
+        call_command('rebuild_unread_counters', stdout=StringIO())
+
+    return Dataset(usernames, conversations)
+
+
+def _pick_conversations(user_ids, rng):
+    """
+    Distinct user pairs, a few per user, in random order.
+    """
+    if len(user_ids) < 2:
+        raise ValueError('At least two users are needed.')
+
+    pairs = set()
+    for user_id in user_ids:
+        for _ in range(3):
+            peer_id = rng.choice(user_ids)
+            if peer_id != user_id:
+                pairs.add(tuple(sorted((user_id, peer_id))))
+
+    if not pairs:
+        pairs.add((user_ids[0], user_ids[1]))
+
+    conversations = sorted(pairs)
+    rng.shuffle(conversations)
+
+    return conversations
@@ -0,0 +1,142 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from benchmarks.concurrency import run_mixed_workload
+from benchmarks.datagen import generate
+from benchmarks.management.commands.benchmark import get_revision
+from drf_samples.database import get_sqlite_pragmas
+
+REPORTED_PRAGMAS = ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size')
+
+# `baseline` is the profile before `SQLITE_PRAGMAS` and `CONN_MAX_AGE`: default
+# pragmas and a new connection per operation.
+PROFILES = OrderedDict((
+    ('baseline', {'pragmas': {}, 'close_connections': True}),
+    ('tuned', {'pragmas': None, 'close_connections': False}),
+))
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure throughput of concurrent message sends and unread count reads on a file database, '
+        'with the default connection handling and with the database profile from the settings.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles',
+            default=','.join(PROFILES),
+            help='Comma separated subset of: {}.'.format(', '.join(PROFILES)),
+        )
+        parser.add_argument('--users', type=int, default=100, help='Users exchanging messages.')
+        parser.add_argument('--messages', type=int, default=1000, help='Messages generated beforehand.')
+        parser.add_argument('--readers', type=int, default=4, help='Threads reading unread counts.')
+        parser.add_argument('--writers', type=int, default=2, help='Threads sending messages.')
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds each profile runs.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the data and of the workload.')
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file and print a summary; by default the JSON goes to stdout.',
+        )
+
+    def handle(self, *args, **options):
+        profiles = [name for name in options['profiles'].split(',') if name]
+        unknown = set(profiles) - set(PROFILES)
+        if unknown:
+            raise CommandError('Unknown profiles: {}.'.format(', '.join(sorted(unknown))))
+
+        if options['users'] < 2 or options['readers'] + options['writers'] < 1:
+            raise CommandError('At least 2 users and one reader or writer are needed.')
+
+        results = OrderedDict((
+            ('revision', get_revision()),
+            ('created', timezone.now().isoformat()),
+            ('database', connection.vendor),
+            ('parameters', OrderedDict(
+                (name, options[name]) for name in ('users', 'messages', 'readers', 'writers', 'duration', 'seed')
+            )),
+            ('profiles', OrderedDict()),
+        ))
+
+        for name in profiles:
+            results['profiles'][name] = self._run_profile(PROFILES[name], options)
+
+        if options['output'] is None:
+            self.stdout.write(json.dumps(results, indent=2, separators=(',', ': ')))
+            return
+
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2, separators=(',', ': '))
+
+        self._print_summary(results)
+
+    def _run_profile(self, profile, options):
+        pragmas = settings.SQLITE_PRAGMAS if profile['pragmas'] is None else profile['pragmas']
+
+        # A file database: WAL and mmap do not apply to the in-memory one, and
+        # the journal mode persists in the file, so each profile gets its own.
+        directory = tempfile.mkdtemp()
+        test_settings = connection.settings_dict['TEST']
+        old_name, old_test_name = connection.settings_dict['NAME'], test_settings.get('NAME')
+        test_settings['NAME'] = os.path.join(directory, 'bench.sqlite3')
+
+        try:
+            with override_settings(SQLITE_PRAGMAS=pragmas):
+                connection.close()
+                connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+                cache.clear()
+                try:
+                    dataset = generate(options['users'], options['messages'], seed=options['seed'])
+                    applied = get_sqlite_pragmas(connection, REPORTED_PRAGMAS) if connection.vendor == 'sqlite' else {}
+                    connection.close()
+
+                    result = run_mixed_workload(
+                        dataset.user_ids,
+                        readers=options['readers'],
+                        writers=options['writers'],
+                        duration=options['duration'],
+                        close_connections=profile['close_connections'],
+                        seed=options['seed'],
+                    )
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+        finally:
+            test_settings['NAME'] = old_test_name
+            shutil.rmtree(directory, ignore_errors=True)
+
+        return OrderedDict((
+            ('pragmas', applied),
+            ('close_connections', profile['close_connections']),
+            ('writes', result['writes']),
+            ('reads', result['reads']),
+        ))
+
+    def _print_summary(self, results):
+        for name, profile in results['profiles'].items():
+            self.stdout.write('{}: {}'.format(name, ', '.join(
+                '{}={}'.format(pragma, value) for pragma, value in sorted(profile['pragmas'].items())
+            ) or 'default pragmas'))
+
+            for kind in ('writes', 'reads'):
+                summary = profile[kind]
+                if not summary['requests']:
+                    self.stdout.write('  {:<8} none, {errors} errors'.format(kind, **summary))
+                    continue
+
+                self.stdout.write(
+                    '  {:<8} {throughput:8.1f} ops/s   p50 {p50_ms:7.1f} ms   p99 {p99_ms:7.1f} ms   '
+                    '{errors} errors'.format(kind, **summary)
+                )
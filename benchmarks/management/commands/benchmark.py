@@ -0,0 +1,172 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import json
+import platform
+import subprocess
+from collections import OrderedDict
+from timeit import default_timer
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from benchmarks.datagen import generate
+from benchmarks.runner import SCENARIOS, run_scenario
+
+
+def parse_sizes(value):
+    """
+    Parse '100x1000,1000x20000' into [(100, 1000), (1000, 20000)]: users x messages.
+    """
+    try:
+        sizes = [tuple(int(part) for part in size.split('x')) for size in value.split(',')]
+    except ValueError:
+        sizes = None
+
+    if not sizes or any(len(size) != 2 or size[0] < 2 or size[1] < 0 for size in sizes):
+        raise CommandError('Sizes are given as USERSxMESSAGES[,USERSxMESSAGES...], at least 2 users each.')
+
+    return sizes
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.STDOUT
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate datasets of several sizes in throw-away test databases and measure latency '
+        'percentiles and throughput of the accounts and chat endpoints through the test client.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='100x1000,1000x20000',
+            help='Datasets as USERSxMESSAGES, comma separated.',
+        )
+        parser.add_argument(
+            '--scenarios',
+            default=','.join(SCENARIOS),
+            help='Comma separated subset of: {}.'.format(', '.join(SCENARIOS)),
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Timed requests per scenario and dataset.',
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=10,
+            help='Untimed requests per scenario before timing.',
+        )
+        parser.add_argument(
+            '--skew',
+            type=float,
+            default=1.1,
+            help='Zipf exponent of the conversation activity.',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the data generator and of the request mix.',
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file and print a summary; by default the JSON goes to stdout.',
+        )
+
+    def handle(self, *args, **options):
+        sizes = parse_sizes(options['sizes'])
+
+        scenarios = [name for name in options['scenarios'].split(',') if name]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError('Unknown scenarios: {}.'.format(', '.join(sorted(unknown))))
+
+        if options['requests'] < 1:
+            raise CommandError('At least one request per scenario is needed.')
+
+        results = OrderedDict((
+            ('revision', get_revision()),
+            ('created', timezone.now().isoformat()),
+            ('python', platform.python_version()),
+            ('django', django.get_version()),
+            ('database', connection.vendor),
+            ('parameters', OrderedDict(
+                (name, options[name]) for name in ('requests', 'warmup', 'skew', 'seed')
+            )),
+            ('datasets', []),
+        ))
+
+        debug = settings.DEBUG
+        settings.DEBUG = False
+        setup_test_environment()
+        try:
+            for users, messages in sizes:
+                results['datasets'].append(self._run_dataset(users, messages, scenarios, options))
+        finally:
+            teardown_test_environment()
+            settings.DEBUG = debug
+
+        if options['output'] is None:
+            self.stdout.write(json.dumps(results, indent=2, separators=(',', ': ')))
+            return
+
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2, separators=(',', ': '))
+
+        self._print_summary(results)
+
+    def _run_dataset(self, users, messages, scenarios, options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        cache.clear()
+        try:
+            start = default_timer()
+            dataset = generate(users, messages, skew=options['skew'], seed=options['seed'])
+            generated = default_timer() - start
+
+            return OrderedDict((
+                ('users', users),
+                ('messages', messages),
+                ('conversations', len(dataset.conversations)),
+                ('generate_seconds', generated),
+                ('scenarios', OrderedDict(
+                    (name, self._run_scenario(name, dataset, options)) for name in scenarios
+                )),
+            ))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _run_scenario(self, name, dataset, options):
+        try:
+            return run_scenario(
+                SCENARIOS[name], dataset, options['requests'],
+                warmup=options['warmup'], skew=options['skew'], seed=options['seed']
+            )
+        except AssertionError as e:
+            raise CommandError(e)
+
+    def _print_summary(self, results):
+        for dataset in results['datasets']:
+            self.stdout.write('{users} users, {messages} messages, {conversations} conversations:'.format(**dataset))
+
+            for name, summary in dataset['scenarios'].items():
+                self.stdout.write(
+                    '  {:<16} {throughput:8.1f} req/s   p50 {p50_ms:7.1f} ms   '
+                    'p90 {p90_ms:7.1f} ms   p99 {p99_ms:7.1f} ms'.format(name, **summary)
+                )
@@ -0,0 +1,218 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import math
+import random
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.contrib.auth.models import User
+from django.test import Client
+from django.urls import reverse
+
+from benchmarks.datagen import PASSWORD, ZipfSampler
+
+
+class Scenario(object):
+    """
+    One kind of request, timed from the client side.
+
+    `prepare` runs untimed before every request and returns the callable to
+    time, so setup such as a first registration step stays out of the numbers.
+    """
+    name = None
+    expected_status = 200
+
+    def __init__(self, dataset, rng, skew):
+        self.dataset = dataset
+        self.rng = rng
+        self.sample_conversation = ZipfSampler(len(dataset.conversations), skew, rng)
+
+    def prepare(self, index):
+        raise NotImplementedError
+
+    def pick_user(self):
+        """
+        Id of a conversation participant, busy users picked more often.
+        """
+        return self.rng.choice(self.dataset.conversations[self.sample_conversation()])
+
+    def pick_conversation(self):
+        """
+        Ids of a user and their peer, busy conversations picked more often.
+        """
+        user_id, peer_id = self.dataset.conversations[self.sample_conversation()]
+        if self.rng.random() < 0.5:
+            user_id, peer_id = peer_id, user_id
+
+        return user_id, peer_id
+
+    def client_for(self, user_id):
+        client = Client()
+        client.force_login(User.objects.get(pk=user_id))
+
+        return client
+
+
+class LoginScenario(Scenario):
+    name = 'login'
+
+    def prepare(self, index):
+        url = reverse('accounts:login')
+        data = {'username': self.dataset.usernames[self.pick_user()], 'password': PASSWORD}
+        client = Client()
+
+        return lambda: client.post(url, data)
+
+
+class RegisterScenario(Scenario):
+    name = 'register'
+    expected_status = 202
+
+    def prepare(self, index):
+        url = reverse('accounts:register')
+        data = {'username': 'bench_register_{}'.format(index), 'password': PASSWORD}
+        client = Client()
+
+        return lambda: client.post(url, data)
+
+
+class RegisterCompleteScenario(Scenario):
+    name = 'register_step_2'
+
+    def prepare(self, index):
+        client = Client()
+        response = client.post(
+            reverse('accounts:register'),
+            {'username': 'bench_register_complete_{}'.format(index), 'password': PASSWORD}
+        )
+
+        data = {
+            'ticket': response.json()['ticket'],
+            'birth_date': '2000-01-01',
+            'country': 'Poland',
+            'city': 'Warszawa',
+            'post_code': '00-001',
+            'telephone_number': '+48123456789',
+        }
+
+        url = reverse('accounts:register_step_2')
+
+        return lambda: client.post(url, data)
+
+
+class SendScenario(Scenario):
+    name = 'send'
+    expected_status = 201
+
+    def prepare(self, index):
+        user_id, peer_id = self.pick_conversation()
+        url = reverse('chat:messages')
+        data = {'receiver': peer_id, 'content': 'Benchmark reply {}.'.format(index)}
+        client = self.client_for(user_id)
+
+        return lambda: client.post(url, data)
+
+
+class UnreadCountScenario(Scenario):
+    name = 'unread_count'
+
+    def prepare(self, index):
+        url = reverse('chat:messages')
+        client = self.client_for(self.pick_user())
+
+        return lambda: client.get(url)
+
+
+class ConversationScenario(Scenario):
+    name = 'conversation'
+
+    def prepare(self, index):
+        user_id, peer_id = self.pick_conversation()
+        url = reverse('chat:list', args=(peer_id,))
+        client = self.client_for(user_id)
+
+        return lambda: client.get(url)
+
+
+class InboxScenario(Scenario):
+    name = 'inbox'
+
+    def prepare(self, index):
+        url = reverse('chat:conversations')
+        client = self.client_for(self.pick_user())
+
+        return lambda: client.get(url)
+
+
+class SearchScenario(Scenario):
+    name = 'search'
+
+    def prepare(self, index):
+        url = reverse('chat:search')
+        client = self.client_for(self.pick_user())
+
+        # Matches every generated message, the worst case for ranking.
+        return lambda: client.get(url, {'q': 'message'})
+
+
+SCENARIOS = OrderedDict((scenario.name, scenario) for scenario in (
+    LoginScenario,
+    RegisterScenario,
+    RegisterCompleteScenario,
+    SendScenario,
+    UnreadCountScenario,
+    ConversationScenario,
+    InboxScenario,
+    SearchScenario,
+))
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an ascending list.
+    """
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    return OrderedDict((
+        ('requests', len(latencies)),
+        ('throughput', len(latencies) / elapsed if elapsed else 0.0),
+        ('mean_ms', sum(latencies) / len(latencies) * 1000),
+        ('p50_ms', percentile(latencies, 50) * 1000),
+        ('p90_ms', percentile(latencies, 90) * 1000),
+        ('p99_ms', percentile(latencies, 99) * 1000),
+        ('max_ms', latencies[-1] * 1000),
+    ))
+
+
+def run_scenario(scenario_class, dataset, requests, warmup=0, skew=1.1, seed=0):
+    """
+    Time `requests` sequential requests of a scenario, after `warmup` untimed ones.
+
+    Throughput counts the timed requests only, untimed preparation excluded.
+    """
+    scenario = scenario_class(dataset, random.Random(seed), skew)
+
+    for index in range(warmup):
+        scenario.prepare('warmup_{}'.format(index))()
+
+    latencies = []
+    for index in range(requests):
+        request = scenario.prepare(index)
+
+        start = default_timer()
+        response = request()
+        latencies.append(default_timer() - start)
+
+        if response.status_code != scenario.expected_status:
+            raise AssertionError('{} answered {}, expected {}.'.format(
+                scenario.name, response.status_code, scenario.expected_status
+            ))
+
+    return summarize(latencies, sum(latencies))
@@ -0,0 +1,81 @@
+import random
+from timeit import default_timer
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from accounts.models import UserProfile
+from benchmarks.concurrency import Worker
+from benchmarks.datagen import ZipfSampler, generate
+from benchmarks.runner import SCENARIOS, percentile, run_scenario
+from chat.models import Message
+
+
+class DataGeneratorTestCase(TestCase):
+    def test_generate(self):
+        dataset = generate(10, 200, seed=1)
+
+        self.assertEqual(10, User.objects.count())
+        self.assertEqual(10, UserProfile.objects.count())
+        self.assertEqual(200, Message.objects.count())
+        self.assertEqual(len(dataset.conversations), len(set(dataset.conversations)))
+
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+    def test_generate_is_reproducible(self):
+        generate(10, 100, seed=1)
+        first = list(Message.objects.order_by('id').values_list('sender__username', 'receiver__username'))
+
+        Message.objects.all().delete()
+        User.objects.all().delete()
+
+        generate(10, 100, seed=1)
+        second = list(Message.objects.order_by('id').values_list('sender__username', 'receiver__username'))
+
+        self.assertEqual(first, second)
+
+    def test_zipf_sampler_is_skewed(self):
+        sample = ZipfSampler(50, 1.1, random.Random(0))
+        draws = [sample() for _ in range(2000)]
+
+        self.assertTrue(all(0 <= draw < 50 for draw in draws))
+        self.assertGreater(draws.count(0), draws.count(49) * 10)
+
+
+class RunnerTestCase(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(1, percentile([1], 99))
+
+    def test_scenarios(self):
+        dataset = generate(5, 50)
+
+        for name, scenario in SCENARIOS.items():
+            summary = run_scenario(scenario, dataset, 3, warmup=1)
+
+            self.assertEqual(3, summary['requests'], name)
+            self.assertLessEqual(summary['p50_ms'], summary['max_ms'], name)
+
+
+class ConcurrencyTestCase(TestCase):
+    def test_worker(self):
+        # Run in this thread: other threads do not see the in-memory test database.
+        calls = []
+
+        def operation(rng):
+            calls.append(rng.random())
+            if len(calls) == 2:
+                raise OperationalError('database is locked')
+
+        worker = Worker(operation, default_timer() + 0.05, seed=0, close_connection=True)
+        worker.run()
+
+        self.assertGreater(len(calls), 2)
+        self.assertEqual(1, worker.errors)
+        self.assertEqual(len(calls) - 1, len(worker.latencies))
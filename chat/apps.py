@@ -1,7 +1,13 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.core import checks
 
 
 class ChatConfig(AppConfig):
     name = 'chat'
+
+    def ready(self):
+        from chat.notifier import check_job_notifier
+
+        checks.register(check_job_notifier)
@@ -0,0 +1,103 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from drf_samples.instrumentation import register_stats
+
+UNREAD_COUNT_KEY = 'chat:unread:{}:{}'
+UNREAD_GENERATION_KEY = 'chat:unread:{}:generation'
+
+
+class CacheStats(object):
+    """
+    Hit/miss counters of a cache, local to the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def snapshot(self):
+        with self._lock:
+            total = self.hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else 0.0,
+            }
+
+
+unread_count_stats = CacheStats()
+register_stats('unread_cache', unread_count_stats.snapshot)
+
+
+def get_unread_count(user_id, load):
+    """
+    Return the cached unread count of `user_id`, calling `load()` on a miss.
+
+    Counts are cached per generation of the user, which writers end when they
+    commit. A count loaded before a commit and stored after it goes to the
+    ended generation, where no later read looks.
+    """
+    generation = _get_generation(user_id)
+    key = UNREAD_COUNT_KEY.format(user_id, generation)
+
+    unread = cache.get(key)
+    if unread is not None:
+        unread_count_stats.hit()
+        return unread
+
+    unread_count_stats.miss()
+    unread = load()
+
+    # Ended while starting, by a commit the load may have missed.
+    if generation is not None:
+        cache.add(key, unread, settings.UNREAD_COUNT_CACHE_TIMEOUT)
+
+    return unread
+
+
+def _get_generation(user_id):
+    key = UNREAD_GENERATION_KEY.format(user_id)
+
+    generation = cache.get(key)
+    if generation is None:
+        # Random, so an ended generation is not started again.
+        generation = random.getrandbits(63)
+        if not cache.add(key, generation, settings.UNREAD_COUNT_CACHE_TIMEOUT):
+            generation = cache.get(key)
+
+    return generation
+
+
+def forget_unread_count(user_id):
+    """
+    End the cached unread count of `user_id`; call after the write has committed.
+
+    The next read loads the committed count. Storing it from here instead could
+    let an overlapping commit overwrite it with an older count.
+    """
+    cache.delete(UNREAD_GENERATION_KEY.format(user_id))
+
+
+def forget_unread_counts(user_ids):
+    cache.delete_many([UNREAD_GENERATION_KEY.format(user_id) for user_id in user_ids])
@@ -0,0 +1,104 @@
+# encoding: utf-8
+"""
+Generators encoding exported messages as JSONL or CSV bytes, optionally gzipped.
+
+Each stage consumes its input lazily, so an export holds one chunk of
+messages in memory whatever its size.
+"""
+from __future__ import unicode_literals
+
+import csv
+import json
+import zlib
+from collections import OrderedDict
+
+from django.utils import six
+from rest_framework import serializers
+
+EXPORT_FIELDS = ('id', 'sender_id', 'receiver_id', 'content', 'datetime')
+
+CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def iter_records(rows):
+    format_datetime = serializers.DateTimeField().to_representation
+
+    for row in rows:
+        yield OrderedDict((
+            ('id', row.id),
+            ('sender_id', row.sender_id),
+            ('receiver_id', row.receiver_id),
+            ('content', row.content),
+            ('datetime', format_datetime(row.datetime)),
+        ))
+
+
+def render_jsonl(rows):
+    for record in iter_records(rows):
+        yield json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+class _Line(object):
+    """
+    File-like target of `csv.writer` keeping only the last line written.
+    """
+
+    def write(self, value):
+        self.value = value
+
+
+def render_csv(rows):
+    line = _Line()
+    writer = csv.writer(line)
+
+    def encode(values):
+        if six.PY2:
+            values = [six.text_type(value).encode('utf-8') for value in values]
+
+        writer.writerow(values)
+        value = line.value
+
+        return value if isinstance(value, bytes) else value.encode('utf-8')
+
+    yield encode(EXPORT_FIELDS)
+    for record in iter_records(rows):
+        yield encode(record.values())
+
+
+RENDERERS = OrderedDict((
+    ('jsonl', render_jsonl),
+    ('csv', render_csv),
+))
+
+
+def gzip_chunks(chunks):
+    """
+    Compress `chunks` of bytes into a gzip stream on the fly.
+    """
+    # 16 + MAX_WBITS: gzip header and trailer instead of a bare zlib stream.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export(rows, export_format, compress=False):
+    """
+    Bytes of `rows` encoded as `export_format`, one of `RENDERERS`.
+    """
+    chunks = RENDERERS[export_format](rows)
+    if compress:
+        chunks = gzip_chunks(chunks)
+
+    return chunks
+
+
+def get_filename(export_format, compress=False):
+    return 'messages.{}{}'.format(export_format, '.gz' if compress else '')
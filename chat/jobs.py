@@ -0,0 +1,48 @@
+# encoding: utf-8
+"""
+Handlers of the background jobs queued with `Job.objects.enqueue`.
+
+A handler takes the decoded payload of its job. Jobs run at least once, a
+retried job may have done part of its work before, so handlers must be
+idempotent; waking a client twice is harmless, a second insert is not.
+"""
+from __future__ import unicode_literals
+
+from chat.notifier import get_notifier
+
+NOTIFY = 'chat.notify'
+
+HANDLERS = {}
+
+
+def handler(name):
+    """
+    Register the decorated function as the handler of the jobs named `name`.
+    """
+    def register(func):
+        HANDLERS[name] = func
+        return func
+
+    return register
+
+
+def run(name, payload):
+    try:
+        func = HANDLERS[name]
+    except KeyError:
+        raise LookupError('No handler for jobs named {!r}.'.format(name))
+
+    func(payload)
+
+
+@handler(NOTIFY)
+def notify(payload):
+    """
+    Wake the long polls of `payload['user_ids']`.
+
+    Run by a worker process, this needs a notifier reaching the web processes,
+    e.g. `UnixSocketNotifier`.
+    """
+    notifier = get_notifier()
+    for user_id in payload['user_ids']:
+        notifier.publish(user_id)
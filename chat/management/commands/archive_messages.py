@@ -0,0 +1,76 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat.models import ArchivedMessage, Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Move read messages older than the retention period to the archive and delete archived '
+        'messages past the purge period, a chunk per transaction. Interrupted runs resume where they stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+            help='Archive messages created more than this many days ago.',
+        )
+        parser.add_argument(
+            '--purge-days',
+            type=int,
+            default=settings.CHAT_PURGE_AFTER_DAYS,
+            help='Delete archived messages created more than this many days ago; nothing is deleted by default.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=settings.CHAT_ARCHIVE_CHUNK_SIZE,
+            help='Messages moved or deleted per transaction.',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to sleep between chunks, leaving the database to other writers.',
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+
+        now = timezone.now()
+
+        archived = self._run(
+            Message.objects.archive, now - timedelta(days=options['days']), options
+        )
+        self.stdout.write(self.style.SUCCESS('Archived {} message(s).'.format(archived)))
+
+        if options['purge_days'] is not None:
+            purged = self._run(
+                ArchivedMessage.objects.purge, now - timedelta(days=options['purge_days']), options
+            )
+            self.stdout.write(self.style.SUCCESS('Purged {} archived message(s).'.format(purged)))
+
+    def _run(self, step, before, options):
+        """
+        Call `step(before, chunk_size)` until it has nothing left to do.
+        """
+        total = 0
+        while True:
+            done = step(before, options['chunk_size'])
+            total += done
+            if done < options['chunk_size']:
+                return total
+
+            self.stdout.write('{} so far'.format(total))
+            if options['pause']:
+                time.sleep(options['pause'])
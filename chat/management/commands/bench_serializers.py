@@ -0,0 +1,99 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import timeit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.renderers import JSONRenderer
+
+from chat.models import Message, Sequence, get_conversation_key
+from chat.serializers import MessageFastSerializer, MessageUserDetailsSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the model and the values_list serializers of conversation listings. '
+        'Runs against a throw-away test database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=5000,
+            help='Messages in the benchmarked conversation.',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Timed runs per step; the best and the median are reported.',
+        )
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self._run(options['messages'], options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _run(self, count, repeat):
+        sender = User.objects.create_user('bench_sender', password='bench_sender')
+        receiver = User.objects.create_user('bench_receiver', password='bench_receiver')
+        self._create_messages(sender, receiver, count)
+
+        renderer = JSONRenderer()
+        conversation = Message.objects.get_conversation(receiver, sender)
+        watermarks = Message.objects.get_read_watermarks(receiver, sender)
+
+        def model_serializer():
+            messages = list(conversation.all())
+            Message.objects.annotate_read_state(messages, watermarks)
+            return MessageUserDetailsSerializer(messages, many=True).data
+
+        def fast_serializer():
+            rows = list(Message.objects.as_rows(conversation))
+            return MessageFastSerializer(rows, watermarks=watermarks).data
+
+        data = model_serializer()
+        if renderer.render(data) != renderer.render(fast_serializer()):
+            raise CommandError('The serializers disagree.')
+
+        self.stdout.write('{} messages, {} runs:'.format(count, repeat))
+
+        results = {}
+        for name, func in (
+            ('model', model_serializer),
+            ('values_list', fast_serializer),
+            # Shared by both paths, for scale.
+            ('render', lambda: renderer.render(data)),
+        ):
+            timings = sorted(timeit.repeat(func, number=1, repeat=repeat))
+            results[name] = timings[0]
+
+            self.stdout.write('  {:<12} best {:8.1f} ms   median {:8.1f} ms'.format(
+                name, timings[0] * 1000, timings[len(timings) // 2] * 1000
+            ))
+
+        self.stdout.write(self.style.SUCCESS('Fetch + serialize with values_list is {:.1f}x faster.'.format(
+            results['model'] / results['values_list']
+        )))
+
+    def _create_messages(self, sender, receiver, count):
+        conversation_key = get_conversation_key(sender.pk, receiver.pk)
+        first_token = Sequence.objects.next_value(Message.SYNC_SEQUENCE, count) - count + 1
+
+        messages = [
+            Message(
+                sender=sender,
+                receiver=receiver,
+                content='Message {} of the benchmark conversation.'.format(i),
+                conversation_key=conversation_key,
+                sync_token=first_token + i,
+            )
+            for i in range(count)
+        ]
+        Message.objects.bulk_create(messages, batch_size=500)
@@ -0,0 +1,79 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import io
+import sys
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import export
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Write all messages of a user, or of one of their conversations, as JSONL or CSV. "
+        "Read state is left unchanged."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User whose messages are exported.')
+        parser.add_argument(
+            '--peer',
+            help='Username of the other participant, to export a single conversation.',
+        )
+        parser.add_argument(
+            '--format',
+            choices=list(export.RENDERERS),
+            default='jsonl',
+            help='Output format.',
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            dest='gzip',
+            default=False,
+            help='Compress the output with gzip.',
+        )
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='File to write, standard output by default.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=settings.CHAT_STREAM_CHUNK_SIZE,
+            help='Messages fetched per query.',
+        )
+
+    def handle(self, *args, **options):
+        user = self._get_user(options['username'])
+        peer = self._get_user(options['peer']) if options['peer'] else None
+
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+
+        rows = Message.objects.iter_export(user, peer, options['chunk_size'])
+        chunks = export.export(rows, options['format'], options['gzip'])
+
+        if options['output'] == '-':
+            # Bytes go to the underlying stream, not the text wrapper.
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+            self._write(output, chunks)
+        else:
+            with io.open(options['output'], 'wb') as output:
+                self._write(output, chunks)
+
+    def _get_user(self, username):
+        try:
+            return User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError('User {} does not exist.'.format(username))
+
+    def _write(self, output, chunks):
+        for chunk in chunks:
+            output.write(chunk)
+        output.flush()
@@ -0,0 +1,30 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Job
+
+
+class Command(BaseCommand):
+    help = (
+        'Report the background job queue: pending, due and failed jobs, and the lag, the seconds '
+        'the oldest due job has been waiting for a worker.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-lag',
+            type=float,
+            default=None,
+            help='Exit with an error when the lag exceeds this many seconds, e.g. for a health check.',
+        )
+
+    def handle(self, *args, **options):
+        stats = Job.objects.get_stats()
+
+        for name, value in stats.items():
+            self.stdout.write('{}: {}'.format(name, round(value, 3) if name == 'lag' else value))
+
+        if options['max_lag'] is not None and stats['lag'] > options['max_lag']:
+            raise CommandError('Job queue lag {:.1f}s exceeds {}s.'.format(stats['lag'], options['max_lag']))
@@ -0,0 +1,156 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from chat import cache, sharding
+from chat.models import ArchivedMessage, Message, Sequence, UnreadCounter, UserConversation
+
+
+class Command(BaseCommand):
+    help = (
+        'Move conversations to the shard `CHAT_SHARDS` assigns them, after shards were added, removed '
+        'or reordered. Rows are copied in chunks and then deleted from the old shard, so an interrupted '
+        'run resumes where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            action='append',
+            default=[],
+            help='Also drain this database alias, e.g. a shard removed from CHAT_SHARDS; repeatable.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=settings.CHAT_ARCHIVE_CHUNK_SIZE,
+            help='Messages copied per transaction.',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to sleep between chunks, leaving the databases to other writers.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only report how many conversations would move.',
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+
+        unknown = set(options['source']) - set(settings.DATABASES)
+        if unknown:
+            raise CommandError('Unknown database aliases: {}.'.format(', '.join(sorted(unknown))))
+
+        shards = sharding.get_shards()
+        sources = shards + [alias for alias in options['source'] if alias not in shards]
+
+        if not options['dry_run']:
+            # Ids keep unique only if new ones come after those of the moved messages.
+            Sequence.objects.advance(Message.ID_SEQUENCE, Message.objects.get_max_id(sources))
+
+        moved = 0
+        for source in sources:
+            misplaced = [key for key in self._get_conversation_keys(source) if sharding.get_shard(key) != source]
+            self.stdout.write('{}: {} conversation(s) to move'.format(source, len(misplaced)))
+
+            if options['dry_run']:
+                continue
+
+            for conversation_key in misplaced:
+                target = sharding.get_shard(conversation_key)
+                for model in (Message, ArchivedMessage):
+                    self._move_rows(model, conversation_key, source, target, options)
+                self._move_conversation_state(conversation_key, source, target)
+                moved += 1
+
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS('Moved {} conversation(s).'.format(moved)))
+
+    def _get_conversation_keys(self, alias):
+        keys = set()
+        for model in (Message, ArchivedMessage, UserConversation):
+            keys.update(sharding.using(model.objects, alias).order_by().values_list(
+                'conversation_key', flat=True
+            ).distinct())
+
+        return sorted(keys)
+
+    def _move_rows(self, model, conversation_key, source, target, options):
+        """
+        Copy the rows of `model` in the conversation from `source` to `target`
+        a chunk at a time, deleting each chunk from `source` once copied.
+        """
+        rows = sharding.using(model.objects, source).filter(conversation_key=conversation_key).order_by('id')
+        copied = sharding.using(model.objects, target)
+
+        while True:
+            chunk = list(rows[:options['chunk_size']])
+            if not chunk:
+                return
+
+            ids = [row.id for row in chunk]
+            # Left by an interrupted run.
+            existing = set(copied.filter(pk__in=ids).values_list('id', flat=True))
+
+            with transaction.atomic(using=target):
+                copied.bulk_create(row for row in chunk if row.id not in existing)
+            with transaction.atomic(using=source):
+                rows.filter(pk__in=ids).delete()
+
+            if options['pause']:
+                time.sleep(options['pause'])
+
+    def _move_conversation_state(self, conversation_key, source, target):
+        """
+        Move the `UserConversation` rows of the conversation, merged into those
+        created on `target` by messages sent since `CHAT_SHARDS` changed. The
+        merged rows count their unread messages again against the newer
+        watermark and correct `UnreadCounter` by the difference.
+        """
+        states = sharding.using(UserConversation.objects, source).filter(conversation_key=conversation_key)
+        conversations = sharding.using(UserConversation.objects, target)
+
+        with transaction.atomic(using=target):
+            for state in states:
+                current = conversations.filter(user_id=state.user_id, conversation_key=conversation_key).first()
+
+                if current is None:
+                    state.pk = state.last_message_id = None
+                    conversations.bulk_create([state])
+                    continue
+
+                counted = current.unread + state.unread
+                if state.last_read_id > current.last_read_id:
+                    current.last_read_id, current.last_read_at = state.last_read_id, state.last_read_at
+                current.sync_token = max(current.sync_token, state.sync_token)
+                # Either watermark may cover messages the other side still counted.
+                current.unread = sharding.using(Message.objects, target).filter(
+                    receiver_id=state.user_id, conversation_key=conversation_key, id__gt=current.last_read_id
+                ).count()
+                current.save(using=target)
+
+                if current.unread != counted:
+                    UnreadCounter.objects.filter(pk=state.user_id).update(
+                        unread=F('unread') + current.unread - counted
+                    )
+                    transaction.on_commit(
+                        lambda user_id=state.user_id: cache.forget_unread_count(user_id), using=target
+                    )
+
+            Message.objects.refresh_last_messages([conversation_key])
+
+        with transaction.atomic(using=source):
+            states.delete()
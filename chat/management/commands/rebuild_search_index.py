@@ -0,0 +1,71 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections, transaction
+
+from chat import sharding
+from chat.models import Message
+from chat.search import FTS_TABLE
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text index of message content on every shard, or only verify it with --verify.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Check that the index matches the messages without changing it.',
+        )
+        parser.add_argument(
+            '--optimize',
+            action='store_true',
+            dest='optimize',
+            default=False,
+            help='Merge the index into a single segment after rebuilding it, e.g. after a bulk import.',
+        )
+
+    def handle(self, *args, **options):
+        shards = sharding.get_shards()
+
+        for alias in shards:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError('The full-text index needs SQLite FTS5, {} is searched without it.'.format(
+                    connections[alias].vendor
+                ))
+
+        if options['verify']:
+            for alias in shards:
+                try:
+                    self._command(alias, "'integrity-check', 1", ', rank')
+                except DatabaseError:
+                    raise CommandError('The full-text index of {} is out of sync, rebuild it.'.format(alias))
+
+            self.stdout.write(self.style.SUCCESS('The full-text index is in sync.'))
+            return
+
+        indexed = 0
+        for alias in shards:
+            with transaction.atomic(using=alias):
+                self._command(alias, "'rebuild'")
+                if options['optimize']:
+                    self._command(alias, "'optimize'")
+
+            indexed += sharding.using(Message.objects, alias).count()
+
+        self.stdout.write(self.style.SUCCESS('Indexed {} message(s).'.format(indexed)))
+
+    def _command(self, alias, values, columns=''):
+        """
+        Run an FTS5 special command on the shard `alias`, an insert into the column named after the table.
+        """
+        connection = connections[alias]
+        fts = connection.ops.quote_name(FTS_TABLE)
+
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO {fts}({fts}{columns}) VALUES ({values})'.format(
+                fts=fts, columns=columns, values=values
+            ))
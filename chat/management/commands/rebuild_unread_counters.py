@@ -0,0 +1,181 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max
+
+from chat import cache, sharding
+from chat.models import Message, UnreadCounter, UserConversation
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the unread counters and the last messages of the inbox from messages and read watermarks, '
+        'or only verify them with --verify.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Report counters that disagree with the messages without changing them.',
+        )
+
+    def handle(self, *args, **options):
+        shards = sharding.get_shards()
+
+        with transaction.atomic():
+            conversations = dict((alias, self._count_unread(alias)) for alias in shards)
+
+            # A user's conversations may be on any shard.
+            users = defaultdict(int)
+            for alias in shards:
+                for (user_id, conversation_key), (peer_id, unread) in conversations[alias].items():
+                    users[user_id] += unread
+
+            mismatches = self._sync_user_counters(users, options['verify'])
+            for alias in shards:
+                with sharding.atomic(alias):
+                    mismatches += self._sync_conversation_counters(alias, conversations[alias], options['verify'])
+                    mismatches += self._sync_last_messages(alias, options['verify'])
+
+        if options['verify'] and mismatches:
+            raise CommandError('{} unread counter(s) out of sync.'.format(mismatches))
+
+        if options['verify']:
+            self.stdout.write(self.style.SUCCESS('Unread counters are in sync.'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Fixed {} unread counter(s).'.format(mismatches)))
+
+    def _count_unread(self, alias):
+        """
+        Messages of the shard `alias` past the receiver's read watermark, keyed
+        by (receiver id, conversation key).
+        """
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        sql = (
+            'SELECT m.receiver_id, m.conversation_key, m.sender_id, COUNT(*) '
+            'FROM {message} m '
+            'LEFT JOIN {conversation} c '
+            'ON c.user_id = m.receiver_id AND c.conversation_key = m.conversation_key '
+            'WHERE m.id > COALESCE(c.last_read_id, 0) '
+            'GROUP BY m.receiver_id, m.conversation_key, m.sender_id'
+        ).format(
+            message=qn(Message._meta.db_table),
+            conversation=qn(UserConversation._meta.db_table),
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+            return dict(
+                ((receiver_id, conversation_key), (sender_id, unread))
+                for receiver_id, conversation_key, sender_id, unread in cursor.fetchall()
+            )
+
+    def _sync_user_counters(self, expected, verify):
+        actual = dict(UnreadCounter.objects.values_list('user_id', 'unread'))
+
+        mismatches = 0
+        for user_id in set(expected) | set(actual):
+            unread = expected.get(user_id, 0)
+            if actual.get(user_id, 0) == unread:
+                continue
+
+            mismatches += 1
+            self.stdout.write('user {}: counter {}, messages {}'.format(
+                user_id, actual.get(user_id, 0), unread
+            ))
+
+            if not verify:
+                UnreadCounter.objects.update_or_create(user_id=user_id, defaults={'unread': unread})
+                transaction.on_commit(lambda user_id=user_id: cache.forget_unread_count(user_id))
+
+        return mismatches
+
+    def _sync_conversation_counters(self, alias, expected, verify):
+        conversations = sharding.using(UserConversation.objects, alias)
+        actual = dict(
+            ((user_id, conversation_key), unread)
+            for user_id, conversation_key, unread in conversations.values_list(
+                'user_id', 'conversation_key', 'unread'
+            )
+        )
+
+        mismatches = 0
+        for key in set(expected) | set(actual):
+            user_id, conversation_key = key
+            peer_id, unread = expected.get(key, (None, 0))
+            if actual.get(key, 0) == unread:
+                continue
+
+            mismatches += 1
+            self.stdout.write('user {} conversation {}: counter {}, messages {}'.format(
+                user_id, conversation_key, actual.get(key, 0), unread
+            ))
+
+            if verify:
+                continue
+
+            if key in actual:
+                conversations.filter(
+                    user_id=user_id, conversation_key=conversation_key
+                ).update(unread=unread)
+            else:
+                conversations.create(
+                    user_id=user_id, peer_id=peer_id,
+                    conversation_key=conversation_key, unread=unread
+                )
+
+        return mismatches
+
+    def _sync_last_messages(self, alias, verify):
+        conversations = sharding.using(UserConversation.objects, alias)
+        expected = dict(
+            sharding.using(Message.objects, alias).order_by().values('conversation_key').annotate(
+                last_message_id=Max('id')
+            ).values_list('conversation_key', 'last_message_id')
+        )
+        actual = dict(
+            ((user_id, conversation_key), last_message_id)
+            for user_id, conversation_key, last_message_id in conversations.values_list(
+                'user_id', 'conversation_key', 'last_message_id'
+            )
+        )
+
+        missing = []
+        stale = set()
+        for conversation_key, last_message_id in expected.items():
+            user_ids = [int(user_id) for user_id in conversation_key.split(':')]
+            for user_id, peer_id in set(zip(user_ids, reversed(user_ids))):
+                key = (user_id, conversation_key)
+                if key not in actual:
+                    missing.append((user_id, peer_id, conversation_key))
+                elif actual[key] != last_message_id:
+                    stale.add(conversation_key)
+
+        for (user_id, conversation_key), last_message_id in actual.items():
+            if last_message_id is not None and conversation_key not in expected:
+                stale.add(conversation_key)
+
+        for user_id, peer_id, conversation_key in missing:
+            self.stdout.write('user {} conversation {}: missing'.format(user_id, conversation_key))
+        for conversation_key in stale:
+            self.stdout.write('conversation {}: stale last message'.format(conversation_key))
+
+        if not verify:
+            conversations.bulk_create(
+                UserConversation(user_id=user_id, peer_id=peer_id, conversation_key=conversation_key)
+                for user_id, peer_id, conversation_key in missing
+            )
+            conversation_keys = list(stale | set(conversation_key for _, _, conversation_key in missing))
+            for start in range(0, len(conversation_keys), 500):
+                Message.objects.refresh_last_messages(conversation_keys[start:start + 500])
+
+        return len(missing) + len(stale)
@@ -0,0 +1,103 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from chat.workers import Worker
+
+
+def _work(batch_size, poll_interval):
+    """
+    Run jobs in this process until it gets SIGTERM, finishing the current job first.
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    Worker(batch_size=batch_size).run(poll_interval, should_stop=lambda: bool(stopping))
+
+
+def _work_in_child(batch_size, poll_interval):
+    # Ctrl-C reaches the whole process group; the parent stops the workers with SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _work(batch_size, poll_interval)
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the queued background jobs, see `chat.jobs`, in worker processes until stopped. '
+        'Workers stop after their current job on SIGTERM or Ctrl-C.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=1,
+            help='Worker processes; with 1 the jobs run in this process.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.CHAT_JOB_BATCH_SIZE,
+            help='Jobs claimed at a time by a worker.',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.CHAT_JOB_POLL_INTERVAL,
+            help='Seconds an idle worker waits before looking for jobs again.',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Run the jobs due now in this process, then exit.',
+        )
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError('--processes must be positive.')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        if options['once']:
+            worker = Worker(batch_size=options['batch_size'])
+            ran = total = worker.run_once()
+            while ran:
+                ran = worker.run_once()
+                total += ran
+
+            self.stdout.write(self.style.SUCCESS('Ran {} job(s).'.format(total)))
+            return
+
+        if options['processes'] == 1:
+            try:
+                _work(options['batch_size'], options['poll_interval'])
+            except KeyboardInterrupt:
+                pass
+            return
+
+        # Forked processes must not share the connections of this one.
+        connections.close_all()
+
+        workers = [
+            multiprocessing.Process(target=_work_in_child, args=(options['batch_size'], options['poll_interval']))
+            for _ in range(options['processes'])
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def backfill_conversation_key(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    db_alias = schema_editor.connection.alias
+
+    pairs = Message.objects.using(db_alias).values_list('sender_id', 'receiver_id').distinct()
+    for sender_id, receiver_id in pairs.iterator():
+        Message.objects.using(db_alias).filter(sender_id=sender_id, receiver_id=receiver_id).update(
+            conversation_key='{}:{}'.format(*sorted((sender_id, receiver_id)))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=41),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_conversation_key, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('conversation_key', 'datetime')]),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 12:30
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_unread_counters(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    UnreadCounter = apps.get_model('chat', 'UnreadCounter')
+    UserConversation = apps.get_model('chat', 'UserConversation')
+    db_alias = schema_editor.connection.alias
+
+    unread = Message.objects.using(db_alias).filter(is_new=True)
+
+    UnreadCounter.objects.using(db_alias).bulk_create(
+        UnreadCounter(user_id=row['receiver_id'], unread=row['unread'])
+        for row in unread.values('receiver_id').annotate(unread=models.Count('id')).order_by()
+    )
+    UserConversation.objects.using(db_alias).bulk_create(
+        UserConversation(
+            user_id=row['receiver_id'],
+            peer_id=row['sender_id'],
+            conversation_key=row['conversation_key'],
+            unread=row['unread']
+        )
+        for row in unread.values('receiver_id', 'sender_id', 'conversation_key').annotate(
+            unread=models.Count('id')
+        ).order_by()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserConversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation_key', models.CharField(max_length=41)),
+                ('unread', models.IntegerField(default=0)),
+                ('peer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='message',
+            options={'get_latest_by': 'datetime', 'ordering': ['-datetime']},
+        ),
+        migrations.AlterUniqueTogether(
+            name='userconversation',
+            unique_together=set([('user', 'conversation_key')]),
+        ),
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
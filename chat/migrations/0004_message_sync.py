@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_sync_fields(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    Sequence = apps.get_model('chat', 'Sequence')
+    db_alias = schema_editor.connection.alias
+
+    # `datetime` only moves on save(), never on the bulk read-state updates,
+    # so it is the best available creation time for existing rows.
+    Message.objects.using(db_alias).update(
+        created_at=models.F('datetime'),
+        sync_token=models.F('id')
+    )
+
+    last_id = Message.objects.using(db_alias).aggregate(last_id=models.Max('id'))['last_id']
+    Sequence.objects.using(db_alias).create(name='message_sync', value=last_id or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_unread_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sequence',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sync_token',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_sync_fields, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('conversation_key', 'datetime'), ('conversation_key', 'sync_token')]),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 12:40
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def is_new_to_watermarks(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    UnreadCounter = apps.get_model('chat', 'UnreadCounter')
+    UserConversation = apps.get_model('chat', 'UserConversation')
+    db_alias = schema_editor.connection.alias
+
+    # Mark-read always covered everything fetched so far, so the newest read
+    # message of a conversation is where the receiver's watermark stands.
+    groups = Message.objects.using(db_alias).values('receiver_id', 'sender_id', 'conversation_key').annotate(
+        last_read_id=models.Max(models.Case(
+            models.When(is_new=False, then='id'),
+            output_field=models.IntegerField()
+        ))
+    ).order_by()
+
+    totals = defaultdict(int)
+    for group in groups.iterator():
+        last_read_id = group['last_read_id'] or 0
+        unread = Message.objects.using(db_alias).filter(
+            receiver_id=group['receiver_id'],
+            conversation_key=group['conversation_key'],
+            id__gt=last_read_id
+        ).count()
+
+        UserConversation.objects.using(db_alias).update_or_create(
+            user_id=group['receiver_id'],
+            conversation_key=group['conversation_key'],
+            defaults={
+                'peer_id': group['sender_id'],
+                'last_read_id': last_read_id,
+                'unread': unread,
+            }
+        )
+        totals[group['receiver_id']] += unread
+
+    UnreadCounter.objects.using(db_alias).update(unread=0)
+    for user_id, unread in totals.items():
+        UnreadCounter.objects.using(db_alias).update_or_create(user_id=user_id, defaults={'unread': unread})
+
+
+def watermarks_to_is_new(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    UserConversation = apps.get_model('chat', 'UserConversation')
+    db_alias = schema_editor.connection.alias
+
+    for conversation in UserConversation.objects.using(db_alias).filter(last_read_id__gt=0).iterator():
+        Message.objects.using(db_alias).filter(
+            receiver_id=conversation.user_id,
+            conversation_key=conversation.conversation_key,
+            id__lte=conversation.last_read_id
+        ).update(is_new=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_receiver_sync_token_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userconversation',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userconversation',
+            name='last_read_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userconversation',
+            name='sync_token',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('conversation_key', 'sync_token'), ('conversation_key', 'datetime'), ('conversation_key', 'id'), ('receiver', 'sync_token')]),
+        ),
+        migrations.RunPython(is_new_to_watermarks, watermarks_to_is_new),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_new',
+        ),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 13:07
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_last_messages(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    UserConversation = apps.get_model('chat', 'UserConversation')
+    db_alias = schema_editor.connection.alias
+
+    # Only receivers had a row so far, add the senders'.
+    existing = set(UserConversation.objects.using(db_alias).values_list('user_id', 'conversation_key'))
+    pairs = Message.objects.using(db_alias).values_list('sender_id', 'receiver_id', 'conversation_key').distinct().order_by()
+
+    missing = {}
+    for sender_id, receiver_id, conversation_key in pairs.iterator():
+        for user_id, peer_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+            if (user_id, conversation_key) not in existing:
+                missing[user_id, conversation_key] = peer_id
+
+    UserConversation.objects.using(db_alias).bulk_create(
+        UserConversation(user_id=user_id, peer_id=peer_id, conversation_key=conversation_key)
+        for (user_id, conversation_key), peer_id in missing.items()
+    )
+
+    qn = schema_editor.connection.ops.quote_name
+    tables = {
+        'message': qn(Message._meta.db_table),
+        'conversation': qn(UserConversation._meta.db_table),
+        'key': qn('conversation_key'),
+        'id': qn('id'),
+    }
+    last_message = (
+        '(SELECT m.{column} FROM {message} m '
+        'WHERE m.{key} = {conversation}.{key} '
+        'ORDER BY m.{id} DESC LIMIT 1)'
+    )
+    schema_editor.execute('UPDATE {conversation} SET last_message_id = {id}, last_message_at = {datetime}'.format(
+        conversation=qn(UserConversation._meta.db_table),
+        id=last_message.format(column=qn('id'), **tables),
+        datetime=last_message.format(column=qn('datetime'), **tables),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0006_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userconversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.Message'),
+        ),
+        migrations.AddField(
+            model_name='userconversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='userconversation',
+            index_together=set([('user', 'last_message_at')]),
+        ),
+        migrations.RunPython(fill_last_messages, migrations.RunPython.noop),
+    ]
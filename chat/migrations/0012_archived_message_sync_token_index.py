@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 14:36
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_cross_database_foreign_keys'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='archivedmessage',
+            index_together=set([('conversation_key', 'sync_token'), ('conversation_key', 'datetime')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 14:40
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.conf import settings
+from django.db import migrations
+
+# SQLite remakes chat_message for the indexes too.
+restore_search_index = import_module('chat.migrations.0011_cross_database_foreign_keys').restore_search_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0012_archived_message_sync_token_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='archivedmessage',
+            index_together=set([('sender', 'datetime', 'id'), ('conversation_key', 'sync_token'), ('conversation_key', 'datetime'), ('receiver', 'datetime', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('conversation_key', 'id'), ('receiver', 'datetime', 'id'), ('sender', 'datetime', 'id'), ('conversation_key', 'sync_token'), ('conversation_key', 'datetime'), ('receiver', 'sync_token')]),
+        ),
+        migrations.RunPython(restore_search_index, restore_search_index),
+    ]
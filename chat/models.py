@@ -1,48 +1,887 @@
 from __future__ import unicode_literals
 
+import itertools
+import json
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from operator import attrgetter
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import Q
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, models, transaction
+from django.db.models import Count, F, Max, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.query import ValuesListIterable
+from django.utils import timezone
+
+from chat import cache, jobs, sharding
+
+
+def get_conversation_key(user_a_id, user_b_id):
+    """
+    Canonical key of the conversation between two users: the ordered pair of their ids.
+    """
+    return '{}:{}'.format(*sorted((user_a_id, user_b_id)))
+
+
+def _increment_unread(queryset, delta, **create_kwargs):
+    """
+    Add `delta` to the `unread` column of the single row matched by `queryset`,
+    creating the row when it does not exist yet.
+    """
+    if queryset.update(unread=F('unread') + delta) if delta else queryset.exists():
+        return
+
+    try:
+        with transaction.atomic(using=queryset.db):
+            queryset.create(unread=delta, **create_kwargs)
+    except IntegrityError:
+        queryset.update(unread=F('unread') + delta)
+
+
+def _increment_unread_many(queryset, key_field, keys, build, delta=1):
+    """
+    Add `delta` to the `unread` column of the rows of `queryset` whose `key_field`
+    is in `keys`, creating missing rows from the keyword arguments `build(key)`.
+    """
+    existing = set(queryset.filter(**{key_field + '__in': keys}).values_list(key_field, flat=True))
+    if delta:
+        queryset.filter(**{key_field + '__in': existing}).update(unread=F('unread') + delta)
+
+    missing = [key for key in keys if key not in existing]
+    if not missing:
+        return
+
+    try:
+        with transaction.atomic(using=queryset.db):
+            queryset.bulk_create(
+                queryset.model(unread=delta, **build(key)) for key in missing
+            )
+    except IntegrityError:
+        # Some rows were created concurrently, fall back to one upsert per row.
+        for key in missing:
+            _increment_unread(queryset.filter(**{key_field: key}), delta, **build(key))
+
+
+def _last_message_sql(column, alias):
+    """
+    Correlated subquery selecting `column` of the newest message of the
+    conversation of the `UserConversation` row being updated, on the shard `alias`.
+    """
+    qn = connections[alias].ops.quote_name
+
+    return RawSQL(
+        'SELECT m.{column} FROM {message} m '
+        'WHERE m.{key} = {conversation}.{key} '
+        'ORDER BY m.{id} DESC LIMIT 1'.format(
+            column=qn(column),
+            key=qn('conversation_key'),
+            id=qn('id'),
+            message=qn(Message._meta.db_table),
+            conversation=qn(UserConversation._meta.db_table),
+        ),
+        []
+    )
+
+
+class MessageRow(namedtuple('MessageRow', ('id', 'sender_id', 'receiver_id', 'content', 'datetime', 'sync_token'))):
+    """
+    Read-only message fetched with `values_list`, see `MessageManager.as_rows`.
+    """
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+
+class MessageRowIterable(ValuesListIterable):
+    def __iter__(self):
+        for row in super(MessageRowIterable, self).__iter__():
+            yield MessageRow._make(row)
 
 
 class MessageManager(models.Manager):
-    def get_unread_count(self, user):
-        qs = self.filter(
-            receiver=user,
-            is_new=True
+    def get_unread_count(self, user, peer=None):
+        if peer is None:
+            return cache.get_unread_count(user.pk, lambda: self._load_unread_count(user.pk))
+
+        conversation_key = get_conversation_key(user.pk, peer.pk)
+        qs = sharding.for_conversation(UserConversation.objects, conversation_key).filter(
+            user=user,
+            conversation_key=conversation_key
         )
 
-        return qs.count()
+        return qs.values_list('unread', flat=True).first() or 0
+
+    def get_inbox(self, user):
+        """
+        Conversations of `user` with at least one message, most recently active first.
+
+        Gathered from every shard, see `sharding.ShardedQuerySet`.
+        """
+        qs = UserConversation.objects.filter(
+            user=user,
+            last_message__isnull=False
+        ).select_related('last_message')
+
+        return sharding.on_all_shards(qs).order_by('-last_message_at', '-id')
 
     def get_conversation(self, receiver, sender):
-        qs = self.filter(
-            Q(receiver=receiver) | Q(receiver=sender) |
-            Q(sender=receiver) | Q(sender=sender)
+        conversation_key = get_conversation_key(receiver.pk, sender.pk)
+        qs = sharding.for_conversation(self, conversation_key).filter(
+            conversation_key=conversation_key
         )
 
         return qs
 
+    def as_rows(self, queryset):
+        """
+        Clone of `queryset` yielding `MessageRow` tuples instead of model instances.
+        """
+        queryset = queryset.values_list(*MessageRow._fields)
+        queryset._iterable_class = MessageRowIterable
+
+        return queryset
+
+    def iter_chunks(self, queryset, chunk_size):
+        """
+        Yield the messages of `queryset` newest first, in lists of at most `chunk_size`.
+
+        Every chunk is its own keyset range query on (`datetime`, `id`), so memory
+        stays bounded by `chunk_size` and no cursor is held open between chunks.
+        """
+        queryset = queryset.order_by('-datetime', '-id')
+
+        chunk = list(queryset[:chunk_size])
+        while chunk:
+            yield chunk
+
+            if len(chunk) < chunk_size:
+                return
+
+            last = chunk[-1]
+            chunk = list(queryset.filter(
+                Q(datetime__lt=last.datetime) | Q(datetime=last.datetime, id__lt=last.id)
+            )[:chunk_size])
+
+    def iter_merged_chunks(self, querysets, chunk_size):
+        """
+        Like `iter_chunks` over all of `querysets` together, e.g. messages and
+        their archive, merged newest first by (`datetime`, `id`).
+
+        Each queryset is read a chunk at a time, so memory stays bounded by
+        `chunk_size` per queryset.
+        """
+        iterators = [itertools.chain.from_iterable(self.iter_chunks(qs, chunk_size)) for qs in querysets]
+        heads = dict((i, row) for i, row in enumerate(next(rows, None) for rows in iterators) if row is not None)
+
+        chunk = []
+        while heads:
+            # `heapq.merge` takes no key in Python 2.
+            i = max(heads, key=lambda i: (heads[i].datetime, heads[i].id))
+            chunk.append(heads.pop(i))
+
+            row = next(iterators[i], None)
+            if row is not None:
+                heads[i] = row
+
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    def iter_export(self, user, peer=None, chunk_size=500):
+        """
+        Yield the messages sent or received by `user`, or only those exchanged
+        with `peer`, newest first and archived ones last, as `MessageRow` tuples.
+
+        Fetched in keyset chunks of `chunk_size`: `iterator()` would not bound
+        memory on SQLite, which Django reads without chunking.
+        """
+        for manager in (self, ArchivedMessage.objects):
+            if peer is None:
+                # Sent and received ones merged, each a range of its index; with
+                # `sender=user OR receiver=user` every chunk sorted all the rest.
+                querysets = [
+                    manager.filter(sender=user),
+                    manager.filter(receiver=user).exclude(sender=user),
+                ]
+                querysets = [sharding.on_all_shards(self.as_rows(queryset)) for queryset in querysets]
+            else:
+                querysets = [self.as_rows(manager.get_conversation(user, peer))]
+
+            for chunk in self.iter_merged_chunks(querysets, chunk_size):
+                for row in chunk:
+                    yield row
+
+    def get_sync_token(self, receiver):
+        """
+        Latest sync token among the messages received by `receiver`, on any shard.
+        """
+        return max(
+            sharding.using(self, alias).filter(receiver=receiver).aggregate(
+                sync_token=Max('sync_token')
+            )['sync_token'] or 0
+            for alias in sharding.get_shards()
+        )
+
     def send(self, sender, receiver, content):
         msg = Message(
             sender=sender,
             receiver=receiver,
-            content=content
+            content=content,
+            conversation_key=get_conversation_key(sender.pk, receiver.pk)
         )
+        alias = sharding.get_shard(msg.conversation_key)
+
+        with transaction.atomic(), sharding.atomic(alias):
+            msg.sync_token = Sequence.objects.next_value(Message.SYNC_SEQUENCE)
+            if sharding.is_sharded():
+                msg.id = self._next_ids(1)
+            msg.save(force_insert=True, using=alias)
+            self._adjust_unread(receiver, sender, 1)
+            self._set_last_message(msg)
 
-        msg.save()
+            Job.objects.enqueue(jobs.NOTIFY, {'user_ids': [receiver.pk]}, key='notify:{}'.format(receiver.pk))
 
         return msg
 
+    def send_many(self, sender, receivers, content, batch_size=500):
+        """
+        Send `content` from `sender` to every user id in `receivers` in one transaction.
+
+        Returns one result per distinct receiver, in the given order.
+        """
+        receiver_ids = list(OrderedDict.fromkeys(receivers))
+        results = OrderedDict(
+            (receiver_id, OrderedDict([('receiver', receiver_id), ('status', 'invalid')]))
+            for receiver_id in receiver_ids
+        )
+        delivered = []
+
+        with transaction.atomic():
+            for start in range(0, len(receiver_ids), batch_size):
+                batch = receiver_ids[start:start + batch_size]
+
+                valid = set(User.objects.filter(pk__in=batch).values_list('pk', flat=True))
+                batch = [receiver_id for receiver_id in batch if receiver_id in valid]
+                if not batch:
+                    continue
+
+                last_token = Sequence.objects.next_value(Message.SYNC_SEQUENCE, len(batch))
+                first_token = last_token - len(batch) + 1
+
+                messages = [
+                    Message(
+                        sender=sender,
+                        receiver_id=receiver_id,
+                        content=content,
+                        conversation_key=get_conversation_key(sender.pk, receiver_id),
+                        sync_token=first_token + i
+                    )
+                    for i, receiver_id in enumerate(batch)
+                ]
+
+                if sharding.is_sharded():
+                    first_id = self._next_ids(len(batch)) - len(batch) + 1
+                    for i, message in enumerate(messages):
+                        message.id = first_id + i
+
+                for alias, shard_messages in sharding.group_by_shard(messages, attrgetter('conversation_key')).items():
+                    with sharding.atomic(alias):
+                        self._send_on_shard(alias, sender, shard_messages)
+
+                for message in messages:
+                    results[message.receiver_id]['status'] = 'sent'
+                    results[message.receiver_id]['id'] = message.id
+
+                _increment_unread_many(
+                    UnreadCounter.objects.all(),
+                    'user_id',
+                    batch,
+                    lambda receiver_id: {'user_id': receiver_id}
+                )
+                delivered.extend(batch)
+
+                Job.objects.enqueue(jobs.NOTIFY, {'user_ids': batch})
+
+            transaction.on_commit(lambda: cache.forget_unread_counts(delivered))
+
+        return list(results.values())
+
+    def _send_on_shard(self, alias, sender, messages):
+        """
+        Insert `messages` from `sender`, all on the shard `alias`, and update
+        the conversation state of both participants.
+        """
+        receiver_ids = [message.receiver_id for message in messages]
+        conversations = sharding.using(UserConversation.objects, alias)
+
+        sharding.using(self, alias).bulk_create(messages)
+
+        if not sharding.is_sharded():
+            # Not every backend returns primary keys from bulk inserts.
+            message_ids = dict(self.filter(
+                receiver_id__in=receiver_ids,
+                sync_token__range=(messages[0].sync_token, messages[-1].sync_token)
+            ).order_by().values_list('receiver_id', 'pk'))
+
+            for message in messages:
+                message.id = message_ids[message.receiver_id]
+
+        _increment_unread_many(
+            conversations.filter(peer=sender),
+            'user_id',
+            receiver_ids,
+            lambda receiver_id: {
+                'user_id': receiver_id,
+                'peer': sender,
+                'conversation_key': get_conversation_key(receiver_id, sender.pk),
+            }
+        )
+        _increment_unread_many(
+            conversations.filter(user=sender),
+            'peer_id',
+            receiver_ids,
+            lambda receiver_id: {
+                'user': sender,
+                'peer_id': receiver_id,
+                'conversation_key': get_conversation_key(sender.pk, receiver_id),
+            },
+            delta=0
+        )
+        self.refresh_last_messages([message.conversation_key for message in messages])
+
+    def refresh_last_messages(self, conversation_keys=None):
+        """
+        Point the `UserConversation` rows of `conversation_keys`, or of every
+        conversation when None, at the newest message of their conversation.
+
+        One statement per shard, each row looking its message up on the
+        (`conversation_key`, `id`) index.
+        """
+        if conversation_keys is None:
+            shards = OrderedDict((alias, None) for alias in sharding.get_shards())
+        else:
+            shards = sharding.group_by_shard(conversation_keys)
+
+        updated = 0
+        for alias, keys in shards.items():
+            qs = sharding.using(UserConversation.objects, alias)
+            if keys is not None:
+                qs = qs.filter(conversation_key__in=keys)
+
+            updated += qs.update(
+                last_message_id=_last_message_sql('id', alias),
+                last_message_at=_last_message_sql('datetime', alias),
+            )
+
+        return updated
+
+    def get_read_watermarks(self, user, peer):
+        """
+        Read watermarks of both participants of the conversation, as a mapping of user id
+        to the id of the last message they have read.
+        """
+        conversation_key = get_conversation_key(user.pk, peer.pk)
+        qs = sharding.for_conversation(UserConversation.objects, conversation_key).filter(
+            conversation_key=conversation_key
+        )
+
+        return dict(qs.values_list('user_id', 'last_read_id'))
+
+    def get_conversation_version(self, reader, peer):
+        """
+        Cheap summary of the conversation as `reader` sees it, changing whenever a
+        message is added or removed or `peer` moves their read watermark.
+
+        `reader`'s own watermark is left out: reading a page does not change it.
+        """
+        conversation_key = get_conversation_key(reader.pk, peer.pk)
+
+        version = self.get_conversation(reader, peer).aggregate(
+            count=Count('id'),
+            sync_token=Max('sync_token'),
+            modified=Max('datetime'),
+        )
+
+        peer_state = sharding.for_conversation(UserConversation.objects, conversation_key).filter(
+            user=peer, conversation_key=conversation_key
+        ).values_list('sync_token', 'last_read_at').first()
+
+        if peer_state is not None:
+            version['read_sync_token'], read_at = peer_state
+            if read_at is not None and (version['modified'] is None or read_at > version['modified']):
+                version['modified'] = read_at
+
+        return version
+
+    def annotate_read_state(self, messages, watermarks):
+        """
+        Set `is_new` on `messages`: whether the receiver has not read them yet.
+        """
+        for message in messages:
+            message.is_new = message.pk > watermarks.get(message.receiver_id, 0)
+
+        return messages
+
+    def mark_read(self, reader, peer, up_to_id, received_ids=None):
+        """
+        Move the read watermark of `reader` in the conversation with `peer` up to
+        the message `up_to_id`, and return how many messages became read.
+
+        With `received_ids`, the ids of the messages shown to `reader`, the
+        watermark stops before the oldest unread message not among them, so
+        messages the reader never received stay unread.
+
+        This is a single-row update however many messages it covers.
+        """
+        conversation_key = get_conversation_key(reader.pk, peer.pk)
+        alias = sharding.get_shard(conversation_key)
+        conversations = sharding.using(UserConversation.objects, alias).filter(
+            user=reader, conversation_key=conversation_key
+        )
+
+        with transaction.atomic(), sharding.atomic(alias):
+            while True:
+                last_read_id = conversations.values_list('last_read_id', flat=True).first()
+
+                # No row means nothing was ever exchanged between `reader` and `peer`.
+                if last_read_id is None or up_to_id <= last_read_id:
+                    return 0
+
+                unread = self.get_conversation(reader, peer).filter(
+                    receiver=reader,
+                    id__gt=last_read_id,
+                    id__lte=up_to_id
+                )
+
+                if received_ids is None:
+                    read_up_to, marked = up_to_id, unread.count()
+                else:
+                    read_up_to, marked = last_read_id, 0
+                    for message_id in unread.order_by('id').values_list('id', flat=True):
+                        if message_id not in received_ids:
+                            break
+                        read_up_to, marked = message_id, marked + 1
+
+                    if not marked:
+                        return 0
+
+                # Conditional on the watermark read above, so a concurrent mark-read
+                # of the same range cannot subtract the messages twice.
+                updated = conversations.filter(last_read_id=last_read_id).update(
+                    last_read_id=read_up_to,
+                    last_read_at=timezone.now(),
+                    unread=F('unread') - marked,
+                    sync_token=Sequence.objects.next_value(Message.SYNC_SEQUENCE)
+                )
+                if updated:
+                    break
+
+            if marked:
+                _increment_unread(UnreadCounter.objects.filter(pk=reader.pk), -marked, user=reader)
+
+                transaction.on_commit(lambda: cache.forget_unread_count(reader.pk))
+
+        return marked
+
+    def archive(self, before, limit):
+        """
+        Move up to `limit` messages created before `before` to `ArchivedMessage`,
+        oldest first, in one transaction per shard; return how many were moved.
+
+        Unread messages and the last message of a conversation stay, so the
+        unread counters and the inbox never depend on the archive.
+        """
+        return sum(self._archive_on_shard(alias, before, limit) for alias in sharding.get_shards())
+
+    def _archive_on_shard(self, alias, before, limit):
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        sql = (
+            'SELECT m.id FROM {message} m '
+            'LEFT JOIN {conversation} c '
+            'ON c.user_id = m.receiver_id AND c.conversation_key = m.conversation_key '
+            'WHERE m.created_at < %s AND m.id <= COALESCE(c.last_read_id, 0) '
+            'AND m.id NOT IN (SELECT last_message_id FROM {conversation} WHERE last_message_id IS NOT NULL) '
+            'ORDER BY m.created_at, m.id '
+            'LIMIT %s'
+        ).format(
+            message=qn(Message._meta.db_table),
+            conversation=qn(UserConversation._meta.db_table),
+        )
+
+        with transaction.atomic(using=alias):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [connection.ops.adapt_datetimefield_value(before), limit])
+                ids = [row[0] for row in cursor.fetchall()]
+
+            if not ids:
+                return 0
+
+            messages = sharding.using(self, alias).filter(pk__in=ids)
+            sharding.using(ArchivedMessage.objects, alias).bulk_create(
+                ArchivedMessage(**dict((field, getattr(message, field)) for field in ARCHIVED_FIELDS))
+                for message in messages
+            )
+            messages.delete()
+
+        return len(ids)
+
+    def _load_unread_count(self, user_id):
+        # Cached for every process, so never from a replica that may lag behind.
+        qs = UnreadCounter.objects.using(DEFAULT_DB_ALIAS).filter(pk=user_id)
+
+        return qs.values_list('unread', flat=True).first() or 0
+
+    def _adjust_unread(self, user, peer, delta):
+        conversation_key = get_conversation_key(user.pk, peer.pk)
+
+        transaction.on_commit(lambda: cache.forget_unread_count(user.pk))
+
+        _increment_unread(
+            UnreadCounter.objects.filter(pk=user.pk),
+            delta,
+            user=user
+        )
+        _increment_unread(
+            sharding.for_conversation(UserConversation.objects, conversation_key).filter(
+                user=user, conversation_key=conversation_key
+            ),
+            delta,
+            user=user, peer=peer, conversation_key=conversation_key
+        )
+
+    def _set_last_message(self, message):
+        """
+        Make `message` the last message of the conversation for both participants.
+        """
+        conversation_key = message.conversation_key
+        conversations = sharding.for_conversation(UserConversation.objects, conversation_key)
+
+        # The receiver's row exists already, see `_adjust_unread`.
+        _increment_unread(
+            conversations.filter(user_id=message.sender_id, conversation_key=conversation_key),
+            0,
+            user_id=message.sender_id, peer_id=message.receiver_id, conversation_key=conversation_key
+        )
+
+        conversations.filter(
+            Q(last_message__isnull=True) | Q(last_message_id__lt=message.pk),
+            conversation_key=conversation_key
+        ).update(last_message=message, last_message_at=message.datetime)
+
+    def _next_ids(self, count):
+        """
+        Reserve `count` message ids, unique across shards, and return the last one.
+        """
+        return Sequence.objects.next_value(Message.ID_SEQUENCE, count, start=self.get_max_id)
+
+    def get_max_id(self, shards=None):
+        """
+        Highest id of the messages, archived ones included, on `shards` or on every shard.
+        """
+        return max(
+            sharding.using(model.objects, alias).aggregate(id=Max('id'))['id'] or 0
+            for alias in (sharding.get_shards() if shards is None else shards)
+            for model in (Message, ArchivedMessage)
+        )
+
+
+class SequenceManager(models.Manager):
+    def next_value(self, name, count=1, start=None):
+        """
+        Reserve `count` values of the sequence and return the last one.
+
+        Must run inside the transaction that uses the values: the row lock
+        makes concurrent writers commit their values in increasing order.
+        A new sequence continues after `start()`, when given, instead of 0.
+        """
+        with transaction.atomic():
+            if not self.filter(name=name).update(value=F('value') + count):
+                self.create(name=name, value=(start() if start else 0) + count)
+
+            return self.filter(name=name).values_list('value', flat=True).get()
+
+    def advance(self, name, value):
+        """
+        Make the sequence continue after `value` if it is not past it already.
+        """
+        with transaction.atomic():
+            if not self.filter(name=name, value__lt=value).update(value=value):
+                self.get_or_create(name=name, defaults={'value': value})
+
+
+class Sequence(models.Model):
+    name = models.CharField(max_length=64, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    objects = SequenceManager()
+
 
 class Message(models.Model):
-    sender = models.ForeignKey(User, related_name='msg_sender')
-    receiver = models.ForeignKey(User, related_name='msg_receiver')
+    SYNC_SEQUENCE = 'message_sync'
+    # Ids of messages sent while there are several shards.
+    ID_SEQUENCE = 'message_id'
+
+    # Users live on `default` only, a shard cannot hold constraints to them.
+    sender = models.ForeignKey(User, related_name='msg_sender', db_constraint=False)
+    receiver = models.ForeignKey(User, related_name='msg_receiver', db_constraint=False)
     content = models.TextField()
     datetime = models.DateTimeField(auto_now=True)
-    is_new = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    conversation_key = models.CharField(max_length=41, editable=False)
+    # Taken from `SYNC_SEQUENCE` when the message is created.
+    sync_token = models.BigIntegerField(default=0, editable=False)
 
     objects = MessageManager()
 
     class Meta:
         ordering = ['-datetime']
         get_latest_by = 'datetime'
+        # SQLite and PostgreSQL walk the index backwards for `-datetime`.
+        index_together = [
+            ('conversation_key', 'datetime'),
+            ('conversation_key', 'sync_token'),
+            ('conversation_key', 'id'),
+            ('receiver', 'sync_token'),
+            ('sender', 'datetime', 'id'),
+            ('receiver', 'datetime', 'id'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.conversation_key = get_conversation_key(self.sender_id, self.receiver_id)
+
+        super(Message, self).save(*args, **kwargs)
+
+
+ARCHIVED_FIELDS = (
+    'id', 'sender_id', 'receiver_id', 'content', 'datetime', 'created_at', 'conversation_key', 'sync_token'
+)
+
+
+class ArchivedMessageManager(models.Manager):
+    def get_conversation(self, receiver, sender):
+        conversation_key = get_conversation_key(receiver.pk, sender.pk)
+
+        return sharding.for_conversation(self, conversation_key).filter(
+            conversation_key=conversation_key
+        )
+
+    def purge(self, before, limit):
+        """
+        Delete up to `limit` archived messages created before `before`, oldest
+        first, in one transaction per shard; return how many were deleted.
+        """
+        purged = 0
+        for alias in sharding.get_shards():
+            archived = sharding.using(self, alias)
+            with transaction.atomic(using=alias):
+                ids = list(archived.filter(created_at__lt=before).order_by('created_at', 'id').values_list('id', flat=True)[:limit])
+                if ids:
+                    archived.filter(pk__in=ids).delete()
+
+            purged += len(ids)
+
+        return purged
+
+
+class ArchivedMessage(models.Model):
+    """
+    Read message moved out of `Message` by `MessageManager.archive`, with its id kept.
+
+    Conversation pages, streams and syncs merge these in with `Message`, see
+    `MessageCursorPagination`. Archived messages are not searchable.
+    """
+    id = models.IntegerField(primary_key=True)
+    sender = models.ForeignKey(User, related_name='+', db_constraint=False)
+    receiver = models.ForeignKey(User, related_name='+', db_constraint=False)
+    content = models.TextField()
+    datetime = models.DateTimeField()
+    created_at = models.DateTimeField(db_index=True)
+    conversation_key = models.CharField(max_length=41)
+    sync_token = models.BigIntegerField(default=0)
+
+    objects = ArchivedMessageManager()
+
+    class Meta:
+        ordering = ['-datetime']
+        index_together = [
+            ('conversation_key', 'datetime'),
+            ('conversation_key', 'sync_token'),
+            ('sender', 'datetime', 'id'),
+            ('receiver', 'datetime', 'id'),
+        ]
+
+
+class UnreadCounter(models.Model):
+    """
+    Number of unread messages received by a user, kept up to date by `MessageManager`.
+    """
+    user = models.OneToOneField(User, primary_key=True, related_name='unread_counter')
+    unread = models.IntegerField(default=0)
+
+
+class UserConversation(models.Model):
+    """
+    Per-user state of a conversation with `peer`, one row for each participant.
+
+    Messages received by `user` up to `last_read_id` are read, later ones are new.
+    `last_message` is the newest message of the conversation, in either direction;
+    with `unread` it makes the row an inbox entry, see `MessageManager.get_inbox`.
+    """
+    user = models.ForeignKey(User, related_name='conversations', db_constraint=False)
+    peer = models.ForeignKey(User, related_name='+', db_constraint=False)
+    conversation_key = models.CharField(max_length=41)
+    unread = models.IntegerField(default=0)
+    last_read_id = models.IntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    # Taken from `Message.SYNC_SEQUENCE` whenever the read watermark moves.
+    sync_token = models.BigIntegerField(default=0)
+    # No constraint either: `rebalance_shards` moves messages and states apart.
+    last_message = models.ForeignKey(
+        Message, null=True, blank=True, related_name='+', on_delete=models.SET_NULL, db_constraint=False
+    )
+    # Copy of `last_message.datetime`, the inbox order.
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('user', 'conversation_key')
+        index_together = [
+            ('user', 'last_message_at'),
+        ]
+
+
+class JobManager(models.Manager):
+    def enqueue(self, name, payload, key=None, delay=0):
+        """
+        Queue the job `name` of `jobs.HANDLERS` with the JSON serializable `payload`.
+
+        Part of the current transaction: the job runs only if it commits. A job
+        with the `key` of one still pending is dropped, the pending one does the
+        work. With `settings.CHAT_JOBS_EAGER` nothing is stored, the handler runs
+        in this process on commit; returns the job otherwise, None when dropped.
+        """
+        if settings.CHAT_JOBS_EAGER:
+            transaction.on_commit(lambda: jobs.run(name, payload))
+            return None
+
+        job = Job(
+            name=name,
+            payload=json.dumps(payload),
+            key=key,
+            run_at=timezone.now() + timedelta(seconds=delay)
+        )
+
+        if key is None:
+            job.save(force_insert=True)
+            return job
+
+        try:
+            with transaction.atomic():
+                job.save(force_insert=True)
+        except IntegrityError:
+            return None
+
+        return job
+
+    def claim(self, worker, limit, lease=None):
+        """
+        Lease up to `limit` due jobs to `worker`, oldest first, and return them.
+
+        A leased job is due again after `lease` seconds, so the jobs of a worker
+        that died are retried. Its key is released: jobs queued from now on are
+        not covered by this run.
+        """
+        if lease is None:
+            lease = settings.CHAT_JOB_LEASE
+
+        now = timezone.now()
+        due = self.filter(state=Job.PENDING, run_at__lte=now).order_by('run_at', 'id')
+
+        claimed = []
+        for pk, attempts in due.values_list('pk', 'attempts')[:limit]:
+            # Lost to another worker when `attempts` moved on.
+            if self.filter(pk=pk, attempts=attempts, run_at__lte=now).update(
+                run_at=now + timedelta(seconds=lease),
+                attempts=attempts + 1,
+                locked_by=worker,
+                key=None
+            ):
+                claimed.append(pk)
+
+        if not claimed:
+            return []
+
+        return list(self.filter(pk__in=claimed).order_by('run_at', 'id'))
+
+    def complete(self, job):
+        self.filter(pk=job.pk).delete()
+
+    def retry(self, job, error):
+        """
+        Run `job` again after a delay doubling with each attempt, or mark it
+        failed after `settings.CHAT_JOB_MAX_ATTEMPTS`.
+        """
+        if job.attempts >= settings.CHAT_JOB_MAX_ATTEMPTS:
+            changes = {'state': Job.FAILED}
+        else:
+            delay = min(settings.CHAT_JOB_RETRY_DELAY * 2 ** (job.attempts - 1), settings.CHAT_JOB_MAX_RETRY_DELAY)
+            changes = {'run_at': timezone.now() + timedelta(seconds=delay)}
+
+        # Unless the lease expired and another worker claimed it again.
+        self.filter(pk=job.pk, attempts=job.attempts).update(locked_by='', last_error=error[:1000], **changes)
+
+    def get_stats(self):
+        """
+        Jobs pending, due and failed, and the seconds the oldest due job has been waiting.
+        """
+        now = timezone.now()
+        pending = self.filter(state=Job.PENDING)
+        due = pending.filter(run_at__lte=now)
+        oldest = due.order_by('run_at').values_list('run_at', flat=True).first()
+
+        return OrderedDict((
+            ('pending', pending.count()),
+            ('due', due.count()),
+            ('failed', self.filter(state=Job.FAILED).count()),
+            ('lag', (now - oldest).total_seconds() if oldest else 0.0),
+        ))
+
+
+class Job(models.Model):
+    """
+    Work queued by `JobManager.enqueue` for `python manage.py run_jobs`.
+
+    Jobs run at least once: a job whose worker died before deleting it runs
+    again, so handlers must be idempotent. Failed jobs are kept for inspection.
+    """
+    PENDING = 'pending'
+    FAILED = 'failed'
+    STATES = (
+        (PENDING, 'Pending'),
+        (FAILED, 'Failed'),
+    )
+
+    name = models.CharField(max_length=64)
+    payload = models.TextField()
+    # Identifies the work of a pending job; unique, so it is queued once.
+    key = models.CharField(max_length=128, null=True, blank=True, unique=True)
+    state = models.CharField(max_length=16, choices=STATES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # When the job is due: queued, retried, or its lease expires.
+    run_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    locked_by = models.CharField(max_length=128, blank=True)
+    last_error = models.TextField(blank=True)
+
+    objects = JobManager()
+
+    class Meta:
+        index_together = [
+            ('state', 'run_at'),
+        ]
@@ -0,0 +1,225 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import glob
+import logging
+import os
+import select
+import socket
+import tempfile
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core import checks
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription(object):
+    """
+    Wake-up channel of one waiting client.
+
+    Waiting blocks in `select` on a pipe, so an idle subscriber costs two file
+    descriptors and no CPU.
+    """
+
+    def __init__(self, notifier, user_id):
+        self.notifier = notifier
+        self.user_id = user_id
+        self._read_fd, self._write_fd = os.pipe()
+
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def notify(self):
+        try:
+            os.write(self._write_fd, b'.')
+        except OSError as e:
+            # A full pipe already holds a pending wake-up.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout):
+        """
+        Block until notified or `timeout` seconds passed; return whether notified.
+        """
+        readable, _, _ = select.select([self._read_fd], [], [], timeout)
+
+        return bool(readable)
+
+    def close(self):
+        self.notifier.unsubscribe(self)
+
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class InProcessNotifier(object):
+    """
+    Delivers notifications to subscribers of the current process only.
+    """
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id)
+
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is None:
+                return
+
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id):
+        self._deliver(user_id)
+
+    def _deliver(self, user_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+
+        for subscription in subscriptions:
+            subscription.notify()
+
+
+class UnixSocketNotifier(InProcessNotifier):
+    """
+    Delivers notifications to subscribers of every worker process on this host.
+
+    Each subscribing process binds a datagram socket in `directory`; publishing
+    sends the user id to all of them. Sockets of dead processes are removed
+    on the first failed delivery.
+    """
+
+    def __init__(self, directory=None, **options):
+        super(UnixSocketNotifier, self).__init__(**options)
+
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'drf_samples_notifier')
+        self._listener_lock = threading.Lock()
+        self._listener_pid = None
+
+    @property
+    def socket_path(self):
+        return os.path.join(self.directory, '{}.sock'.format(os.getpid()))
+
+    def subscribe(self, user_id):
+        self._start_listener()
+
+        return super(UnixSocketNotifier, self).subscribe(user_id)
+
+    def publish(self, user_id):
+        self._deliver(user_id)
+
+        payload = str(user_id).encode('ascii')
+        own_path = self.socket_path
+
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for path in glob.glob(os.path.join(self.directory, '*.sock')):
+                if path == own_path:
+                    continue
+
+                try:
+                    sender.sendto(payload, path)
+                except socket.error as e:
+                    if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        self._remove_stale(path)
+                    else:
+                        # Waiting clients fall back to their poll timeout.
+                        logger.warning('Notification to %s dropped: %s', path, e)
+        finally:
+            sender.close()
+
+    def _start_listener(self):
+        with self._listener_lock:
+            # Forked workers inherit the attribute but not the listener thread.
+            if self._listener_pid == os.getpid():
+                return
+
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            path = self.socket_path
+            self._remove_stale(path)
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            listener.bind(path)
+
+            thread = threading.Thread(target=self._listen, args=(listener,), name='chat-notifier')
+            thread.daemon = True
+            thread.start()
+
+            self._listener_pid = os.getpid()
+
+    def _listen(self, listener):
+        while True:
+            payload = listener.recv(64)
+
+            try:
+                user_id = int(payload)
+            except ValueError:
+                continue
+
+            self._deliver(user_id)
+
+    def _remove_stale(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def check_job_notifier(app_configs, **kwargs):
+    """
+    System check: stored jobs run in `run_jobs`, which must reach the web processes.
+    """
+    backend = settings.CHAT_NOTIFIER['BACKEND']
+    if settings.CHAT_JOBS_EAGER or backend != 'chat.notifier.InProcessNotifier':
+        return []
+
+    return [checks.Error(
+        'CHAT_NOTIFIER cannot be InProcessNotifier unless CHAT_JOBS_EAGER is set.',
+        hint='run_jobs wakes the long polls of other processes; use chat.notifier.UnixSocketNotifier.',
+        obj='CHAT_NOTIFIER',
+        id='chat.E001',
+    )]
+
+
+def get_notifier():
+    """
+    Return the process-wide notifier configured by `settings.CHAT_NOTIFIER`.
+    """
+    global _notifier
+
+    with _notifier_lock:
+        if _notifier is None:
+            config = settings.CHAT_NOTIFIER
+            _notifier = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+    return _notifier
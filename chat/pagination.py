@@ -0,0 +1,218 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.six.moves.urllib import parse as urlparse
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class PageSizePagination(BasePagination):
+    """
+    Page size taken from `page_size_query_param`, capped at `max_page_size`.
+    """
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        if page_size <= 0:
+            return self.page_size
+
+        return min(page_size, self.max_page_size)
+
+
+class MessageCursorPagination(PageSizePagination):
+    """
+    Keyset pagination over (`datetime`, `id`), newest messages first.
+
+    The opaque cursor holds the position of the boundary row, so each page is
+    a bounded index range scan no matter how deep the client pages.
+
+    When the view has a `get_archive_queryset` method, the archive queryset is
+    paged with the same bounds and merged in: archived messages may fall
+    between messages that are not archived, e.g. unread ones.
+    """
+    ordering_field = 'datetime'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+
+        reverse = self.cursor is not None and self.cursor[0]
+
+        results = list(self.apply_cursor(queryset)[:self.page_size + 1])
+
+        if hasattr(view, 'get_archive_queryset'):
+            archived = list(self.apply_cursor(view.get_archive_queryset())[:self.page_size + 1])
+            if archived:
+                results = sorted(results + archived, key=self.get_position, reverse=not reverse)
+                results = results[:self.page_size + 1]
+
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        if self.page:
+            position = self.get_position(self.page[-1])
+        else:
+            position = self.cursor[1:]
+
+        return self.encode_cursor(False, position)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+
+        if self.page:
+            position = self.get_position(self.page[0])
+        else:
+            position = self.cursor[1:]
+
+        return self.encode_cursor(True, position)
+
+    def apply_cursor(self, queryset):
+        """
+        Rows of `queryset` past the cursor, in the order they are paged through.
+        """
+        field = self.ordering_field
+
+        if self.cursor is None:
+            return queryset.order_by('-' + field, '-id')
+
+        reverse, datetime, pk = self.cursor
+
+        if reverse:
+            return queryset.filter(
+                Q(**{field + '__gt': datetime}) | Q(**{field: datetime, 'id__gt': pk})
+            ).order_by(field, 'id')
+
+        return queryset.filter(
+            Q(**{field + '__lt': datetime}) | Q(**{field: datetime, 'id__lt': pk})
+        ).order_by('-' + field, '-id')
+
+    def get_position(self, row):
+        return getattr(row, self.ordering_field), row.id
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = urlparse.parse_qs(querystring, keep_blank_values=True)
+
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+            datetime = parse_datetime(tokens['p'][0])
+            pk = int(tokens['i'][0])
+        except (KeyError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if datetime is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        return reverse, datetime, pk
+
+    def encode_cursor(self, reverse, position):
+        datetime, pk = position
+        tokens = {
+            'p': datetime.isoformat(),
+            'i': str(pk),
+        }
+        if reverse:
+            tokens['r'] = '1'
+
+        querystring = urlparse.urlencode(sorted(tokens.items()))
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class ConversationCursorPagination(MessageCursorPagination):
+    """
+    Keyset pagination of the inbox over (`last_message_at`, `id`), most recent first.
+    """
+    ordering_field = 'last_message_at'
+
+
+class SearchOffsetPagination(PageSizePagination):
+    """
+    Offset pagination of ranked search hits, which have no stable position to
+    put in a cursor. Fetches one extra hit to know whether a next page exists,
+    without counting all of them.
+    """
+    offset_query_param = 'offset'
+    page_size = 20
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+
+        try:
+            self.offset = max(0, int(request.query_params.get(self.offset_query_param, 0)))
+        except ValueError:
+            self.offset = 0
+
+        results = list(queryset[self.offset:self.offset + self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+
+        return results[:self.page_size]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        return replace_query_param(self.base_url, self.offset_query_param, self.offset + self.page_size)
+
+    def get_previous_link(self):
+        if not self.offset:
+            return None
+
+        offset = max(0, self.offset - self.page_size)
+        if not offset:
+            return remove_query_param(self.base_url, self.offset_query_param)
+
+        return replace_query_param(self.base_url, self.offset_query_param, offset)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
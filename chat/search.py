@@ -0,0 +1,156 @@
+# encoding: utf-8
+"""
+Full-text search over the messages of a user.
+
+On SQLite, hits come ranked from the FTS5 index created by migration 0008 and
+kept in sync by triggers on the message table. Other databases fall back to
+an unranked `icontains` scan, newest first, without highlighting. Each shard
+is searched on its own and the hits merged.
+
+Snippets are HTML: the message text escaped, the matches in `<mark>` tags.
+"""
+from __future__ import unicode_literals
+
+import re
+import uuid
+from operator import attrgetter
+
+from django.db import connections
+from django.db.models import Q
+from django.utils.html import escape
+
+from chat import sharding
+from chat.models import Message, get_conversation_key
+
+FTS_TABLE = 'chat_message_fts'
+
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_END = '</mark>'
+SNIPPET_ELLIPSIS = '…'
+SNIPPET_TOKENS = 16
+
+# Words, optionally followed by `*` for a prefix match; any other syntax of
+# the FTS5 query language is ignored.
+TERMS = re.compile(r'(\w+)(\*?)', re.UNICODE)
+
+
+def get_terms(text):
+    """
+    (word, is_prefix) pairs of the search `text`.
+    """
+    return [(word, bool(prefix)) for word, prefix in TERMS.findall(text)]
+
+
+def get_match_expression(terms):
+    """
+    FTS5 query matching messages containing all of `terms`.
+    """
+    return ' '.join('"{}"{}'.format(word, '*' if prefix else '') for word, prefix in terms)
+
+
+def highlight(snippet, start, end):
+    """
+    `snippet` escaped as HTML, with the `start` and `end` markers around the
+    matches replaced by highlighting tags.
+    """
+    return escape(snippet).replace(start, HIGHLIGHT_START).replace(end, HIGHLIGHT_END)
+
+
+def search_messages(user, text, peer=None):
+    """
+    Messages sent or received by `user` matching `text`, best first; in the
+    conversation with `peer` only when given.
+
+    The result is lazy, slice it to fetch a page.
+    """
+    return MessageSearch(user, get_terms(text), peer)
+
+
+class MessageSearch(object):
+    def __init__(self, user, terms, peer=None):
+        self.user = user
+        self.terms = terms
+        self.peer = peer
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None or item.stop is None:
+            raise TypeError('Only [start:stop] slices of a search are supported.')
+
+        offset = item.start or 0
+        limit = item.stop - offset
+        if not self.terms or limit <= 0:
+            return []
+
+        if self.peer is not None:
+            shards = [sharding.get_shard(get_conversation_key(self.user.pk, self.peer.pk))]
+        else:
+            shards = sharding.get_shards()
+
+        if len(shards) == 1:
+            return self._fetch(shards[0], offset, limit)
+
+        # Any shard may hold the hits up to `stop`.
+        hits = [hit for alias in shards for hit in self._fetch(alias, 0, item.stop)]
+        if all(hit.rank is not None for hit in hits):
+            hits.sort(key=lambda hit: (hit.rank, -hit.id))
+        else:
+            hits.sort(key=attrgetter('datetime', 'id'), reverse=True)
+
+        return hits[offset:item.stop]
+
+    def _fetch(self, alias, offset, limit):
+        if connections[alias].vendor == 'sqlite':
+            return self._fetch_ranked(alias, offset, limit)
+
+        return self._fetch_scanned(alias, offset, limit)
+
+    def _fetch_ranked(self, alias, offset, limit):
+        qn = connections[alias].ops.quote_name
+
+        if self.peer is None:
+            scope = 'm.sender_id = %s OR m.receiver_id = %s'
+            scope_params = [self.user.pk, self.user.pk]
+        else:
+            scope = 'm.conversation_key = %s'
+            scope_params = [get_conversation_key(self.user.pk, self.peer.pk)]
+
+        sql = (
+            'SELECT m.*, snippet({fts}, 0, %s, %s, %s, %s) AS snippet, {fts}.rank AS rank '
+            'FROM {fts} JOIN {message} m ON m.id = {fts}.rowid '
+            'WHERE {fts} MATCH %s AND ({scope}) '
+            'ORDER BY {fts}.rank, m.id DESC '
+            'LIMIT %s OFFSET %s'
+        ).format(
+            fts=qn(FTS_TABLE),
+            message=qn(Message._meta.db_table),
+            scope=scope,
+        )
+        # Markers no message contains, left intact by escaping.
+        start, end = ('\x02{}\x03'.format(uuid.uuid4().hex) for _ in range(2))
+        params = (
+            [start, end, SNIPPET_ELLIPSIS, SNIPPET_TOKENS, get_match_expression(self.terms)] +
+            scope_params +
+            [limit, offset]
+        )
+
+        hits = list(sharding.using(Message.objects, alias).raw(sql, params))
+        for hit in hits:
+            hit.snippet = highlight(hit.snippet, start, end)
+
+        return hits
+
+    def _fetch_scanned(self, alias, offset, limit):
+        if self.peer is None:
+            qs = sharding.using(Message.objects, alias).filter(Q(sender=self.user) | Q(receiver=self.user))
+        else:
+            qs = Message.objects.get_conversation(self.user, self.peer)
+
+        for word, prefix in self.terms:
+            qs = qs.filter(content__icontains=word)
+
+        messages = list(qs.order_by('-datetime', '-id')[offset:offset + limit])
+        for message in messages:
+            message.snippet = escape(message.content)
+            message.rank = None
+
+        return messages
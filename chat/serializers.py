@@ -1,19 +1,99 @@
 # encoding: utf-8
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+
+from django.conf import settings
 from rest_framework import serializers
 
 from accounts.serializers import UserSerializer
-from chat.models import Message
+from chat.models import Message, UserConversation
+from drf_samples.instrumentation import TimedListSerializer, TimedSerializerMixin, span
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ('receiver', 'content')
 
 
-class MessageUserDetailsSerializer(serializers.ModelSerializer):
+class MessageBulkSerializer(TimedSerializerMixin, serializers.Serializer):
+    receivers = serializers.ListField(child=serializers.IntegerField(min_value=1))
+    content = serializers.CharField()
+
+    def validate_receivers(self, value):
+        if not value:
+            raise serializers.ValidationError('This list may not be empty.')
+
+        if len(value) > settings.CHAT_BULK_SEND_MAX_RECEIVERS:
+            raise serializers.ValidationError(
+                'Ensure this list has no more than {} elements.'.format(settings.CHAT_BULK_SEND_MAX_RECEIVERS)
+            )
+
+        return value
+
+
+class MessageUserDetailsSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    # Derived from the receiver's read watermark, see `MessageManager.annotate_read_state`.
+    is_new = serializers.BooleanField(read_only=True)
+
     class Meta:
         model = Message
         fields = ('id', 'sender_id', 'receiver_id', 'content', 'datetime', 'is_new')
+        list_serializer_class = TimedListSerializer
+
+
+class MessageSearchSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    # Matched terms wrapped in `chat.search.HIGHLIGHT_START` / `HIGHLIGHT_END`.
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ('id', 'sender_id', 'receiver_id', 'content', 'datetime', 'snippet')
+        list_serializer_class = TimedListSerializer
+
+
+class LastMessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Message
+        fields = ('id', 'sender_id', 'receiver_id', 'content', 'datetime')
+
+
+class ConversationSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    last_message = LastMessageSerializer(read_only=True)
+
+    class Meta:
+        model = UserConversation
+        fields = ('peer_id', 'unread', 'last_message')
+        list_serializer_class = TimedListSerializer
+
+
+class MessageFastSerializer(object):
+    """
+    Opt-in replacement of `MessageUserDetailsSerializer` for `MessageRow` tuples.
+
+    Builds the same representation straight from the tuples, without model
+    instances or per-field serializers; `is_new` comes from `watermarks`.
+    """
+
+    def __init__(self, instance, watermarks=None, **kwargs):
+        self.instance = instance
+        self.watermarks = watermarks or {}
+
+    @property
+    def data(self):
+        format_datetime = serializers.DateTimeField().to_representation
+        watermarks = self.watermarks
+
+        with span('serializer'):
+            return [
+                OrderedDict((
+                    ('id', row.id),
+                    ('sender_id', row.sender_id),
+                    ('receiver_id', row.receiver_id),
+                    ('content', row.content),
+                    ('datetime', format_datetime(row.datetime)),
+                    ('is_new', row.id > watermarks.get(row.receiver_id, 0)),
+                ))
+                for row in self.instance
+            ]
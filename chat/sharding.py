@@ -0,0 +1,128 @@
+# encoding: utf-8
+"""
+Placement of conversations on the databases of `settings.CHAT_SHARDS`.
+
+The messages, archived messages and per-user state (`UserConversation`) of a
+conversation live together on one shard, picked by a hash of the
+conversation key, so the queries and transactions of a conversation never
+span databases. Users, unread counters and sequences stay on the default
+database; message ids come from a sequence there once there are several
+shards, so they stay unique when conversations move between shards.
+
+Changing `CHAT_SHARDS` moves conversations, `python manage.py
+rebalance_shards` copies them where they now belong.
+"""
+from __future__ import unicode_literals
+
+import zlib
+from collections import OrderedDict
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+
+def get_shards():
+    return list(settings.CHAT_SHARDS)
+
+
+def is_sharded():
+    return get_shards() != [DEFAULT_DB_ALIAS]
+
+
+def get_shard(conversation_key, shards=None):
+    """
+    Alias of the database holding the conversation `conversation_key`.
+    """
+    if shards is None:
+        shards = get_shards()
+
+    # crc32, unlike hash(), is the same in every process and Python version.
+    return shards[(zlib.crc32(conversation_key.encode('utf-8')) & 0xffffffff) % len(shards)]
+
+
+def group_by_shard(items, get_key=lambda item: item):
+    """
+    `items` grouped by the shard of their conversation key, `get_key(item)`.
+    """
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(get_shard(get_key(item)), []).append(item)
+
+    return groups
+
+
+def using(queryset, alias):
+    """
+    `queryset`, or all objects of a manager, on the database `alias`.
+
+    The default database is left to the database routers, which may send
+    reads to a replica.
+    """
+    if alias == DEFAULT_DB_ALIAS:
+        return queryset.all()
+
+    return queryset.using(alias)
+
+
+def for_conversation(queryset, conversation_key):
+    return using(queryset, get_shard(conversation_key))
+
+
+def atomic(alias):
+    """
+    Transaction on the shard `alias`, nested in one on the default database.
+
+    The default shard shares the outer transaction instead of adding a savepoint.
+    """
+    return transaction.atomic(using=alias, savepoint=alias != DEFAULT_DB_ALIAS)
+
+
+def on_all_shards(queryset):
+    """
+    `queryset` run on every shard, see `ShardedQuerySet`; unchanged with a single shard.
+    """
+    if not is_sharded():
+        return queryset
+
+    return ShardedQuerySet([using(queryset, alias) for alias in get_shards()])
+
+
+class ShardedQuerySet(object):
+    """
+    The same query on several shards, its results merged in the order of `order_by`.
+
+    Supports what keyset and offset pagination need: `filter`, `order_by`
+    and `[start:stop]` slices, which fetch `stop` rows from every shard.
+    """
+
+    def __init__(self, querysets, ordering=()):
+        self.querysets = querysets
+        self.ordering = ordering
+
+    def filter(self, *args, **kwargs):
+        return ShardedQuerySet([qs.filter(*args, **kwargs) for qs in self.querysets], self.ordering)
+
+    def order_by(self, *fields):
+        return ShardedQuerySet([qs.order_by(*fields) for qs in self.querysets], fields)
+
+    def count(self):
+        return sum(qs.count() for qs in self.querysets)
+
+    def __iter__(self):
+        return iter(self._merge([row for qs in self.querysets for row in qs]))
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None or item.stop is None:
+            raise TypeError('Only [start:stop] slices of a sharded queryset are supported.')
+
+        rows = self._merge([row for qs in self.querysets for row in qs[:item.stop]])
+
+        return rows[item.start or 0:item.stop]
+
+    def _merge(self, rows):
+        # Stable sorts from the last field to the first, each in its own direction.
+        for field in reversed(self.ordering):
+            rows.sort(key=attrgetter(field.lstrip('-')), reverse=field.startswith('-'))
+
+        return rows
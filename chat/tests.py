@@ -1,14 +1,48 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from calendar import timegm
+from collections import OrderedDict
+from datetime import timedelta
+
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from django.utils import timezone
+from django.utils.http import http_date
+from django.utils.six import StringIO
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITransactionTestCase
 
-from chat.models import Message
+from chat import cache as chat_cache, jobs, sharding
+from chat.cache import unread_count_stats
+from chat.models import ArchivedMessage, Job, Message, UnreadCounter, UserConversation, get_conversation_key
+from chat.notifier import InProcessNotifier, UnixSocketNotifier, check_job_notifier, get_notifier
+from chat.serializers import MessageFastSerializer, MessageUserDetailsSerializer
+from chat.workers import Worker
 
 
-class MessageAPITestCase(APITestCase):
+# Jobs run on commit, no worker needed; `JobQueueTestCase` stores them.
+@override_settings(CHAT_JOBS_EAGER=True)
+class MessageAPITestCase(APITransactionTestCase):
     url_login = reverse('accounts:login')
 
     def setUp(self):
+        cache.clear()
+        unread_count_stats.reset()
+
         self.user_1 = User.objects.create_user('user_1', password='user_1_p')
         self.user_2 = User.objects.create_user('user_2', password='user_2_p')
 
@@ -111,11 +145,11 @@ class MessageListApiViewTestCase(MessageAPITestCase):
 
         self._login('user_1', 'user_1_p')
 
-        url_list = reverse('chat:list', args=(self.user_1.id,))
+        url_list = reverse('chat:list', args=(self.user_2.id,))
         response_first = self.client.get(url_list)
         self.assertEqual(200, response_first.status_code)
 
-        messages_first = response_first.json()
+        messages_first = response_first.json()['results']
 
         self.assertEqual(3, len(messages_first))
 
@@ -127,7 +161,7 @@ class MessageListApiViewTestCase(MessageAPITestCase):
         response_snd = self.client.get(url_list)
         self.assertEqual(200, response_snd.status_code)
 
-        messages_snd = response_snd.json()
+        messages_snd = response_snd.json()['results']
 
         self.assertEqual(3, len(messages_snd))
 
@@ -145,7 +179,7 @@ class MessageListApiViewTestCase(MessageAPITestCase):
         response_first = self.client.get(url_list)
         self.assertEqual(200, response_first.status_code)
 
-        messages_first = response_first.json()
+        messages_first = response_first.json()['results']
 
         self.assertEqual(3, len(messages_first))
 
@@ -157,7 +191,7 @@ class MessageListApiViewTestCase(MessageAPITestCase):
         response_snd = self.client.get(url_list)
         self.assertEqual(200, response_snd.status_code)
 
-        messages_snd = response_snd.json()
+        messages_snd = response_snd.json()['results']
 
         self.assertEqual(3, len(messages_snd))
 
@@ -166,6 +200,25 @@ class MessageListApiViewTestCase(MessageAPITestCase):
             self.assertEqual(self.user_2.id, msg['receiver_id'])
             self.assertEqual(False, msg['is_new'])
 
+    def test_get_conversation_excludes_other_users(self):
+        user_3 = User.objects.create_user('user_3', password='user_3_p')
+        self._create_messages(self.user_1, self.user_2, 2)
+        self._create_messages(self.user_2, self.user_1, 1)
+        self._create_messages(self.user_1, user_3, 4)
+        self._create_messages(user_3, self.user_2, 5)
+
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        messages = self.client.get(url_list).json()['results']
+
+        self.assertEqual(3, len(messages))
+        for msg in messages:
+            self.assertEqual(
+                set([self.user_1.id, self.user_2.id]),
+                set([msg['sender_id'], msg['receiver_id']])
+            )
+
     def test_get_unread_count_sender(self):
         self._create_messages(self.user_1, self.user_2, 3)
         self._login('user_1', 'user_1_p')
@@ -188,3 +241,1411 @@ class MessageListApiViewTestCase(MessageAPITestCase):
         response_snd = self.client.get(self.url_message_create)
         response_snd_json = response_snd.json()
         self.assertEqual(0, response_snd_json['unread'])
+
+
+class MessageListPaginationTestCase(MessageAPITestCase):
+    def _create_messages(self, sender, receiver, count=1):
+        for i in xrange(0, count):
+            Message.objects.send(sender, receiver, 'msg {}'.format(i))
+
+    def test_page_size_cap(self):
+        self._create_messages(self.user_1, self.user_2, 5)
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        response = self.client.get(url_list, {'page_size': 2})
+        self.assertEqual(200, response.status_code)
+
+        response_json = response.json()
+        self.assertEqual(2, len(response_json['results']))
+        self.assertIsNotNone(response_json['next'])
+        self.assertIsNone(response_json['previous'])
+
+    def test_forward_and_backward_cursors(self):
+        self._create_messages(self.user_1, self.user_2, 5)
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        expected_ids = list(
+            Message.objects.order_by('-datetime', '-id').values_list('id', flat=True)
+        )
+
+        seen_ids = []
+        pages = []
+        url = url_list + '?page_size=2'
+        while url:
+            response_json = self.client.get(url).json()
+            pages.append(response_json)
+            seen_ids.extend(msg['id'] for msg in response_json['results'])
+            url = response_json['next']
+
+        self.assertEqual(expected_ids, seen_ids)
+        self.assertEqual(3, len(pages))
+
+        response_json = self.client.get(pages[-1]['previous']).json()
+        self.assertEqual(
+            [msg['id'] for msg in pages[1]['results']],
+            [msg['id'] for msg in response_json['results']]
+        )
+
+    def test_invalid_cursor(self):
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        response = self.client.get(url_list, {'cursor': 'not-a-cursor'})
+        self.assertEqual(404, response.status_code)
+
+    def test_mark_as_read_only_returned_page(self):
+        self._create_messages(self.user_1, self.user_2, 3)
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        response = self.client.get(url_list, {'page_size': 2})
+
+        # The read watermark cannot pass the oldest message, which was not returned.
+        self.assertEqual(3, self.client.get(reverse('chat:messages')).json()['unread'])
+
+        # The next page returns it; the newer ones were returned by another request.
+        self.client.get(response.json()['next'])
+        self.assertEqual(2, self.client.get(reverse('chat:messages')).json()['unread'])
+
+        self.client.get(url_list, {'page_size': 2})
+        self.assertEqual(0, self.client.get(reverse('chat:messages')).json()['unread'])
+
+    def test_mark_as_read_up_to_first_gap(self):
+        messages = [Message.objects.send(self.user_1, self.user_2, 'msg {}'.format(i)) for i in xrange(0, 4)]
+
+        marked = Message.objects.mark_read(
+            self.user_2, self.user_1, messages[3].pk, received_ids={messages[0].pk, messages[1].pk, messages[3].pk}
+        )
+
+        self.assertEqual(2, marked)
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(messages[1].pk, Message.objects.get_read_watermarks(self.user_2, self.user_1)[self.user_2.pk])
+
+
+class UnreadCounterTestCase(MessageAPITestCase):
+    def test_counters_follow_send_and_read(self):
+        user_3 = User.objects.create_user('user_3', password='user_3_p')
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        Message.objects.send(self.user_1, self.user_2, 'Bar')
+        Message.objects.send(user_3, self.user_2, 'Baz')
+
+        self.assertEqual(3, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2, self.user_1))
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_2, user_3))
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_1))
+
+        self._login('user_2', 'user_2_p')
+        self.client.get(reverse('chat:list', args=(self.user_1.id,)))
+
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2, self.user_1))
+
+        self.client.get(reverse('chat:list', args=(self.user_1.id,)))
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_2))
+
+    def test_unread_endpoint_queries(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_2', 'user_2_p')
+
+        cache.clear()
+
+        # Authenticated user lookup plus the counter primary-key lookup.
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('chat:messages'))
+
+        self.assertEqual(1, response.json()['unread'])
+
+    def test_unread_endpoint_served_from_cache(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_2', 'user_2_p')
+        self.client.get(reverse('chat:messages'))
+
+        # The first read cached the count, only the user lookup is left.
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('chat:messages'))
+
+        self.assertEqual(1, response.json()['unread'])
+        self.assertEqual(1, unread_count_stats.snapshot()['hits'])
+
+    def test_unread_cache_forgotten_on_send_and_read(self):
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'hit_ratio': 0.5},
+            unread_count_stats.snapshot()
+        )
+
+        message = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self.assertIsNone(cache.get('chat:unread:{}:generation'.format(self.user_2.pk)))
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_2))
+
+        Message.objects.mark_read(self.user_2, self.user_1, message.pk)
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(3, unread_count_stats.snapshot()['misses'])
+
+    def test_unread_cache_load_racing_commit(self):
+        def load():
+            # The count is read, then a send commits before it is stored.
+            unread = Message.objects._load_unread_count(self.user_2.pk)
+            Message.objects.send(self.user_1, self.user_2, 'Foo')
+            return unread
+
+        self.assertEqual(0, chat_cache.get_unread_count(self.user_2.pk, load))
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_2))
+
+    def test_rebuild_command(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        Message.objects.send(self.user_1, self.user_2, 'Bar')
+        UnreadCounter.objects.filter(pk=self.user_2.pk).update(unread=7)
+        UserConversation.objects.all().delete()
+        cache.clear()
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+        self.assertEqual(7, Message.objects.get_unread_count(self.user_2))
+
+        call_command('rebuild_unread_counters', stdout=StringIO())
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2, self.user_1))
+
+
+class MessageSyncTestCase(MessageAPITestCase):
+    def test_sync_tokens_are_monotonic(self):
+        first = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        second = Message.objects.send(self.user_2, self.user_1, 'Bar')
+
+        self.assertLess(first.sync_token, second.sync_token)
+
+        Message.objects.mark_read(self.user_2, self.user_1, first.pk)
+        conversation = UserConversation.objects.get(user=self.user_2)
+
+        self.assertLess(second.sync_token, conversation.sync_token)
+        self.assertIsNotNone(first.created_at)
+
+    def test_since_returns_new_messages_and_read_state_changes(self):
+        first = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        response_json = self.client.get(url_list, {'since': 0}).json()
+        self.assertEqual([first.id], [msg['id'] for msg in response_json['results']])
+        self.assertFalse(response_json['has_more'])
+        token = response_json['sync_token']
+
+        response_json = self.client.get(url_list, {'since': token}).json()
+        self.assertEqual([], response_json['results'])
+        self.assertEqual(token, response_json['sync_token'])
+
+        second = Message.objects.send(self.user_1, self.user_2, 'Bar')
+        Message.objects.mark_read(self.user_2, self.user_1, first.pk)
+
+        response_json = self.client.get(url_list, {'since': token}).json()
+        self.assertEqual(
+            [(second.id, True)],
+            [(msg['id'], msg['is_new']) for msg in response_json['results']]
+        )
+        self.assertEqual(
+            [{'user_id': self.user_2.id, 'last_read_id': first.id}],
+            response_json['read_state']
+        )
+
+        response_json = self.client.get(url_list, {'since': response_json['sync_token']}).json()
+        self.assertEqual([], response_json['results'])
+        self.assertEqual([], response_json['read_state'])
+
+    def test_since_marks_received_messages_as_read(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        response_json = self.client.get(url_list, {'since': 0}).json()
+        self.assertTrue(response_json['results'][0]['is_new'])
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2))
+
+        response_json = self.client.get(url_list, {'since': response_json['sync_token']}).json()
+        self.assertEqual([], response_json['results'])
+        self.assertEqual(
+            [{'user_id': self.user_2.id, 'last_read_id': Message.objects.get().id}],
+            response_json['read_state']
+        )
+
+    def test_since_page_size(self):
+        for i in xrange(0, 3):
+            Message.objects.send(self.user_1, self.user_2, 'msg {}'.format(i))
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        response_json = self.client.get(url_list, {'since': 0, 'page_size': 2}).json()
+        self.assertEqual(2, len(response_json['results']))
+        self.assertTrue(response_json['has_more'])
+
+    def test_invalid_since(self):
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        response = self.client.get(url_list, {'since': 'yesterday'})
+        self.assertEqual(400, response.status_code)
+
+        response = self.client.get(url_list, {'since': '99999999999999999999999'})
+        self.assertEqual(400, response.status_code)
+        response = self.client.get(url_list, {'since': 2 ** 63 - 1})
+        self.assertEqual(200, response.status_code)
+
+
+class NotifierTestCase(APITransactionTestCase):
+    def test_in_process_notifier(self):
+        notifier = InProcessNotifier()
+
+        with notifier.subscribe(1) as subscription:
+            self.assertFalse(subscription.wait(0))
+
+            notifier.publish(2)
+            self.assertFalse(subscription.wait(0))
+
+            notifier.publish(1)
+            self.assertTrue(subscription.wait(0))
+
+        self.assertEqual({}, dict(notifier._subscriptions))
+
+    def test_unix_socket_notifier(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        class OtherProcessNotifier(UnixSocketNotifier):
+            socket_path = os.path.join(directory, 'other.sock')
+
+        subscriber = UnixSocketNotifier(directory=directory)
+        publisher = OtherProcessNotifier(directory=directory)
+
+        with subscriber.subscribe(1) as subscription:
+            publisher.publish(1)
+            self.assertTrue(subscription.wait(5))
+
+        open(os.path.join(directory, '999999.sock'), 'w').close()
+        publisher.publish(1)
+        self.assertFalse(os.path.exists(os.path.join(directory, '999999.sock')))
+
+    def test_in_process_notifier_needs_eager_jobs(self):
+        in_process = {'BACKEND': 'chat.notifier.InProcessNotifier'}
+
+        with self.settings(CHAT_NOTIFIER=in_process, CHAT_JOBS_EAGER=False):
+            self.assertEqual(['chat.E001'], [error.id for error in check_job_notifier(None)])
+        with self.settings(CHAT_NOTIFIER=in_process, CHAT_JOBS_EAGER=True):
+            self.assertEqual([], check_job_notifier(None))
+        with self.settings(CHAT_JOBS_EAGER=False):
+            self.assertEqual([], check_job_notifier(None))
+
+
+class MessageWaitApiViewTestCase(MessageAPITestCase):
+    url_wait = reverse('chat:wait')
+
+    def test_get_unauthorized(self):
+        response = self.client.get(self.url_wait)
+
+        self.assertEqual(403, response.status_code)
+
+    def test_timeout(self):
+        self._login('user_2', 'user_2_p')
+
+        response = self.client.get(self.url_wait, {'timeout': 0})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'changed': False, 'sync_token': 0, 'unread': 0}, response.json())
+
+    def test_returns_immediately_when_behind(self):
+        message = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_2', 'user_2_p')
+
+        response = self.client.get(self.url_wait, {'since': 0, 'timeout': 25})
+
+        self.assertEqual(
+            {'changed': True, 'sync_token': message.sync_token, 'unread': 1},
+            response.json()
+        )
+
+    def test_woken_by_send(self):
+        self._login('user_2', 'user_2_p')
+
+        # The in-memory test database is only reachable through this connection.
+        connection = connections['default']
+        connection.allow_thread_sharing = True
+        self.addCleanup(setattr, connection, 'allow_thread_sharing', False)
+
+        def send():
+            connections['default'] = connection
+            time.sleep(0.2)
+            Message.objects.send(self.user_1, self.user_2, 'Foo')
+
+        thread = threading.Thread(target=send)
+        thread.start()
+
+        started = time.time()
+        response = self.client.get(self.url_wait, {'timeout': 10})
+        thread.join()
+
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(response.json()['changed'])
+        self.assertEqual(1, response.json()['unread'])
+
+
+class MessageBulkSendTestCase(MessageAPITestCase):
+    url_bulk = reverse('chat:bulk')
+
+    def test_send_many(self):
+        user_3 = User.objects.create_user('user_3', password='user_3_p')
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+
+        # A fixed number of statements per batch, savepoints included.
+        with self.assertNumQueries(23):
+            results = Message.objects.send_many(
+                self.user_1, [self.user_2.id, 999, user_3.id, self.user_2.id], 'Notice'
+            )
+
+        self.assertEqual(
+            [(self.user_2.id, 'sent'), (999, 'invalid'), (user_3.id, 'sent')],
+            [(result['receiver'], result['status']) for result in results]
+        )
+        self.assertEqual('Notice', Message.objects.get(pk=results[0]['id']).content)
+        self.assertEqual(self.user_2.id, Message.objects.get(pk=results[0]['id']).receiver_id)
+
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2, self.user_1))
+        self.assertEqual(1, Message.objects.get_unread_count(user_3))
+        self.assertEqual(1, len(Message.objects.get_conversation(user_3, self.user_1)))
+
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+    def test_send_many_batches(self):
+        receivers = [
+            User.objects.create_user('receiver_{}'.format(i)).id
+            for i in xrange(0, 5)
+        ]
+
+        results = Message.objects.send_many(self.user_1, receivers, 'Notice', batch_size=2)
+
+        self.assertEqual(5, len(set(result['id'] for result in results)))
+        sync_tokens = list(Message.objects.order_by('id').values_list('sync_token', flat=True))
+        self.assertEqual(sorted(sync_tokens), sync_tokens)
+        self.assertEqual(5, len(set(sync_tokens)))
+
+    def test_bulk_endpoint(self):
+        self._login('user_1', 'user_1_p')
+
+        response = self.client.post(
+            self.url_bulk,
+            {'receivers': [self.user_2.id, 999], 'content': 'Notice'},
+            format='json'
+        )
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(
+            ['sent', 'invalid'],
+            [result['status'] for result in response.json()['results']]
+        )
+
+        self._login('user_2', 'user_2_p')
+        self.assertEqual(1, self.client.get(reverse('chat:messages')).json()['unread'])
+
+    def test_bulk_endpoint_invalid(self):
+        self._login('user_1', 'user_1_p')
+
+        response = self.client.post(self.url_bulk, {'receivers': [], 'content': 'Notice'}, format='json')
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn('receivers', response.json())
+
+
+class MessageListStreamTestCase(MessageAPITestCase):
+    def _stream(self, url, **params):
+        params['stream'] = 1
+        response = self.client.get(url, params)
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEqual('application/json', response['Content-Type'])
+
+        return json.loads(b''.join(response.streaming_content).decode('utf-8'))
+
+    @override_settings(CHAT_STREAM_CHUNK_SIZE=2)
+    def test_stream_matches_pages(self):
+        for i in xrange(0, 5):
+            Message.objects.send(self.user_1, self.user_2, 'msg {}'.format(i))
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        paginated = self.client.get(url_list).json()['results']
+
+        self.assertEqual(paginated, self._stream(url_list))
+
+    def test_stream_empty_conversation(self):
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        self.assertEqual([], self._stream(url_list))
+
+    @override_settings(CHAT_STREAM_CHUNK_SIZE=2)
+    def test_stream_marks_as_read(self):
+        for i in xrange(0, 3):
+            Message.objects.send(self.user_1, self.user_2, 'msg {}'.format(i))
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        messages = self._stream(url_list)
+
+        self.assertEqual([True] * 3, [msg['is_new'] for msg in messages])
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2))
+
+    def test_iter_chunks(self):
+        for i in xrange(0, 5):
+            Message.objects.send(self.user_1, self.user_2, 'msg {}'.format(i))
+
+        conversation = Message.objects.get_conversation(self.user_1, self.user_2)
+        chunks = list(Message.objects.iter_chunks(conversation, 2))
+
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in chunks])
+        self.assertEqual(
+            list(conversation.order_by('-datetime', '-id').values_list('id', flat=True)),
+            [msg.id for chunk in chunks for msg in chunk]
+        )
+
+
+class ReadWatermarkTestCase(MessageAPITestCase):
+    def test_mark_read_is_single_row_update(self):
+        messages = [Message.objects.send(self.user_1, self.user_2, 'msg {}'.format(i)) for i in xrange(0, 5)]
+
+        # Read the watermark, count the covered messages, then move the sequence,
+        # the watermark and the user counter; no message row is rewritten.
+        with self.assertNumQueries(9):
+            marked = Message.objects.mark_read(self.user_2, self.user_1, messages[2].pk)
+
+        self.assertEqual(3, marked)
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2))
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_2, self.user_1))
+
+        self.assertEqual(0, Message.objects.mark_read(self.user_2, self.user_1, messages[1].pk))
+        self.assertEqual(2, Message.objects.mark_read(self.user_2, self.user_1, messages[4].pk))
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2))
+
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+    def test_read_state_is_derived(self):
+        first = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        second = Message.objects.send(self.user_2, self.user_1, 'Bar')
+        Message.objects.mark_read(self.user_2, self.user_1, first.pk)
+
+        watermarks = Message.objects.get_read_watermarks(self.user_1, self.user_2)
+        Message.objects.annotate_read_state([first, second], watermarks)
+
+        self.assertFalse(first.is_new)
+        self.assertTrue(second.is_new)
+
+    def test_mark_read_without_conversation(self):
+        self.assertEqual(0, Message.objects.mark_read(self.user_2, self.user_1, 10))
+        self.assertFalse(UserConversation.objects.exists())
+
+
+class MessageFastSerializerTestCase(MessageAPITestCase):
+    def setUp(self):
+        super(MessageFastSerializerTestCase, self).setUp()
+
+        Message.objects.send(self.user_1, self.user_2, u'Za\u017c\xf3\u0142\u0107 "g\u0119\u015bl\u0105" ja\u017a\u0144')
+        reply = Message.objects.send(self.user_2, self.user_1, 'Foo\nBar')
+        Message.objects.send(self.user_1, self.user_2, '')
+        Message.objects.mark_read(self.user_1, self.user_2, reply.pk)
+
+    def test_output_is_identical(self):
+        conversation = Message.objects.get_conversation(self.user_1, self.user_2)
+        watermarks = Message.objects.get_read_watermarks(self.user_1, self.user_2)
+
+        messages = list(conversation)
+        Message.objects.annotate_read_state(messages, watermarks)
+        rows = list(Message.objects.as_rows(conversation))
+
+        renderer = JSONRenderer()
+        self.assertEqual(
+            renderer.render(MessageUserDetailsSerializer(messages, many=True).data),
+            renderer.render(MessageFastSerializer(rows, watermarks=watermarks).data)
+        )
+
+    def test_rows_quack_like_messages(self):
+        message = Message.objects.get_conversation(self.user_1, self.user_2).first()
+        row = Message.objects.as_rows(Message.objects.get_conversation(self.user_1, self.user_2)).first()
+
+        for field in ('pk', 'id', 'sender_id', 'receiver_id', 'content', 'datetime', 'sync_token'):
+            self.assertEqual(getattr(message, field), getattr(row, field))
+
+    def test_endpoint_output_is_identical(self):
+        self._login('user_1', 'user_1_p')
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+
+        for params in ({}, {'page_size': 2}, {'since': 0}, {'stream': 1}):
+            response = self.client.get(url_list, params)
+            with override_settings(CHAT_FAST_SERIALIZER=True):
+                fast_response = self.client.get(url_list, params)
+
+            if response.streaming:
+                self.assertEqual(
+                    b''.join(response.streaming_content), b''.join(fast_response.streaming_content)
+                )
+            else:
+                self.assertEqual(response.content, fast_response.content)
+
+    @override_settings(CHAT_FAST_SERIALIZER=True)
+    def test_marks_as_read(self):
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        response = self.client.get(url_list)
+        messages = json.loads(response.content.decode('utf-8'))['results']
+
+        self.assertEqual([True, False, True], [msg['is_new'] for msg in messages])
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_2))
+
+
+class ConditionalGetTestCase(MessageAPITestCase):
+    def test_unread_count_not_modified(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_2', 'user_2_p')
+
+        url = reverse('chat:messages')
+        response = self.client.get(url)
+        etag = response['ETag']
+
+        self.assertTrue(etag.startswith('"'))
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        Message.objects.send(self.user_1, self.user_2, 'Bar')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, response.data['unread'])
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_list_not_modified_after_mark_read(self):
+        message = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        Message.objects.filter(pk=message.pk).update(datetime=message.datetime.replace(microsecond=0))
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        response = self.client.get(url_list)
+        self.assertTrue(response.has_header('Last-Modified'))
+        # The next page shows the message as read, an equivalent representation.
+        self.assertTrue(response['ETag'].startswith('W/"'))
+
+        # Reading the page moved the caller's watermark, the page is still current.
+        response = self.client.get(url_list, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.content)
+
+        response = self.client.get(url_list, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(304, response.status_code)
+
+    def test_list_modified_in_same_second(self):
+        first = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        sent_at = first.datetime.replace(microsecond=100000)
+        Message.objects.filter(pk=first.pk).update(datetime=sent_at)
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        last_modified = self.client.get(url_list)['Last-Modified']
+        self.assertEqual(304, self.client.get(url_list, HTTP_IF_MODIFIED_SINCE=http_date(
+            timegm(sent_at.utctimetuple()) + 1
+        )).status_code)
+
+        second = Message.objects.send(self.user_1, self.user_2, 'Bar')
+        Message.objects.filter(pk=second.pk).update(datetime=sent_at.replace(microsecond=900000))
+
+        response = self.client.get(url_list, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['Bar', 'Foo'], [message['content'] for message in response.data['results']])
+
+    def test_list_changes_invalidate(self):
+        first = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_1', 'user_1_p')
+
+        url_list = reverse('chat:list', args=(self.user_2.id,))
+        etag = self.client.get(url_list)['ETag']
+
+        # The peer reading the message changes its `is_new`.
+        Message.objects.mark_read(self.user_2, self.user_1, first.pk)
+        response = self.client.get(url_list, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.data['results'][0]['is_new'])
+
+        etag = response['ETag']
+        Message.objects.send(self.user_2, self.user_1, 'Bar')
+        self.assertEqual(200, self.client.get(url_list, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        # Another page of the same conversation has its own validator.
+        response = self.client.get(url_list, {'page_size': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
+    def test_not_modified_still_marks_read(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_2', 'user_2_p')
+
+        url_list = reverse('chat:list', args=(self.user_1.id,))
+        etag = self.client.get(url_list)['ETag']
+
+        # A client that fetched the page before, e.g. from another device.
+        UserConversation.objects.filter(user=self.user_2).update(last_read_id=0)
+
+        self.assertEqual(304, self.client.get(url_list, HTTP_IF_NONE_MATCH=etag).status_code)
+        self.assertEqual(
+            Message.objects.get().pk,
+            Message.objects.get_read_watermarks(self.user_2, self.user_1)[self.user_2.pk]
+        )
+
+
+class ConversationListApiViewTestCase(MessageAPITestCase):
+    url_inbox = reverse('chat:conversations')
+
+    def _inbox(self, **params):
+        response = self.client.get(self.url_inbox, params)
+        self.assertEqual(200, response.status_code)
+
+        return response.data
+
+    def test_get_unauthorized(self):
+        response = self.client.get(self.url_inbox)
+
+        self.assertEqual(403, response.status_code)
+
+    def test_inbox(self):
+        user_3 = User.objects.create_user('user_3')
+        User.objects.create_user('user_4', password='user_4_p')
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        Message.objects.send(user_3, self.user_1, 'Bar')
+        Message.objects.send(user_3, self.user_1, 'Baz')
+        last = Message.objects.send(self.user_2, self.user_1, 'Qux')
+        Message.objects.send(user_3, self.user_2, 'Not for user_1')
+        self._login('user_1', 'user_1_p')
+
+        results = self._inbox()['results']
+
+        self.assertEqual(
+            [(self.user_2.id, 1, 'Qux'), (user_3.id, 2, 'Baz')],
+            [(result['peer_id'], result['unread'], result['last_message']['content']) for result in results]
+        )
+        self.assertEqual(
+            {'id': last.pk, 'sender_id': self.user_2.id, 'receiver_id': self.user_1.id},
+            dict((key, results[0]['last_message'][key]) for key in ('id', 'sender_id', 'receiver_id'))
+        )
+
+        # Sending moves the conversation to the top of both participants' inboxes.
+        Message.objects.send(self.user_1, user_3, 'Reply')
+        self.assertEqual([user_3.id, self.user_2.id], [result['peer_id'] for result in self._inbox()['results']])
+
+        self._login('user_4', 'user_4_p')
+        self.assertEqual([], self._inbox()['results'])
+
+    def test_reading_clears_unread(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        self._login('user_2', 'user_2_p')
+
+        self.assertEqual(1, self._inbox()['results'][0]['unread'])
+
+        self.client.get(reverse('chat:list', args=(self.user_1.id,)))
+
+        self.assertEqual(0, self._inbox()['results'][0]['unread'])
+
+    def test_pagination(self):
+        peers = [User.objects.create_user('peer_{}'.format(i)) for i in range(5)]
+        for peer in peers:
+            Message.objects.send(peer, self.user_1, 'Hi')
+        self._login('user_1', 'user_1_p')
+
+        data = self._inbox(page_size=2)
+        peer_ids = [result['peer_id'] for result in data['results']]
+        while data['next']:
+            response = self.client.get(data['next'])
+            data = response.data
+            peer_ids.extend(result['peer_id'] for result in data['results'])
+
+        self.assertEqual([peer.id for peer in reversed(peers)], peer_ids)
+
+    def test_queries_do_not_grow_with_peers(self):
+        self._login('user_1', 'user_1_p')
+
+        def count_queries():
+            with CaptureQueriesContext(connections['default']) as queries:
+                self._inbox()
+
+            return len(queries)
+
+        Message.objects.send(self.user_2, self.user_1, 'Hi')
+        queries = count_queries()
+
+        for i in range(5):
+            Message.objects.send(User.objects.create_user('peer_{}'.format(i)), self.user_1, 'Hi')
+
+        self.assertEqual(queries, count_queries())
+
+    def test_send_many_and_rebuild(self):
+        user_3 = User.objects.create_user('user_3', password='user_3_p')
+        Message.objects.send(user_3, self.user_1, 'Foo')
+        Message.objects.send_many(self.user_1, [self.user_2.id, user_3.id], 'Notice')
+
+        self._login('user_1', 'user_1_p')
+        expected = [(result['peer_id'], result['last_message']['content']) for result in self._inbox()['results']]
+        self.assertEqual(set([(self.user_2.id, 'Notice'), (user_3.id, 'Notice')]), set(expected))
+
+        UserConversation.objects.filter(user=self.user_1).delete()
+        UserConversation.objects.update(last_message=None, last_message_at=None)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+        call_command('rebuild_unread_counters', stdout=StringIO())
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+        self.assertEqual(expected, [
+            (result['peer_id'], result['last_message']['content']) for result in self._inbox()['results']
+        ])
+
+
+class MessageSearchApiViewTestCase(MessageAPITestCase):
+    url_search = reverse('chat:search')
+
+    def setUp(self):
+        super(MessageSearchApiViewTestCase, self).setUp()
+
+        self.user_3 = User.objects.create_user('user_3', password='user_3_p')
+
+    def _search(self, **params):
+        response = self.client.get(self.url_search, params)
+        self.assertEqual(200, response.status_code)
+
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_get_unauthorized(self):
+        response = self.client.get(self.url_search, {'q': 'foo'})
+
+        self.assertEqual(403, response.status_code)
+
+    def test_snippet_escaped(self):
+        Message.objects.send(self.user_2, self.user_1, '<img src=x onerror=alert(1)> lunch & <mark>')
+        self._login('user_1', 'user_1_p')
+
+        result, = self._search(q='lunch')['results']
+
+        self.assertEqual('&lt;img src=x onerror=alert(1)&gt; <mark>lunch</mark> &amp; &lt;mark&gt;', result['snippet'])
+        self.assertEqual('<img src=x onerror=alert(1)> lunch & <mark>', result['content'])
+
+    def test_search(self):
+        Message.objects.send(self.user_1, self.user_2, 'Lunch at noon?')
+        best = Message.objects.send(self.user_2, self.user_1, 'Lunch, lunch, lunch!')
+        Message.objects.send(self.user_1, self.user_3, 'No lunch today')
+        Message.objects.send(self.user_2, self.user_3, 'Lunch without user_1')
+        Message.objects.send(self.user_1, self.user_2, 'Dinner')
+        self._login('user_1', 'user_1_p')
+
+        results = self._search(q='LUNCH')['results']
+
+        self.assertEqual(3, len(results))
+        self.assertEqual(best.pk, results[0]['id'])
+        self.assertEqual('<mark>Lunch</mark>, <mark>lunch</mark>, <mark>lunch</mark>!', results[0]['snippet'])
+        self.assertEqual(
+            ['No lunch today'],
+            [result['content'] for result in self._search(q='lunch', peer=self.user_3.id)['results']]
+        )
+
+        # All words must match, prefixes only with `*`.
+        self.assertEqual(['Lunch at noon?'], [result['content'] for result in self._search(q='noon lunch')['results']])
+        self.assertEqual([], self._search(q='lun')['results'])
+        self.assertEqual(3, len(self._search(q='lun*')['results']))
+
+    def test_index_follows_changes(self):
+        message = Message.objects.send(self.user_1, self.user_2, 'Foo')
+        Message.objects.send_many(self.user_1, [self.user_2.id, self.user_3.id], u'Za\u017c\xf3\u0142\u0107 foo')
+        self._login('user_1', 'user_1_p')
+
+        self.assertEqual(3, len(self._search(q='foo')['results']))
+        self.assertEqual(2, len(self._search(q=u'zaz\xf3\u0142\u0107')['results']))
+
+        message.content = 'Bar'
+        message.save()
+        self.assertEqual(2, len(self._search(q='foo')['results']))
+        self.assertEqual([message.pk], [result['id'] for result in self._search(q='bar')['results']])
+
+        message.delete()
+        self.assertEqual([], self._search(q='bar')['results'])
+
+    def test_query_syntax_is_escaped(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo or bar')
+        self._login('user_1', 'user_1_p')
+
+        # Operators are words like any other.
+        self.assertEqual(1, len(self._search(q='"foo" OR (bar')['results']))
+        self.assertEqual([], self._search(q='foo NOT bar')['results'])
+
+        response = self.client.get(self.url_search, {'q': '" ( *'})
+        self.assertEqual(400, response.status_code)
+        self.assertIn('q', response.json())
+
+    def test_pagination(self):
+        for i in range(5):
+            Message.objects.send(self.user_1, self.user_2, 'Foo {}'.format(i))
+        self._login('user_1', 'user_1_p')
+
+        data = self._search(q='foo', page_size=2)
+        self.assertIsNone(data['previous'])
+        ids = [result['id'] for result in data['results']]
+        while data['next']:
+            data = json.loads(self.client.get(data['next']).content.decode('utf-8'))
+            ids.extend(result['id'] for result in data['results'])
+
+        self.assertEqual(5, len(set(ids)))
+        self.assertIsNotNone(data['previous'])
+
+    def test_rebuild_command(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        with connections['default'].cursor() as cursor:
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('delete-all')")
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_search_index', verify=True, stdout=StringIO())
+
+        call_command('rebuild_search_index', optimize=True, stdout=StringIO())
+        call_command('rebuild_search_index', verify=True, stdout=StringIO())
+
+        self._login('user_1', 'user_1_p')
+        self.assertEqual(1, len(self._search(q='foo')['results']))
+
+
+class ArchiveTestCase(MessageAPITestCase):
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+
+        self.messages = [Message.objects.send(self.user_1, self.user_2, 'Old {}'.format(i)) for i in range(5)]
+        Message.objects.mark_read(self.user_2, self.user_1, self.messages[-2].pk)
+        # The last one stays unread.
+
+        old = timezone.now() - timedelta(days=400)
+        Message.objects.update(created_at=old)
+
+        self.messages.append(Message.objects.send(self.user_2, self.user_1, 'New'))
+
+    def _archive(self, **options):
+        call_command('archive_messages', stdout=StringIO(), chunk_size=2, **options)
+
+    def _pages(self, **params):
+        url = reverse('chat:list', args=(self.user_1.id,))
+        data = self.client.get(url, dict(params, page_size=2)).data
+        ids = [message['id'] for message in data['results']]
+        while data['next']:
+            data = self.client.get(data['next']).data
+            ids.extend(message['id'] for message in data['results'])
+
+        return ids
+
+    def test_archive(self):
+        self._archive(days=365)
+
+        # Read and old only; the unread one is also the last message sent to user_2.
+        self.assertEqual(
+            [message.pk for message in self.messages[:4]],
+            sorted(ArchivedMessage.objects.values_list('id', flat=True))
+        )
+        self.assertEqual(
+            [message.pk for message in self.messages[4:]],
+            sorted(Message.objects.values_list('id', flat=True))
+        )
+        self.assertEqual('Old 0', ArchivedMessage.objects.get(pk=self.messages[0].pk).content)
+
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_2))
+
+        # Nothing left to do.
+        self._archive(days=365)
+        self.assertEqual(4, ArchivedMessage.objects.count())
+
+    def test_retention_period(self):
+        self._archive(days=500)
+
+        self.assertEqual(0, ArchivedMessage.objects.count())
+
+    def test_pages_continue_into_archive(self):
+        self._login('user_2', 'user_2_p')
+        expected = self._pages()
+
+        self._archive(days=365)
+
+        self.assertEqual(expected, self._pages())
+        with override_settings(CHAT_FAST_SERIALIZER=True):
+            self.assertEqual(expected, self._pages())
+
+        # And back again.
+        url = reverse('chat:list', args=(self.user_1.id,))
+        data = self.client.get(url, {'page_size': 4}).data
+        data = self.client.get(data['next']).data
+        data = self.client.get(data['previous']).data
+        self.assertEqual(expected[:4], [message['id'] for message in data['results']])
+
+        response = self.client.get(url, {'stream': 1})
+        self.assertEqual(expected, [message['id'] for message in json.loads(b''.join(response.streaming_content))])
+
+    def test_pages_interleave_archived_and_unread(self):
+        for i in range(6):
+            Message.objects.send(self.user_2, self.user_1, 'Unread {}'.format(i))
+            last = Message.objects.send(self.user_1, self.user_2, 'Read {}'.format(i))
+        Message.objects.mark_read(self.user_2, self.user_1, last.pk)
+        Message.objects.update(created_at=timezone.now() - timedelta(days=400))
+        expected = list(Message.objects.order_by('-datetime', '-id').values_list('id', flat=True))
+
+        self._archive(days=365)
+
+        # The read ones but the last went to the archive, the unread ones stayed.
+        self.assertEqual(len(self.messages) - 1 + 5, ArchivedMessage.objects.count())
+        self._login('user_2', 'user_2_p')
+        self.assertEqual(expected, self._pages())
+
+        url = reverse('chat:list', args=(self.user_1.id,))
+        with override_settings(CHAT_STREAM_CHUNK_SIZE=2):
+            response = self.client.get(url, {'stream': 1})
+        self.assertEqual(expected, [message['id'] for message in json.loads(b''.join(response.streaming_content))])
+
+    def test_sync_includes_archive(self):
+        self._login('user_2', 'user_2_p')
+        url = reverse('chat:list', args=(self.user_1.id,))
+        expected = [message['id'] for message in self.client.get(url, {'since': 0}).json()['results']]
+
+        self._archive(days=365)
+
+        ids = []
+        data = {'sync_token': 0, 'has_more': True}
+        while data['has_more']:
+            data = self.client.get(url, {'since': data['sync_token'], 'page_size': 2}).json()
+            ids.extend(message['id'] for message in data['results'])
+
+        self.assertEqual(expected, ids)
+
+    def test_purge(self):
+        self._archive(days=365)
+        ArchivedMessage.objects.filter(pk=self.messages[0].pk).update(created_at=timezone.now())
+
+        self._archive(days=365, purge_days=30)
+
+        self.assertEqual([self.messages[0].pk], list(ArchivedMessage.objects.values_list('id', flat=True)))
+
+
+class MessageExportTestCase(MessageAPITestCase):
+    url_export = reverse('chat:export')
+
+    def setUp(self):
+        super(MessageExportTestCase, self).setUp()
+
+        self.user_3 = User.objects.create_user('user_3')
+        self.messages = [
+            Message.objects.send(self.user_1, self.user_2, u'Foo, "bar"\nZa\u017c\xf3\u0142\u0107'),
+            Message.objects.send(self.user_2, self.user_1, 'Baz'),
+            Message.objects.send(self.user_3, self.user_1, 'Qux'),
+            Message.objects.send(self.user_2, self.user_3, 'Not for user_1'),
+        ]
+
+    def _export(self, **params):
+        response = self.client.get(self.url_export, params)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+
+        return response, b''.join(response.streaming_content)
+
+    def test_get_unauthorized(self):
+        response = self.client.get(self.url_export)
+
+        self.assertEqual(403, response.status_code)
+
+    def test_jsonl(self):
+        self._login('user_1', 'user_1_p')
+        read_state = list(UserConversation.objects.values_list('unread', 'last_read_id', 'sync_token'))
+
+        response, content = self._export()
+
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        self.assertIn('messages.jsonl', response['Content-Disposition'])
+        records = [json.loads(line) for line in content.decode('utf-8').splitlines()]
+        self.assertEqual([message.pk for message in reversed(self.messages[:3])], [record['id'] for record in records])
+        self.assertEqual(self.messages[0].content, records[-1]['content'])
+
+        # Exporting is not reading.
+        self.assertEqual(read_state, list(UserConversation.objects.values_list('unread', 'last_read_id', 'sync_token')))
+        self.assertEqual(2, Message.objects.get_unread_count(self.user_1))
+
+    def test_csv_gzip_peer(self):
+        self._login('user_1', 'user_1_p')
+
+        response, content = self._export(export_format='csv', gzip=1, peer=self.user_2.id)
+
+        self.assertEqual('application/gzip', response['Content-Type'])
+        self.assertIn('messages.csv.gz', response['Content-Disposition'])
+        rows = list(csv.reader(io.BytesIO(gzip.GzipFile(fileobj=io.BytesIO(content)).read())))
+        self.assertEqual(['id', 'sender_id', 'receiver_id', 'content', 'datetime'], rows[0])
+        self.assertEqual(
+            [str(self.messages[1].pk), str(self.messages[0].pk)],
+            [row[0] for row in rows[1:]]
+        )
+        self.assertEqual(self.messages[0].content, rows[2][3].decode('utf-8'))
+
+    def test_invalid_format(self):
+        self._login('user_1', 'user_1_p')
+
+        response = self.client.get(self.url_export, {'export_format': 'xml'})
+
+        self.assertEqual(400, response.status_code)
+
+    def test_includes_archive(self):
+        Message.objects.mark_read(self.user_1, self.user_2, self.messages[1].pk)
+        Message.objects.send(self.user_1, self.user_2, 'Latest')
+        Message.objects.archive(timezone.now(), 10)
+        self.assertTrue(ArchivedMessage.objects.exists())
+
+        rows = list(Message.objects.iter_export(self.user_1, self.user_2))
+
+        self.assertEqual(
+            # The first message stays, user_2 has not read it yet.
+            ['Latest', self.messages[0].content, 'Baz'],
+            [row.content for row in rows]
+        )
+
+    def test_fetched_lazily(self):
+        rows = Message.objects.iter_export(self.user_1, chunk_size=1)
+
+        # The first sent and received chunks, then the next of the one taken from.
+        with self.assertNumQueries(3):
+            next(rows)
+        # One more received chunk, the empty ones ending them, and the archive.
+        with self.assertNumQueries(4):
+            self.assertEqual(2, len(list(rows)))
+
+    def test_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'export.jsonl.gz')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+
+        call_command('export_messages', 'user_1', gzip=True, output=path, chunk_size=2)
+
+        with gzip.open(path) as exported:
+            records = [json.loads(line.decode('utf-8')) for line in exported]
+        self.assertEqual([message.pk for message in reversed(self.messages[:3])], [record['id'] for record in records])
+
+        with self.assertRaises(CommandError):
+            call_command('export_messages', 'nobody', output=path)
+
+
+@override_settings(CHAT_SHARDS=['default', 'shard_1', 'shard_2'])
+class ShardingTestCase(MessageAPITestCase):
+    """
+    Two more SQLite files are the shards besides the default database.
+    """
+    multi_db = True
+    shard_aliases = ('shard_1', 'shard_2')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        for alias in cls.shard_aliases:
+            connections.databases[alias] = dict(
+                connection.settings_dict, NAME=os.path.join(cls.directory, alias + '.sqlite3'), TEST={}
+            )
+            call_command('migrate', database=alias, verbosity=0)
+
+        super(ShardingTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ShardingTestCase, cls).tearDownClass()
+
+        for alias in cls.shard_aliases:
+            connections[alias].close()
+            del connections.databases[alias]
+            del connections[alias]
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        super(ShardingTestCase, self).setUp()
+
+        self.peers = [self.user_2] + [User.objects.create_user('user_{}'.format(i)) for i in range(3, 9)]
+        # Ids depend on the tests run before; more users until every shard holds a conversation.
+        while True:
+            self.shards = dict(
+                (peer.pk, sharding.get_shard(get_conversation_key(self.user_1.pk, peer.pk))) for peer in self.peers
+            )
+            if set(self.shards.values()) == set(sharding.get_shards()) or len(self.peers) >= 30:
+                break
+            self.peers.append(User.objects.create_user('user_{}'.format(len(self.peers) + 2)))
+
+        self.assertEqual(set(sharding.get_shards()), set(self.shards.values()))
+
+    def _count(self, model, alias, peer):
+        key = get_conversation_key(self.user_1.pk, peer.pk)
+
+        return model.objects.using(alias).filter(conversation_key=key).count()
+
+    def _assert_placed(self, peers, messages_per_peer):
+        for peer in peers:
+            for alias in sharding.get_shards():
+                expected = alias == self.shards[peer.pk]
+                self.assertEqual(messages_per_peer if expected else 0, self._count(Message, alias, peer))
+                self.assertEqual(2 if expected else 0, self._count(UserConversation, alias, peer))
+
+    def test_send(self):
+        sent = []
+        for peer in self.peers:
+            sent.append(Message.objects.send(peer, self.user_1, 'Hello'))
+            sent.append(Message.objects.send(self.user_1, peer, 'Hi'))
+        Message.objects.send_many(self.user_1, [peer.pk for peer in self.peers], 'To all')
+
+        self._assert_placed(self.peers, 3)
+        ids = [message.pk for message in sent]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(len(self.peers), Message.objects.get_unread_count(self.user_1))
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_1, self.peers[-1]))
+        self.assertEqual(2, Message.objects.get_unread_count(self.peers[-1], self.user_1))
+        self.assertEqual(sent[-2].sync_token, Message.objects.get_sync_token(self.user_1))
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+        call_command('rebuild_search_index', verify=True, stdout=StringIO())
+
+    def test_api(self):
+        for i, peer in enumerate(self.peers):
+            Message.objects.send(peer, self.user_1, 'Lunch {}'.format(i))
+        self._login('user_1', 'user_1_p')
+
+        response = self.client.get(reverse('chat:messages'))
+        self.assertEqual(len(self.peers), response.data['unread'])
+
+        peer = self.peers[0]
+        response = self.client.post(reverse('chat:messages'), {'receiver': peer.pk, 'content': 'Lunch? Sure'})
+        self.assertEqual(201, response.status_code)
+        response = self.client.get(reverse('chat:list', args=(peer.pk,)))
+        self.assertEqual(['Lunch? Sure', 'Lunch 0'], [message['content'] for message in response.data['results']])
+        self.assertEqual(len(self.peers) - 1, self.client.get(reverse('chat:messages')).data['unread'])
+
+        # The inbox and search gather every shard, most recent and best first.
+        results = []
+        url = reverse('chat:conversations') + '?page_size=3'
+        while url:
+            response = self.client.get(url)
+            results.extend(response.data['results'])
+            url = response.data['next']
+        self.assertEqual([peer.pk] + [peer.pk for peer in reversed(self.peers[1:])], [r['peer_id'] for r in results])
+
+        response = self.client.get(reverse('chat:search'), {'q': 'lunch', 'page_size': 4})
+        self.assertEqual(4, len(response.data['results']))
+        found = len(response.data['results'])
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            found += len(response.data['results'])
+        self.assertEqual(len(self.peers) + 1, found)
+
+        response = self.client.get(reverse('chat:export'))
+        records = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        ids = [record['id'] for record in records]
+        self.assertEqual(len(self.peers) + 1, len(ids))
+        self.assertEqual(sorted(ids, reverse=True), ids)
+
+    def test_archive(self):
+        for peer in self.peers:
+            Message.objects.send(peer, self.user_1, 'Old')
+            Message.objects.send(peer, self.user_1, 'New')
+            Message.objects.mark_read(self.user_1, peer, Message.objects.get_max_id())
+        Message.objects.all().update(created_at=timezone.now() - timedelta(days=400))
+        for alias in self.shard_aliases:
+            Message.objects.using(alias).update(created_at=timezone.now() - timedelta(days=400))
+
+        call_command('archive_messages', stdout=StringIO(), chunk_size=2)
+
+        for peer in self.peers:
+            self.assertEqual(1, self._count(ArchivedMessage, self.shards[peer.pk], peer))
+            self.assertEqual(
+                ['New', 'Old'], [m.content for m in Message.objects.iter_export(self.user_1, peer)]
+            )
+
+    def test_rebalance(self):
+        with override_settings(CHAT_SHARDS=['default']):
+            for peer in self.peers:
+                Message.objects.send(peer, self.user_1, 'Before')
+                Message.objects.send(self.user_1, peer, 'Before')
+            Message.objects.mark_read(self.user_1, self.peers[0], Message.objects.get_max_id())
+        max_id = Message.objects.get_max_id()
+
+        output = StringIO()
+        call_command('rebalance_shards', dry_run=True, stdout=output)
+        moved = len([alias for alias in self.shards.values() if alias != 'default'])
+        self.assertIn('default: {} conversation(s) to move'.format(moved), output.getvalue())
+        self.assertEqual(0, Message.objects.using('shard_1').count())
+
+        call_command('rebalance_shards', chunk_size=1, stdout=StringIO())
+
+        self._assert_placed(self.peers, 2)
+        self.assertEqual(len(self.peers) - 1, Message.objects.get_unread_count(self.user_1))
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_1, self.peers[0]))
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+        peer = self.peers[-1]
+        message = Message.objects.send(peer, self.user_1, 'After')
+        self.assertGreater(message.pk, max_id)
+        self.assertEqual(message.pk, Message.objects.get_inbox(self.user_1)[:1][0].last_message_id)
+        self.assertEqual(['After', 'Before', 'Before'], [m.content for m in Message.objects.get_conversation(self.user_1, peer)])
+
+        # Draining a shard removed from the configuration.
+        with override_settings(CHAT_SHARDS=['shard_2']):
+            call_command('rebalance_shards', source=['default', 'shard_1'], stdout=StringIO())
+
+            self.assertEqual(0, Message.objects.count() + Message.objects.using('shard_1').count())
+            self.assertEqual(2 * len(self.peers) + 1, Message.objects.using('shard_2').count())
+            call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+    def test_no_foreign_keys_across_databases(self):
+        # Users are on `default` only, inserts on a PostgreSQL shard would fail.
+        with connections['shard_1'].cursor() as cursor:
+            for model in (Message, ArchivedMessage, UserConversation):
+                constraints = connections['shard_1'].introspection.get_constraints(cursor, model._meta.db_table)
+                self.assertEqual([], [name for name, constraint in constraints.items() if constraint['foreign_key']])
+
+    def test_rebalance_merges_read_state(self):
+        peer = next(peer for peer in self.peers if self.shards[peer.pk] != 'default')
+        with override_settings(CHAT_SHARDS=['default']):
+            Message.objects.send(peer, self.user_1, 'Before')
+
+        # Read on the new shard up to a message newer than the one left behind.
+        message = Message.objects.send(peer, self.user_1, 'After')
+        Message.objects.mark_read(self.user_1, peer, message.pk)
+        self.assertEqual(1, Message.objects.get_unread_count(self.user_1))
+
+        call_command('rebalance_shards', stdout=StringIO())
+
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_1))
+        self.assertEqual(0, Message.objects.get_unread_count(self.user_1, peer))
+        call_command('rebuild_unread_counters', verify=True, stdout=StringIO())
+
+
+@override_settings(CHAT_JOBS_EAGER=False, CHAT_JOB_MAX_ATTEMPTS=3, CHAT_JOB_RETRY_DELAY=2)
+class JobQueueTestCase(MessageAPITestCase):
+    def setUp(self):
+        super(JobQueueTestCase, self).setUp()
+
+        self.failures = []
+        jobs.HANDLERS['test.fail'] = self._fail
+        self.addCleanup(jobs.HANDLERS.pop, 'test.fail')
+
+        # Failures are expected, their tracebacks noise.
+        worker_logger = logging.getLogger('chat.workers')
+        worker_logger.disabled = True
+        self.addCleanup(setattr, worker_logger, 'disabled', False)
+
+    def _fail(self, payload):
+        self.failures.append(payload)
+        raise ValueError('Boom')
+
+    def _make_due(self):
+        Job.objects.update(run_at=timezone.now() - timedelta(seconds=1))
+
+    def test_send_enqueues_notification(self):
+        with get_notifier().subscribe(self.user_2.pk) as subscription:
+            Message.objects.send(self.user_1, self.user_2, 'Foo')
+            Message.objects.send(self.user_1, self.user_2, 'Bar')
+
+            # Queued once while pending, nobody woken yet.
+            job = Job.objects.get()
+            self.assertEqual(jobs.NOTIFY, job.name)
+            self.assertEqual({'user_ids': [self.user_2.pk]}, json.loads(job.payload))
+            self.assertFalse(subscription.wait(0))
+
+            self.assertEqual(1, Worker().run_once())
+
+            self.assertTrue(subscription.wait(0))
+            self.assertFalse(Job.objects.exists())
+
+    def test_claim_releases_key(self):
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        claimed = Job.objects.claim('worker', 10)
+
+        # Sent after the claim, may be missed by the running job.
+        Message.objects.send(self.user_1, self.user_2, 'Bar')
+
+        self.assertEqual(2, Job.objects.count())
+        self.assertIsNone(claimed[0].key)
+        self.assertEqual('notify:{}'.format(self.user_2.pk), Job.objects.exclude(pk=claimed[0].pk).get().key)
+
+    def test_send_many_enqueues_batches(self):
+        user_3 = User.objects.create_user('user_3', password='user_3_p')
+
+        Message.objects.send_many(self.user_1, [self.user_2.pk, 999, user_3.pk], 'Notice', batch_size=2)
+
+        self.assertEqual(
+            [[self.user_2.pk], [user_3.pk]],
+            [json.loads(payload)['user_ids'] for payload in Job.objects.order_by('id').values_list('payload', flat=True)]
+        )
+
+    def test_rolled_back(self):
+        try:
+            with transaction.atomic():
+                Job.objects.enqueue('test.fail', {})
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertFalse(Job.objects.exists())
+
+    def test_lease(self):
+        job = Job.objects.enqueue('test.fail', {})
+
+        self.assertEqual([job.pk], [claimed.pk for claimed in Job.objects.claim('worker_1', 10)])
+        self.assertEqual([], Job.objects.claim('worker_2', 10))
+
+        # The first worker died.
+        self._make_due()
+        claimed = Job.objects.claim('worker_2', 10)
+
+        self.assertEqual(2, claimed[0].attempts)
+        self.assertEqual('worker_2', claimed[0].locked_by)
+
+    def test_retry_with_backoff(self):
+        Job.objects.enqueue('test.fail', {'n': 1})
+        worker = Worker()
+
+        for attempt, delay in ((1, 2), (2, 4)):
+            started = timezone.now()
+            self.assertEqual(1, worker.run_once())
+
+            job = Job.objects.get()
+            self.assertEqual((Job.PENDING, attempt), (job.state, job.attempts))
+            self.assertEqual('ValueError: Boom', job.last_error)
+            self.assertGreaterEqual(job.run_at, started + timedelta(seconds=delay))
+            self.assertLess(job.run_at, started + timedelta(seconds=delay + 1))
+
+            # Not due yet.
+            self.assertEqual(0, worker.run_once())
+            self._make_due()
+
+        self.assertEqual(1, worker.run_once())
+
+        self.assertEqual(Job.FAILED, Job.objects.get().state)
+        self.assertEqual([{'n': 1}] * 3, self.failures)
+        self.assertEqual(0, worker.run_once())
+
+    def test_commands(self):
+        Job.objects.enqueue('test.fail', {})
+        Message.objects.send(self.user_1, self.user_2, 'Foo')
+        Job.objects.update(run_at=timezone.now() - timedelta(seconds=30))
+
+        output = StringIO()
+        call_command('job_stats', stdout=output)
+        self.assertIn('pending: 2\ndue: 2\nfailed: 0\nlag: 30', output.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('job_stats', max_lag=10, stdout=StringIO())
+
+        output = StringIO()
+        call_command('run_jobs', once=True, stdout=output)
+        self.assertIn('Ran 2 job(s).', output.getvalue())
+
+        self.assertEqual(
+            OrderedDict((('pending', 1), ('due', 0), ('failed', 0), ('lag', 0.0))),
+            Job.objects.get_stats()
+        )
+        call_command('job_stats', max_lag=10, stdout=StringIO())
@@ -3,9 +3,17 @@ from __future__ import unicode_literals
 
 from django.conf.urls import url
 
-from chat.views import MessageApiView, MessageListApiView
+from chat.views import (
+    ConversationListApiView, MessageApiView, MessageBulkApiView, MessageExportApiView, MessageListApiView,
+    MessageSearchApiView, MessageWaitApiView
+)
 
 urlpatterns = [
     url(r'^accounts/messages$', MessageApiView.as_view(), name='messages'),
+    url(r'^accounts/messages/bulk$', MessageBulkApiView.as_view(), name='bulk'),
+    url(r'^accounts/messages/wait$', MessageWaitApiView.as_view(), name='wait'),
+    url(r'^accounts/messages/search$', MessageSearchApiView.as_view(), name='search'),
+    url(r'^accounts/messages/export$', MessageExportApiView.as_view(), name='export'),
+    url(r'^accounts/conversations$', ConversationListApiView.as_view(), name='conversations'),
     url(r'^accounts/messages(?P<receiver_id>\d+)$', MessageListApiView.as_view(), name='list'),
 ]
@@ -1,25 +1,115 @@
 # Create your views here.
+import hashlib
+import json
+from calendar import timegm
+from collections import OrderedDict
+from operator import attrgetter
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from rest_framework.generics import CreateAPIView, ListAPIView
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.encoding import force_bytes
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import CreateAPIView, GenericAPIView, ListAPIView
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
-from chat.models import Message
-from chat.serializers import MessageSerializer, MessageUserDetailsSerializer
+from chat import export, sharding
+from chat.models import ArchivedMessage, Message, UserConversation, get_conversation_key
+from chat.notifier import get_notifier
+from chat.pagination import ConversationCursorPagination, MessageCursorPagination, SearchOffsetPagination
+from chat.search import get_terms, search_messages
+from chat.serializers import (
+    ConversationSerializer, MessageBulkSerializer, MessageFastSerializer, MessageSearchSerializer,
+    MessageSerializer, MessageUserDetailsSerializer
+)
+from drf_samples.routers import ReplicaReadsMixin
+
+# Sync tokens are stored in 64-bit integer columns.
+MAX_SYNC_TOKEN = 2 ** 63 - 1
+
+
+def get_sync_token_param(request, default=None):
+    if 'since' not in request.query_params:
+        return default
+
+    try:
+        since = int(request.query_params['since'])
+    except ValueError:
+        since = -1
+
+    if not 0 <= since <= MAX_SYNC_TOKEN:
+        raise ValidationError({'since': ['A valid sync token is required.']})
+
+    return since
+
+
+def get_peer_param(request):
+    """
+    User given by the optional `peer` query parameter, None without it.
+    """
+    if 'peer' not in request.query_params:
+        return None
+
+    try:
+        peer_id = int(request.query_params['peer'])
+    except ValueError:
+        raise ValidationError({'peer': ['A valid integer is required.']})
+
+    return get_object_or_404(User, pk=peer_id)
+
+
+def get_etag(*parts):
+    return hashlib.md5(force_bytes(json.dumps(parts, cls=DjangoJSONEncoder, sort_keys=True))).hexdigest()
+
 
+def get_not_modified_response(request, etag, last_modified=None):
+    """
+    304 response when the client's copy matches the validators, otherwise None.
+    """
+    if last_modified is not None:
+        # `If-Modified-Since` has whole seconds: a change later in the second
+        # the client's copy is from must not match it, so round up.
+        last_modified = timegm(last_modified.utctimetuple()) + (1 if last_modified.microsecond else 0)
 
-class MessageApiView(CreateAPIView):
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+
+def set_validators(response, etag, last_modified=None, weak=False):
+    """
+    Set the validators of `response`; a `weak` ETag for content that may change
+    in ways that do not matter, e.g. the `is_new` flags of the caller's own reads.
+    """
+    response['ETag'] = ('W/' if weak else '') + quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+
+    return response
+
+
+class MessageApiView(ReplicaReadsMixin, CreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
         unread_count = Message.objects.get_unread_count(request.user)
 
+        etag = get_etag(request.user.pk, unread_count, request.accepted_renderer.format)
+        not_modified = get_not_modified_response(request, etag)
+        if not_modified is not None:
+            return set_validators(not_modified, etag)
+
         data = {
             'unread': unread_count
         }
 
-        return Response(data)
+        return set_validators(Response(data), etag)
 
     def perform_create(self, serializer):
         message = Message.objects.send(
@@ -31,25 +121,314 @@ class MessageApiView(CreateAPIView):
         return message
 
 
-class MessageListApiView(ListAPIView):
+class MessageBulkApiView(GenericAPIView):
+    serializer_class = MessageBulkSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+
+        if serializer.is_valid():
+            results = Message.objects.send_many(
+                request.user,
+                serializer.validated_data['receivers'],
+                serializer.validated_data['content']
+            )
+
+            return Response(
+                data={'results': results},
+                status=status.HTTP_201_CREATED
+            )
+
+        return Response(
+            data=serializer.errors,
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+class MessageListApiView(ReplicaReadsMixin, ListAPIView):
     serializer_class = MessageUserDetailsSerializer
-    parser_classes = (IsAuthenticated,)
+    permission_classes = (IsAuthenticated,)
+    pagination_class = MessageCursorPagination
+
+    def initial(self, request, *args, **kwargs):
+        super(MessageListApiView, self).initial(request, *args, **kwargs)
+
+        # Fixed per request, streamed chunks are serialized after the view returns.
+        self.fast_serializer = settings.CHAT_FAST_SERIALIZER
 
     def get_queryset(self):
+        self.peer = get_object_or_404(User, pk=self.kwargs['receiver_id'])
+
         messages = Message.objects.get_conversation(
             self.request.user,
-            User.objects.get(pk=self.kwargs['receiver_id'])
+            self.peer
         )
 
+        if self.fast_serializer:
+            messages = Message.objects.as_rows(messages)
+
+        return messages
+
+    def get_archive_queryset(self):
+        """
+        Archived messages of the conversation, where pages continue past `get_queryset`.
+        """
+        messages = ArchivedMessage.objects.get_conversation(self.request.user, self.peer)
+
+        if self.fast_serializer:
+            messages = Message.objects.as_rows(messages)
+
         return messages
 
+    def get_serializer(self, *args, **kwargs):
+        if self.fast_serializer:
+            return MessageFastSerializer(*args, watermarks=self.get_read_watermarks(), **kwargs)
+
+        return super(MessageListApiView, self).get_serializer(*args, **kwargs)
+
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
 
-        serializer = self.get_serializer(queryset, many=True)
+        if 'since' in request.query_params:
+            return self.sync(request, queryset)
+
+        if request.query_params.get('stream'):
+            return self.stream(queryset)
+
+        etag, last_modified = self.get_validators()
+        not_modified = get_not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            # The client holds the page already, it still counts as read.
+            self.mark_read(self.paginate_queryset(Message.objects.as_rows(queryset)))
+            return set_validators(not_modified, etag, last_modified, weak=True)
+
+        page = self.paginate_queryset(queryset)
+        self.annotate_read_state(page)
+
+        serializer = self.get_serializer(page, many=True)
+
+        response = self.get_paginated_response(serializer.data)
+
+        self.mark_read(page)
+
+        return set_validators(response, etag, last_modified, weak=True)
+
+    def get_validators(self):
+        """
+        ETag and last modification time of the requested page, without fetching it.
+
+        Marking the page as read leaves them unchanged, so a repeated poll gets a 304.
+        The `is_new` flags of the caller's messages do change: the ETag is weak.
+        """
+        version = Message.objects.get_conversation_version(self.request.user, self.peer)
+
+        etag = get_etag(
+            self.request.user.pk,
+            self.request.get_full_path(),
+            self.request.accepted_renderer.format,
+            version,
+        )
+
+        return etag, version['modified']
+
+    def sync(self, request, queryset):
+        """
+        Messages created and read watermarks moved after the `since` sync token, oldest first.
+        """
+        since = get_sync_token_param(request)
+
+        page_size = self.paginator.get_page_size(request)
+
+        messages = list(queryset.filter(sync_token__gt=since).order_by('sync_token')[:page_size + 1])
+        # Archiving keeps the sync tokens: a client syncing from 0 gets the archive too.
+        archived = list(
+            self.get_archive_queryset().filter(sync_token__gt=since).order_by('sync_token')[:page_size + 1]
+        )
+        if archived:
+            messages = sorted(messages + archived, key=attrgetter('sync_token'))[:page_size + 1]
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
 
-        response = Response(serializer.data)
+        self.annotate_read_state(messages)
+        serializer = self.get_serializer(messages, many=True)
 
-        queryset.filter(receiver=self.request.user).update(is_new=False)
+        conversation_key = get_conversation_key(request.user.pk, self.peer.pk)
+        read_state = list(sharding.for_conversation(UserConversation.objects, conversation_key).filter(
+            conversation_key=conversation_key,
+            sync_token__gt=since
+        ).order_by('sync_token').values('user_id', 'last_read_id', 'sync_token'))
+
+        sync_tokens = [message.sync_token for message in messages]
+        if not has_more:
+            sync_tokens.extend(row['sync_token'] for row in read_state)
+
+        response = Response(OrderedDict([
+            ('sync_token', max(sync_tokens) if sync_tokens else since),
+            ('has_more', has_more),
+            ('results', serializer.data),
+            ('read_state', [
+                OrderedDict([('user_id', row['user_id']), ('last_read_id', row['last_read_id'])])
+                for row in read_state
+            ]),
+        ]))
+
+        self.mark_read(messages)
 
         return response
+
+    def stream(self, queryset):
+        """
+        Whole conversation as a JSON array, newest first with the archive merged
+        in, fetched and encoded chunk by chunk.
+        """
+        renderer = JSONRenderer()
+        chunks = Message.objects.iter_merged_chunks(
+            [queryset, self.get_archive_queryset()], settings.CHAT_STREAM_CHUNK_SIZE
+        )
+
+        def content():
+            separator = b''
+
+            yield b'['
+            for chunk in chunks:
+                self.annotate_read_state(chunk)
+                rows = self.get_serializer(chunk, many=True).data
+
+                yield separator + b','.join(renderer.render(row) for row in rows)
+                separator = b','
+
+                self.mark_read(chunk)
+            yield b']'
+
+        return StreamingHttpResponse(content(), content_type='application/json')
+
+    def get_read_watermarks(self):
+        """
+        Read watermarks as of the first call in this request.
+        """
+        if not hasattr(self, '_read_watermarks'):
+            self._read_watermarks = Message.objects.get_read_watermarks(self.request.user, self.peer)
+
+        return self._read_watermarks
+
+    def annotate_read_state(self, messages):
+        # The fast serializer derives `is_new` itself.
+        if self.fast_serializer:
+            return messages
+
+        return Message.objects.annotate_read_state(messages, self.get_read_watermarks())
+
+    def mark_read(self, messages):
+        """
+        Move the caller's read watermark over the unread messages they received
+        in this request, `messages` included, up to the oldest unread message
+        they have not received yet.
+        """
+        read_up_to = self.get_read_watermarks().get(self.request.user.pk, 0)
+        unread_ids = set(
+            message.pk for message in messages
+            if message.receiver_id == self.request.user.pk and message.pk > read_up_to
+        )
+        if not unread_ids:
+            return
+
+        # A stream receives the newest messages first, the watermark moves once
+        # the older chunks caught up with it.
+        received_ids = self._received_ids = getattr(self, '_received_ids', set()) | unread_ids
+        Message.objects.mark_read(self.request.user, self.peer, max(received_ids), received_ids=received_ids)
+
+
+class ConversationListApiView(ListAPIView):
+    """
+    Inbox: the user's conversations with their last message and unread count, most recent first.
+    """
+    serializer_class = ConversationSerializer
+    permission_classes = (IsAuthenticated,)
+    pagination_class = ConversationCursorPagination
+
+    def get_queryset(self):
+        return Message.objects.get_inbox(self.request.user)
+
+
+class MessageExportApiView(GenericAPIView):
+    """
+    Download of all the user's messages, or those with `peer`, as JSONL or CSV
+    (`export_format`), gzipped with `gzip=1`. Reading them here does not mark
+    them as read.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.query_params.get('export_format', 'jsonl')
+        if export_format not in export.RENDERERS:
+            raise ValidationError({'export_format': ['Must be one of: {}.'.format(', '.join(export.RENDERERS))]})
+
+        peer = get_peer_param(request)
+        compress = request.query_params.get('gzip') in ('1', 'true')
+
+        rows = Message.objects.iter_export(request.user, peer, settings.CHAT_STREAM_CHUNK_SIZE)
+        response = StreamingHttpResponse(
+            export.export(rows, export_format, compress),
+            content_type='application/gzip' if compress else export.CONTENT_TYPES[export_format]
+        )
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+            export.get_filename(export_format, compress)
+        )
+
+        return response
+
+
+class MessageSearchApiView(GenericAPIView):
+    """
+    Messages of the user matching `q`, best first; `peer` limits them to one conversation.
+    """
+    serializer_class = MessageSearchSerializer
+    permission_classes = (IsAuthenticated,)
+    pagination_class = SearchOffsetPagination
+
+    def get(self, request, *args, **kwargs):
+        text = request.query_params.get('q', '')
+        if not get_terms(text):
+            raise ValidationError({'q': ['At least one word to search for is required.']})
+
+        peer = get_peer_param(request)
+
+        page = self.paginate_queryset(search_messages(request.user, text, peer))
+        serializer = self.get_serializer(page, many=True)
+
+        return self.get_paginated_response(serializer.data)
+
+
+class MessageWaitApiView(GenericAPIView):
+    """
+    Long poll: hold the request until a message is delivered to the user or the timeout expires.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        since = get_sync_token_param(request)
+
+        try:
+            timeout = float(request.query_params.get('timeout', settings.CHAT_LONG_POLL_TIMEOUT))
+        except ValueError:
+            raise ValidationError({'timeout': ['A valid number is required.']})
+
+        timeout = max(0, min(timeout, settings.CHAT_LONG_POLL_TIMEOUT))
+
+        # Subscribe before reading the token, so no delivery slips in between.
+        with get_notifier().subscribe(request.user.pk) as subscription:
+            sync_token = Message.objects.get_sync_token(request.user)
+            if since is None:
+                since = sync_token
+
+            if sync_token <= since and subscription.wait(timeout):
+                sync_token = Message.objects.get_sync_token(request.user)
+
+        data = {
+            'changed': sync_token > since,
+            'sync_token': sync_token,
+            'unread': Message.objects.get_unread_count(request.user),
+        }
+
+        return Response(data)
@@ -0,0 +1,60 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from chat import jobs
+from chat.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(object):
+    """
+    Runs the due jobs of `Job`, a batch at a time; see `python manage.py run_jobs`.
+    """
+
+    def __init__(self, name=None, batch_size=None, lease=None):
+        self.name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.batch_size = batch_size or settings.CHAT_JOB_BATCH_SIZE
+        self.lease = lease or settings.CHAT_JOB_LEASE
+
+    def run_once(self):
+        """
+        Run one batch of due jobs; return how many ran, failed ones included.
+        """
+        claimed = Job.objects.claim(self.name, self.batch_size, self.lease)
+        for job in claimed:
+            self.run_job(job)
+
+        return len(claimed)
+
+    def run(self, poll_interval=None, should_stop=lambda: False):
+        """
+        Run jobs until `should_stop()`, polling every `poll_interval` seconds when idle.
+        """
+        if poll_interval is None:
+            poll_interval = settings.CHAT_JOB_POLL_INTERVAL
+
+        while not should_stop():
+            # Long-lived: drop connections past `CONN_MAX_AGE` or broken, as requests do.
+            close_old_connections()
+
+            if not self.run_once():
+                time.sleep(poll_interval)
+
+    def run_job(self, job):
+        try:
+            jobs.run(job.name, json.loads(job.payload))
+        except Exception as e:
+            logger.exception('Job %s (%s) failed on attempt %s.', job.pk, job.name, job.attempts)
+            Job.objects.retry(job, '{}: {}'.format(type(e).__name__, e))
+        else:
+            Job.objects.complete(job)
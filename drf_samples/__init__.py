@@ -0,0 +1 @@
+default_app_config = 'drf_samples.apps.DrfSamplesConfig'
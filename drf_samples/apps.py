@@ -0,0 +1,16 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+from django.core import checks
+from django.db.backends.signals import connection_created
+
+
+class DrfSamplesConfig(AppConfig):
+    name = 'drf_samples'
+
+    def ready(self):
+        from drf_samples.database import configure_connection
+        from drf_samples.routers import check_replica_cache
+
+        connection_created.connect(configure_connection, dispatch_uid='drf_samples.configure_connection')
+        checks.register(check_replica_cache, checks.Tags.caches)
@@ -0,0 +1,39 @@
+# encoding: utf-8
+"""
+Per-connection database settings, applied when Django opens a connection.
+
+With `CONN_MAX_AGE` a connection serves many requests, so the pragmas cost
+one round of statements per connection rather than per request.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    `connection_created` receiver running `settings.SQLITE_PRAGMAS` on SQLite connections.
+    """
+    if connection.vendor != 'sqlite':
+        return
+
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in sorted(settings.SQLITE_PRAGMAS.items()):
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+    finally:
+        cursor.close()
+
+
+def get_sqlite_pragmas(connection, names):
+    """
+    Current values of the pragmas `names` on `connection`, for checks and reports.
+    """
+    with connection.cursor() as cursor:
+        values = {}
+        for name in names:
+            cursor.execute('PRAGMA {}'.format(name))
+            row = cursor.fetchone()
+            values[name] = row[0] if row else None
+
+        return values
@@ -0,0 +1,257 @@
+# encoding: utf-8
+"""
+Per-request timing of SQL, serializers, rendering, session I/O and password hashing.
+
+`ServerTimingMiddleware` samples requests, reports the collected timings in a
+`Server-Timing` response header and logs them as one structured line, at
+warning level when a threshold from `settings.SERVER_TIMING` is crossed. It
+also logs the process-wide counters of `register_stats` every
+`STATS_INTERVAL` seconds.
+"""
+from __future__ import unicode_literals
+
+import logging
+import random
+import re
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connections
+from rest_framework import renderers, serializers
+
+logger = logging.getLogger(__name__)
+stats_logger = logging.getLogger(__name__ + '.stats')
+
+_local = threading.local()
+
+_stats = OrderedDict()
+
+# String and number literals of a logged statement; what remains identifies
+# statements issued again and again with other parameters.
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class RequestTimings(object):
+    """
+    Durations in seconds spent in named parts of the current request.
+
+    A part entered again while already running, e.g. a renderer calling
+    another renderer, is only counted once.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self._running = Counter()
+
+    @contextmanager
+    def span(self, name):
+        self._running[name] += 1
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self._running[name] -= 1
+            if not self._running[name]:
+                self.durations[name] += default_timer() - start
+
+
+def get_current_timings():
+    """
+    Timings of the request handled by this thread, None when it is not sampled.
+    """
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def span(name):
+    timings = get_current_timings()
+    if timings is None:
+        yield
+        return
+
+    with timings.span(name):
+        yield
+
+
+def register_stats(name, snapshot):
+    """
+    Log `snapshot()`, a mapping of the counters of this process, as `name.<key>=<value>`.
+    """
+    _stats[name] = snapshot
+
+
+def log_stats():
+    record = OrderedDict()
+    for name, snapshot in list(_stats.items()):
+        for key, value in sorted(snapshot().items()):
+            record['{}.{}'.format(name, key)] = round(value, 3) if isinstance(value, float) else value
+
+    stats_logger.info(
+        ' '.join('{}={}'.format(key, value) for key, value in record.items()),
+        extra={'stats': record},
+    )
+
+
+class TimedSerializerMixin(object):
+    """
+    Counts validation and representation of the serializer as serializer time.
+    """
+
+    def is_valid(self, *args, **kwargs):
+        with span('serializer'):
+            return super(TimedSerializerMixin, self).is_valid(*args, **kwargs)
+
+    @property
+    def data(self):
+        with span('serializer'):
+            return super(TimedSerializerMixin, self).data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class TimedRendererMixin(object):
+    def render(self, *args, **kwargs):
+        with span('render'):
+            return super(TimedRendererMixin, self).render(*args, **kwargs)
+
+
+class TimedJSONRenderer(TimedRendererMixin, renderers.JSONRenderer):
+    pass
+
+
+class TimedBrowsableAPIRenderer(TimedRendererMixin, renderers.BrowsableAPIRenderer):
+    pass
+
+
+class ServerTimingMiddleware(object):
+    """
+    Outermost middleware: samples requests and reports their timings.
+
+    SQL is timed through Django's query log, forced on for sampled requests
+    only, so each statement is timed to the millisecond. Session time includes
+    the session's own queries. Streamed content is produced after the
+    response leaves the middleware and is not covered.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._stats_lock = threading.Lock()
+        self._stats_logged_at = default_timer()
+
+    def __call__(self, request):
+        options = settings.SERVER_TIMING
+        self._log_stats_if_due(options)
+
+        if random.random() >= options['SAMPLE_RATE']:
+            return self.get_response(request)
+
+        timings = _local.timings = RequestTimings()
+        query_logs = self._start_query_logs()
+        try:
+            with timings.span('total'):
+                response = self.get_response(request)
+        finally:
+            queries = self._stop_query_logs(query_logs)
+            del _local.timings
+
+        self._report(request, response, timings, queries, options)
+
+        return response
+
+    def _log_stats_if_due(self, options):
+        now = default_timer()
+        with self._stats_lock:
+            if now - self._stats_logged_at < options['STATS_INTERVAL']:
+                return
+            self._stats_logged_at = now
+
+        log_stats()
+
+    def _start_query_logs(self):
+        query_logs = []
+        for connection in connections.all():
+            query_logs.append((connection, connection.force_debug_cursor, len(connection.queries_log)))
+            connection.force_debug_cursor = True
+
+        return query_logs
+
+    def _stop_query_logs(self, query_logs):
+        queries = []
+        for connection, force_debug_cursor, start in query_logs:
+            connection.force_debug_cursor = force_debug_cursor
+            queries.extend(list(connection.queries_log)[start:])
+
+        return queries
+
+    def _report(self, request, response, timings, queries, options):
+        db_time = sum(float(query['time']) for query in queries)
+
+        metrics = OrderedDict((
+            ('db', db_time),
+            ('serializer', timings.durations['serializer']),
+            ('render', timings.durations['render']),
+            ('session', timings.durations['session']),
+            ('hash', timings.durations['hash']),
+            ('total', timings.durations['total']),
+        ))
+
+        response['Server-Timing'] = ', '.join(
+            '{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in metrics.items()
+        ) + ', queries;desc="{}"'.format(len(queries))
+
+        warnings = []
+
+        repeated = Counter(SQL_LITERALS.sub('?', query['sql']) for query in queries).most_common(1)
+        if repeated and repeated[0][1] >= options['N_PLUS_ONE_THRESHOLD']:
+            warnings.append('n+1: {} x {}'.format(repeated[0][1], repeated[0][0]))
+
+        if len(queries) >= options['QUERY_COUNT_THRESHOLD']:
+            warnings.append('queries: {}'.format(len(queries)))
+
+        if metrics['total'] * 1000 >= options['SLOW_REQUEST_MS']:
+            warnings.append('slow')
+
+        record = OrderedDict((
+            ('method', request.method),
+            ('path', request.path),
+            ('status', response.status_code),
+            ('queries', len(queries)),
+        ))
+        record.update(('{}_ms'.format(name), round(seconds * 1000, 2)) for name, seconds in metrics.items())
+
+        logger.log(
+            logging.WARNING if warnings else logging.INFO,
+            ' '.join('{}={}'.format(key, value) for key, value in record.items()) +
+            ''.join(' [{}]'.format(warning) for warning in warnings),
+            extra={'timing': record, 'timing_warnings': warnings},
+        )
+
+
+class SessionTimingMiddleware(object):
+    """
+    Times loading and saving of the session; goes right after `SessionMiddleware`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = get_current_timings()
+        if timings is not None:
+            session = request.session
+            session.load = self._timed(timings, session.load)
+            session.save = self._timed(timings, session.save)
+
+        return self.get_response(request)
+
+    def _timed(self, timings, method):
+        def timed(*args, **kwargs):
+            with timings.span('session'):
+                return method(*args, **kwargs)
+
+        return timed
@@ -0,0 +1,142 @@
+# encoding: utf-8
+"""
+Read/write splitting between the primary database and `settings.DATABASE_REPLICAS`.
+
+Only views opting in with `ReplicaReadsMixin` read from a replica, and only
+the models of `REPLICA_MODELS`. Everything else, writes, reads in a
+transaction and reads after a write of the same request, uses the primary.
+
+A user who wrote is pinned to the primary for
+`settings.DATABASE_REPLICA_PIN_SECONDS`, long enough for the replicas to
+catch up, so clients always read their own writes; see
+`ReplicaPinningMiddleware`.
+"""
+from __future__ import unicode_literals
+
+import random
+import threading
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+REPLICA_MODELS = frozenset((
+    'chat.message',
+    'chat.archivedmessage',
+    'chat.userconversation',
+    'accounts.userprofile',
+))
+
+PIN_KEY = 'db:pin:{}'
+
+# Cache backends keeping their entries in the process, where the pins of the
+# other server processes are not seen.
+UNSHARED_CACHE_BACKENDS = frozenset((
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+))
+
+_local = threading.local()
+
+
+def pin_user(user_id):
+    """
+    Send the reads of `user_id` to the primary for a while.
+    """
+    cache.set(PIN_KEY.format(user_id), True, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    return bool(cache.get(PIN_KEY.format(user_id)))
+
+
+def allow_replica_reads(user_id):
+    """
+    Let the current thread read from replicas, unless `user_id` is pinned.
+    """
+    _local.replica_reads = bool(settings.DATABASE_REPLICAS) and not is_pinned(user_id)
+
+
+def disallow_replica_reads():
+    _local.replica_reads = False
+
+
+def check_replica_cache(app_configs, **kwargs):
+    """
+    System check: with replicas the pins must be shared by every server process.
+    """
+    backend = settings.CACHES[DEFAULT_CACHE_ALIAS]['BACKEND']
+    if not settings.DATABASE_REPLICAS or backend not in UNSHARED_CACHE_BACKENDS:
+        return []
+
+    return [checks.Error(
+        "DATABASE_REPLICAS needs a cache shared by the server processes, not {}.".format(backend),
+        hint="Users who wrote are pinned to the primary in the cache; use e.g. memcached.",
+        obj='CACHES',
+        id='drf_samples.E001',
+    )]
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if not getattr(_local, 'replica_reads', False):
+            return None
+
+        if model._meta.label_lower not in REPLICA_MODELS:
+            return None
+
+        # A transaction reads what it is about to change.
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        # The rest of the request reads its own writes.
+        _local.replica_reads = False
+        _local.wrote = True
+
+        return DEFAULT_DB_ALIAS
+
+
+class ReplicaReadsMixin(object):
+    """
+    API view mixin sending the reads of its safe methods to replicas.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super(ReplicaReadsMixin, self).initial(request, *args, **kwargs)
+
+        if request.method in SAFE_METHODS:
+            allow_replica_reads(request.user.pk)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ReplicaReadsMixin, self).dispatch(request, *args, **kwargs)
+        finally:
+            disallow_replica_reads()
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Pins the user of a request that wrote to the database; goes after `AuthenticationMiddleware`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.wrote = False
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote, _local.wrote = getattr(_local, 'wrote', False), False
+
+        # Set by DRF authentication too, token clients included.
+        user = getattr(request, 'user', None)
+        if wrote and user is not None and user.is_authenticated:
+            pin_user(user.pk)
+
+        return response
@@ -38,16 +38,23 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
 
+    'rest_framework.authtoken',
+
+    'drf_samples',
     'accounts',
     'chat',
+    'benchmarks',
 ]
 
 MIDDLEWARE = [
+    'drf_samples.instrumentation.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'drf_samples.instrumentation.SessionTimingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'drf_samples.routers.ReplicaPinningMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -72,24 +79,214 @@ TEMPLATES = [
 
 SESSION_ENGINE = 'django.contrib.sessions.backends.file'
 
+
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'drf_samples',
+    }
+}
+
+# Comma separated memcached servers, shared by the server processes; needed with replicas.
+if os.environ.get('MEMCACHED_LOCATION'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ['MEMCACHED_LOCATION'].split(','),
+    }
+
+# Seconds an unread count may live in the cache; writers end it on commit.
+UNREAD_COUNT_CACHE_TIMEOUT = 300
+
+
+# Long polling
+# `chat.notifier.UnixSocketNotifier` wakes waiting clients across worker processes,
+# the `run_jobs` workers included; `InProcessNotifier` needs `CHAT_JOBS_EAGER`.
+
+CHAT_NOTIFIER = {
+    'BACKEND': 'chat.notifier.UnixSocketNotifier',
+    'OPTIONS': {},
+}
+
+# Longest time in seconds a client may wait for new messages.
+CHAT_LONG_POLL_TIMEOUT = 25
+
+# Most receivers a single bulk send may address.
+CHAT_BULK_SEND_MAX_RECEIVERS = 5000
+
+# Messages fetched and encoded at a time by streaming responses.
+CHAT_STREAM_CHUNK_SIZE = 500
+
+# Serialize conversations from `values_list` tuples instead of model instances.
+CHAT_FAST_SERIALIZER = False
+
+# Retention: `archive_messages` moves read messages older than this many days
+# out of `chat.Message` into `chat.ArchivedMessage`, and deletes archived ones
+# older than `CHAT_PURGE_AFTER_DAYS`, unless None.
+CHAT_ARCHIVE_AFTER_DAYS = 365
+CHAT_PURGE_AFTER_DAYS = None
+
+# Messages moved or deleted per transaction by `archive_messages`.
+CHAT_ARCHIVE_CHUNK_SIZE = 1000
+
+# Background jobs, see `chat.jobs`. They are stored in `chat.Job` and run by
+# `python manage.py run_jobs`, which needs a `CHAT_NOTIFIER` reaching other
+# processes, e.g. `chat.notifier.UnixSocketNotifier`. Eager jobs run in the
+# process queueing them when its transaction commits instead, as in the tests.
+CHAT_JOBS_EAGER = False
+
+# A failed job is retried after CHAT_JOB_RETRY_DELAY seconds, doubled with each
+# attempt up to CHAT_JOB_MAX_RETRY_DELAY, until it failed CHAT_JOB_MAX_ATTEMPTS times.
+CHAT_JOB_MAX_ATTEMPTS = 5
+CHAT_JOB_RETRY_DELAY = 2
+CHAT_JOB_MAX_RETRY_DELAY = 600
+
+# Seconds a claimed job is hidden from other workers; longer than any job runs.
+CHAT_JOB_LEASE = 60
+
+# Jobs claimed at a time by a worker, and seconds an idle worker sleeps.
+CHAT_JOB_BATCH_SIZE = 100
+CHAT_JOB_POLL_INTERVAL = 1.0
+
 WSGI_APPLICATION = 'drf_samples.wsgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# Seconds a connection is kept open across requests, 0 to close it after each one.
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+if os.environ.get('POSTGRES_DB'):
+    # Needs psycopg2.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'USER': os.environ.get('POSTGRES_USER', ''),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', ''),
+            'PORT': os.environ.get('POSTGRES_PORT', ''),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        }
+    }
+
+    # Read-only standbys, e.g. streaming replicas, as comma separated hosts.
+    for i, host in enumerate(filter(None, os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(','))):
+        DATABASES['replica_{}'.format(i + 1)] = dict(
+            DATABASES['default'], HOST=host, TEST={'MIRROR': 'default'}
+        )
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        }
     }
+
+# Aliases of `DATABASES` sharing the conversations, see `chat.sharding`. The
+# order matters: after changing it run `python manage.py rebalance_shards`.
+CHAT_SHARDS = ['default']
+
+# Further shards as comma separated database names, or files for SQLite.
+for i, name in enumerate(filter(None, os.environ.get('CHAT_SHARD_DATABASES', '').split(','))):
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+        name = os.path.join(BASE_DIR, name)
+
+    DATABASES['shard_{}'.format(i + 1)] = dict(DATABASES['default'], NAME=name)
+    CHAT_SHARDS.append('shard_{}'.format(i + 1))
+
+# Aliases of `DATABASES` serving the chat reads of `drf_samples.routers.ReplicaReadsMixin` views.
+DATABASE_REPLICAS = [alias for alias in sorted(DATABASES) if alias.startswith('replica_')]
+
+DATABASE_ROUTERS = ['drf_samples.routers.ReplicaRouter']
+
+# Seconds a user who wrote reads from the primary only; more than the replication lag.
+DATABASE_REPLICA_PIN_SECONDS = 5
+
+# Applied to every new SQLite connection, see `drf_samples.database`. WAL lets
+# readers proceed while a writer commits; `synchronous = NORMAL` is durable
+# across application crashes in WAL mode, only a power loss may lose the last
+# transactions. `cache_size` is in KiB when negative, `mmap_size` in bytes.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -20000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
 }
 
 # DRF
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        # Without a session cookie the session check costs no I/O.
         'rest_framework.authentication.SessionAuthentication',
-    )
+        'accounts.authentication.CachedTokenAuthentication',
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'drf_samples.instrumentation.TimedJSONRenderer',
+        'drf_samples.instrumentation.TimedBrowsableAPIRenderer',
+    ),
+}
+
+# Seconds between registration step 1 and step 2.
+ACCOUNTS_REGISTRATION_TICKET_MAX_AGE = 600
+
+# Password hashing runs in PROCESSES worker processes (inline when 0); requests
+# beyond MAX_PENDING hashes in progress, or waiting over TIMEOUT seconds, get a 503.
+ACCOUNTS_HASHING_POOL = {
+    'PROCESSES': 2,
+    'MAX_PENDING': 8,
+    'TIMEOUT': 5,
+}
+
+# Validated API tokens kept in memory by each process.
+ACCOUNTS_TOKEN_CACHE_SIZE = 10000
+# Seconds a token revoked elsewhere, or its deactivated user, stays valid in a process.
+ACCOUNTS_TOKEN_CACHE_TTL = 60
+
+# Server-Timing headers and timing log lines of sampled requests.
+SERVER_TIMING = {
+    # Share of requests instrumented, between 0 and 1. A sampled request keeps
+    # a log of its queries, so production samples few.
+    'SAMPLE_RATE': 1.0 if DEBUG else 0.01,
+    # Identical statements (up to their parameters) in one request flagged as N+1.
+    'N_PLUS_ONE_THRESHOLD': 5,
+    'QUERY_COUNT_THRESHOLD': 50,
+    'SLOW_REQUEST_MS': 500,
+    # Seconds between two log lines of the process-wide counters, e.g. unread cache hits.
+    'STATS_INTERVAL': 60,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # INFO logs every sampled request, WARNING only the flagged ones.
+        'drf_samples.instrumentation': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'drf_samples.instrumentation.stats': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # Failed background jobs, with their traceback.
+        'chat.workers': {
+            'handlers': ['console'],
+            'level': 'ERROR',
+        },
+    },
 }
 
 
@@ -0,0 +1,270 @@
+import logging
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from accounts.models import UserProfile
+from accounts.serializers import UserSerializer
+from chat.cache import unread_count_stats
+from chat.models import ArchivedMessage, Message, UnreadCounter, UserConversation
+from drf_samples import routers
+from drf_samples.database import get_sqlite_pragmas
+from drf_samples.instrumentation import ServerTimingMiddleware, logger, stats_logger
+
+
+def parse_server_timing(header):
+    metrics = {}
+    for metric in header.split(', '):
+        name, param = metric.split(';', 1)
+        key, value = param.split('=', 1)
+        metrics[name] = float(value) if key == 'dur' else int(value.strip('"'))
+
+    return metrics
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+SERVER_TIMING = dict(
+    SAMPLE_RATE=1.0, N_PLUS_ONE_THRESHOLD=5, QUERY_COUNT_THRESHOLD=50, SLOW_REQUEST_MS=500, STATS_INTERVAL=60
+)
+
+
+# Tests run with DEBUG off, which samples few requests.
+@override_settings(SERVER_TIMING=SERVER_TIMING)
+class ServerTimingTestCase(APITestCase):
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.addCleanup(setattr, logger, 'handlers', logger.handlers)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.handlers = [self.handler]
+        logger.setLevel(logging.INFO)
+
+        self.user = User.objects.create_user('user_1', password='user_1_p')
+
+    def test_header(self):
+        peer = User.objects.create_user('user_2')
+        for i in range(10):
+            Message.objects.send(peer, self.user, 'msg {}'.format(i))
+        self.client.login(username='user_1', password='user_1_p')
+
+        response = self.client.get(reverse('chat:list', args=(peer.id,)))
+        metrics = parse_server_timing(response['Server-Timing'])
+
+        self.assertEqual(
+            set(['db', 'serializer', 'render', 'session', 'hash', 'total', 'queries']), set(metrics)
+        )
+        self.assertGreater(metrics['queries'], 0)
+        self.assertGreater(metrics['serializer'], 0)
+        self.assertGreater(metrics['render'], 0)
+        self.assertGreater(metrics['session'], 0)
+        self.assertGreaterEqual(metrics['total'], metrics['render'])
+
+        record, = self.handler.records
+        self.assertEqual(200, record.timing['status'])
+        self.assertEqual(metrics['queries'], record.timing['queries'])
+
+    @override_settings(SERVER_TIMING=dict(SERVER_TIMING, SAMPLE_RATE=0.0))
+    def test_not_sampled(self):
+        response = self.client.post(reverse('accounts:login'), {'username': 'user_1', 'password': 'x'})
+
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual([], self.handler.records)
+
+    @override_settings(SERVER_TIMING=dict(SERVER_TIMING, SAMPLE_RATE=0.0, STATS_INTERVAL=0))
+    def test_stats_logged(self):
+        handler = RecordingHandler()
+        self.addCleanup(setattr, stats_logger, 'handlers', stats_logger.handlers)
+        stats_logger.handlers = [handler]
+
+        cache.clear()
+        unread_count_stats.reset()
+        Message.objects.get_unread_count(self.user)
+        Message.objects.get_unread_count(self.user)
+        # Logged as the next request comes in, sampled or not.
+        self.client.get(reverse('chat:messages'))
+
+        record, = handler.records
+        self.assertEqual(1, record.stats['unread_cache.hits'])
+        self.assertEqual(1, record.stats['unread_cache.misses'])
+        self.assertIn('unread_cache.hit_ratio=0.5', record.getMessage())
+
+    def test_n_plus_one(self):
+        for i in range(5):
+            user = User.objects.create_user('user_{}'.format(i + 2))
+            UserProfile.objects.create(
+                user=user, birth_date='2000-01-01', country='Poland', city='Warszawa',
+                post_code='00-001', telephone_number='+48123456789'
+            )
+
+        def view(request):
+            # One profile query per user.
+            UserSerializer(User.objects.all(), many=True).data
+            return HttpResponse()
+
+        ServerTimingMiddleware(view)(RequestFactory().get('/'))
+
+        record, = self.handler.records
+        self.assertEqual(logging.WARNING, record.levelno)
+        self.assertIn('accounts_userprofile', record.timing_warnings[0])
+        self.assertTrue(record.timing_warnings[0].startswith('n+1: 6 x '))
+
+
+class DatabaseProfileTestCase(APITestCase):
+    def _connect(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        settings_dict = dict(connection.settings_dict, NAME=os.path.join(directory, 'db.sqlite3'))
+        wrapper = DatabaseWrapper(settings_dict, alias='profile')
+        self.addCleanup(wrapper.close)
+
+        return wrapper
+
+    def test_pragmas_applied_on_connect(self):
+        pragmas = get_sqlite_pragmas(self._connect(), ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size'))
+
+        self.assertEqual({'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000, 'cache_size': -20000}, pragmas)
+
+    @override_settings(SQLITE_PRAGMAS={})
+    def test_no_pragmas(self):
+        self.assertEqual('delete', get_sqlite_pragmas(self._connect(), ('journal_mode',))['journal_mode'])
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTestCase(APITransactionTestCase):
+    """
+    A second SQLite file stands in for the replica; nothing replicates to it,
+    so whatever a view returns tells which database it read.
+    """
+
+    replicated_models = (User, UserProfile, Message, ArchivedMessage, UserConversation, UnreadCounter)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        connections.databases['replica'] = dict(
+            connection.settings_dict, NAME=os.path.join(cls.directory, 'replica.sqlite3'), TEST={}
+        )
+        with connections['replica'].schema_editor() as editor:
+            for model in cls.replicated_models:
+                editor.create_model(model)
+
+        super(ReplicaRouterTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections.databases['replica']
+        del connections['replica']
+        shutil.rmtree(cls.directory)
+
+        super(ReplicaRouterTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        with connections['replica'].cursor() as cursor:
+            for model in self.replicated_models:
+                cursor.execute('DELETE FROM {}'.format(model._meta.db_table))
+        cache.clear()
+
+        self.user_1 = User.objects.create_user('user_1')
+        self.user_2 = User.objects.create_user('user_2')
+        self.client.force_authenticate(self.user_1)
+
+    def _replicate(self):
+        for model in self.replicated_models:
+            model.objects.using('replica').bulk_create(list(model.objects.all()))
+
+    def test_unread_count_not_cached_from_replica(self):
+        # The receiver did not write, so is not pinned; the replica lags behind.
+        Message.objects.send(self.user_2, self.user_1, 'Hello')
+
+        response = self.client.get(reverse('chat:messages'))
+
+        self.assertEqual(1, response.json()['unread'])
+        self.assertFalse(routers.is_pinned(self.user_1.pk))
+
+        self._replicate()
+        response = self.client.get(reverse('chat:messages'))
+
+        self.assertEqual(1, response.json()['unread'])
+
+    def test_pinned_after_send(self):
+        UnreadCounter.objects.using('replica').create(user_id=self.user_1.pk, unread=7)
+
+        response = self.client.post(reverse('chat:messages'), {'receiver': self.user_2.pk, 'content': 'Hello'})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(1, Message.objects.count())
+        self.assertFalse(Message.objects.using('replica').exists())
+        self.assertTrue(routers.is_pinned(self.user_1.pk))
+
+        response = self.client.get(reverse('chat:messages'))
+
+        self.assertEqual(0, response.json()['unread'])
+
+    def test_pinned_after_mark_read(self):
+        Message.objects.send(self.user_2, self.user_1, 'msg 1')
+        Message.objects.send(self.user_2, self.user_1, 'msg 2')
+        self._replicate()
+        Message.objects.send(self.user_2, self.user_1, 'msg 3')
+        url = reverse('chat:list', args=(self.user_2.pk,))
+
+        response = self.client.get(url)
+        self.assertEqual(2, len(response.json()['results']))
+        self.assertTrue(routers.is_pinned(self.user_1.pk))
+
+        response = self.client.get(url)
+        self.assertEqual(3, len(response.json()['results']))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        UnreadCounter.objects.using('replica').create(user_id=self.user_1.pk, unread=7)
+
+        response = self.client.get(reverse('chat:messages'))
+
+        self.assertEqual(0, response.json()['unread'])
+
+    def test_router(self):
+        router = routers.ReplicaRouter()
+
+        self.assertIsNone(router.db_for_read(Message))
+
+        routers.allow_replica_reads(self.user_1.pk)
+        self.addCleanup(routers.disallow_replica_reads)
+        self.assertEqual('replica', router.db_for_read(Message))
+        self.assertIsNone(router.db_for_read(User))
+
+        with transaction.atomic():
+            self.assertIsNone(router.db_for_read(Message))
+
+        self.assertEqual('default', router.db_for_write(Message))
+        self.assertIsNone(router.db_for_read(Message))
+
+        routers.pin_user(self.user_1.pk)
+        routers.allow_replica_reads(self.user_1.pk)
+        self.assertIsNone(router.db_for_read(Message))
+
+    def test_unshared_cache_rejected(self):
+        self.assertEqual(['drf_samples.E001'], [error.id for error in routers.check_replica_cache(None)])
+
+        memcached = {'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}}
+        with self.settings(CACHES=memcached):
+            self.assertEqual([], routers.check_replica_cache(None))
+
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertEqual([], routers.check_replica_cache(None))